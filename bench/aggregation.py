@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# Cost of Solver.aggregate_received_updates' weighted sum over the updates
+# of many peers: one flat in-place accumulation (src.aggregation) versus the
+# old per-layer sum of alpha * weight, and versus stacking the flat updates
+# and multiplying by the alphas. Updates are decoded from the wire format
+# like received ones.
+# Run from the repository root: python -m bench.aggregation
+import time
+import torch
+from src.neural_net import Net
+from src.aggregation import weighted_sum, flatten
+from src.update_metadata.model_update import ModelUpdate
+
+def per_layer(alphas, weight_list, keys):
+    return {idx: sum([alpha * weight[idx] for alpha, weight in zip(alphas, weight_list)]) for idx in keys}
+
+def stacked(alphas, weight_list, keys):
+    updates = torch.stack([flatten([weight[k] for k in keys]) for weight in weight_list])
+    return torch.tensor(alphas) @ updates
+
+def run(fn, alphas, weight_list, keys, repeat):
+    fn(alphas, weight_list, keys)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(alphas, weight_list, keys)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    net = Net()
+    own = {str(idx): params.data for idx, params in enumerate(net.parameters())}
+    keys = list(own.keys())
+    print(f"{'peers':>6}{'per-layer ms':>14}{'stacked ms':>12}{'flat ms':>10}")
+    for peers in [2, 16, 128]:
+        weight_list = [ModelUpdate.from_bytes(ModelUpdate(
+            {k: torch.randn_like(v) for k, v in own.items()}, {}).to_bytes()).updates for _ in range(peers)]
+        weight_list.append(own)
+        alphas = [1.0 / len(weight_list)] * len(weight_list)
+        repeat = max(3, 200 // peers)
+        print(f"{peers:>6}{run(per_layer, alphas, weight_list, keys, repeat):>14.2f}"
+              f"{run(stacked, alphas, weight_list, keys, repeat):>12.2f}"
+              f"{run(weighted_sum, alphas, weight_list, keys, repeat):>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# Cost of one pass over a node's MNIST partition in minibatches of 100:
+# DataLoader over the dataset, converting every example through PIL and
+# ToTensor like torchvision's MNIST, versus TensorBatchLoader, which
+# converts the partition once when built and then only slices it.
+# Random images stand in for MNIST.
+# Run from the repository root: python -m bench.batch_loader
+import time
+import torch
+from PIL import Image
+from torchvision import transforms
+from torch.utils.data import DataLoader, Dataset
+from src.data_partition import DataPartitioner, TensorBatchLoader, dataset_tensors
+
+class FakeMNIST(Dataset):
+    def __init__(self, num_examples):
+        self.data = torch.randint(0, 256, (num_examples, 28, 28), dtype=torch.uint8)
+        self.targets = torch.randint(0, 10, (num_examples,))
+        self.transform = transforms.ToTensor()
+
+    def __getitem__(self, index):
+        img = Image.fromarray(self.data[index].numpy(), mode='L')
+        return self.transform(img), int(self.targets[index])
+
+    def __len__(self):
+        return len(self.data)
+
+def one_pass(loader):
+    start = time.perf_counter()
+    for images, labels in loader:
+        pass
+    return time.perf_counter() - start
+
+def main():
+    dataset = FakeMNIST(60000)
+    print(f"{'nodes':>6}{'examples':>10}{'DataLoader s':>14}{'build s':>9}{'tensor s':>10}")
+    for nodes in [1, 3, 8]:
+        partition = DataPartitioner(dataset, [1.0 / nodes] * nodes).use(0)
+        loader = DataLoader(partition, batch_size=100, shuffle=True)
+        start = time.perf_counter()
+        tensor_loader = TensorBatchLoader(*dataset_tensors(partition), batch_size=100)
+        build = time.perf_counter() - start
+        print(f"{nodes:>6}{len(partition):>10}{one_pass(loader):>14.2f}{build:>9.3f}{one_pass(tensor_loader):>10.3f}")
+
+if __name__ == "__main__":
+    main()
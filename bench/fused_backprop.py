@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# Cost of one local step of minibatch_backprop_and_update_weights: freq
+# forward and backward passes on minibatches of 100 followed by one weight
+# update, versus a single fused pass over the freq minibatches
+# (fuse_minibatches). The step includes encoding the update for sending.
+# Run from the repository root: python -m bench.fused_backprop
+import time
+import torch
+from src.ml_thread import Solver
+from src.pendingwork import PendingWork
+from src.sender import Sender
+
+def make_solver(fuse):
+    pending_work_queues = PendingWork(5)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    solver = Solver(None, None, pending_work_queues, Sender(20), fuse_minibatches=fuse)
+    # Updates are still encoded, but not queued for sending; close
+    # sender_queues when done
+    solver.sender_queues.enqueue = lambda update: None
+    return solver
+
+def run(solver, minibatches, freq, repeat):
+    solver.minibatch_backprop_and_update_weights(minibatches, 0, freq)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        solver.minibatch_backprop_and_update_weights(minibatches, 0, freq)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    torch.manual_seed(0)
+    print(f"{torch.get_num_threads()} torch threads")
+    print(f"{'batch':>6}{'freq':>6}{'loop ms':>10}{'fused ms':>10}")
+    for batch_size, freq in [(100, 5), (100, 10), (20, 5)]:
+        minibatches = [(torch.rand(batch_size, 1, 28, 28), torch.randint(0, 10, (batch_size,))) for _ in range(freq)]
+        repeat = 50
+        solvers = [make_solver(False), make_solver(True)]
+        loop, fused = [run(solver, minibatches, freq, repeat) for solver in solvers]
+        for solver in solvers:
+            solver.sender_queues.close()
+        print(f"{batch_size:>6}{freq:>6}{loop:>10.2f}{fused:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# Cost of turning the metadata of every update into alphas, as
+# aggregate_received_updates does: the old nested-loop flatten_metadata and
+# get_weights, metadata_matrix and the vectorized get_weights_array, and
+# metadata_vectors and get_weights, which pick one of the two by size
+# (SMALL_INPUT_ENTRIES).
+# Run from the repository root: python -m bench.get_weights
+import random
+import time
+from src.update_metadata.device_fairness import DeviceFairnessReceiverState
+from src.get_weights import get_weights, get_weights_array
+
+def loop_flatten_metadata(metadata_list, host_id_list):
+    v = []
+    for metadata in metadata_list:
+        v_i = []
+        for host_id in host_id_list:
+            if host_id in metadata:
+                v_i.append(metadata[host_id])
+            else:
+                v_i.append(0)
+        v.append(v_i)
+    return v
+
+def loop_get_weights(vs):
+    ls = []
+    for v in vs:
+        l = 0.0
+        for e in v:
+            l += e**2
+        l = l**0.5
+        ls.append(l)
+    s = 0.0
+    ret = []
+    for l in ls:
+        x = 1.0 / l
+        s += x
+        ret.append(x)
+    for k in range(len(ls)):
+        ret[k] /= s
+    return ret
+
+def timed(fn, repeat=50):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    rng = random.Random(0)
+    print(f"{'updates':>8}{'hosts':>7}{'loops ms':>10}{'arrays ms':>11}{'picked ms':>11}")
+    for updates, num_hosts in [(2, 2), (10, 10), (15, 15), (20, 20), (30, 30), (100, 100), (300, 300), (1000, 300)]:
+        hosts = ["10.0.%d.%d:5000" % (i // 256, i % 256) for i in range(num_hosts)]
+        state = DeviceFairnessReceiverState(2, {host: 0 for host in hosts})
+        metadata_list = [{host: rng.randint(1, 1000) for host in rng.sample(hosts, (num_hosts + 1) // 2)}
+            for _ in range(updates)]
+        loops = timed(lambda: loop_get_weights(loop_flatten_metadata(metadata_list, hosts)))
+        arrays = timed(lambda: get_weights_array(state.metadata_matrix(metadata_list, hosts)).tolist())
+        picked = timed(lambda: get_weights(state.metadata_vectors(metadata_list, hosts)))
+        print(f"{updates:>8}{num_hosts:>7}{loops:>10.3f}{arrays:>11.3f}{picked:>11.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+# Memory per node when 8 nodes on one machine each load their partition of
+# MNIST: torchvision's datasets.MNIST, which loads the whole dataset into
+# every process, versus MappedMNIST, which memory-maps the raw IDX files so
+# the nodes share them. Every node builds its loaders with
+# build_dataset_loader, makes one pass over its training partition and
+# then reports, while all nodes are still alive:
+#   rss      resident memory, counting shared pages in full
+#   pss      resident memory with shared pages split between the processes
+#   private  memory of the process alone added by loading the data
+# Needs the raw MNIST files in <dataset dir>/MNIST/raw.
+# Run from the repository root: python -m bench.mapped_dataset [dataset dir]
+import sys
+from multiprocessing import get_context
+
+NODES = 8
+
+def memory_kb(path, field):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+def private_kb():
+    return memory_kb('/proc/self/smaps_rollup', 'Private_Clean') + memory_kb('/proc/self/smaps_rollup', 'Private_Dirty')
+
+def node(idx, dataset_dir, mapped, barrier, queue):
+    from src.data_partition import build_dataset_loader
+    hosts = ['localhost:%d' % (6000 + i) for i in range(NODES)]
+    before = private_kb()
+    train_loader, test_loader = build_dataset_loader(hosts[idx], hosts[:idx] + hosts[idx + 1:], 'MNIST', dataset_dir, 100,
+                                                     mapped=mapped)
+    for images, labels in train_loader:
+        pass
+    barrier.wait()
+    queue.put((memory_kb('/proc/self/status', 'VmRSS'), memory_kb('/proc/self/smaps_rollup', 'Pss'), private_kb() - before))
+    barrier.wait()
+
+def main():
+    dataset_dir = sys.argv[1] if len(sys.argv) > 1 else './data'
+    context = get_context('spawn')
+    print(f"{'backend':>12}{'rss MB':>9}{'pss MB':>9}{'private MB':>12}")
+    for mapped in [False, True]:
+        barrier = context.Barrier(NODES)
+        queue = context.Queue()
+        processes = [context.Process(target=node, args=(i, dataset_dir, mapped, barrier, queue)) for i in range(NODES)]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        rss, pss, data = [sum(r[i] for r in results) / len(results) / 1024 for i in range(3)]
+        print(f"{'MappedMNIST' if mapped else 'torchvision':>12}{rss:>9.1f}{pss:>9.1f}{data:>12.1f}")
+
+if __name__ == "__main__":
+    main()
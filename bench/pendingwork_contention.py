@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# Enqueue throughput and worst-case enqueue latency on PendingWork with many
+# concurrent enqueuers (one per peer, like Flask request threads) while the
+# training thread drains every host with empty_model_and_metadata_from.
+# Compares a single lock stripe, which serializes all queue mutations like
+# the old global lock, with per-host striping.
+# Run from the repository root: python -m bench.pendingwork_contention
+import time
+from threading import Thread
+import torch
+from src.pendingwork import PendingWork
+from src.update_metadata.model_update import ModelUpdate
+from src.util import EmptyQueueError
+
+def run(num_stripes, num_enqueuers, per_thread):
+    hosts = ["localhost:6%03d" % i for i in range(num_enqueuers)]
+    pending_work_queues = PendingWork(float('inf'), num_stripes)
+    pending_work_queues.setup("localhost:5000", hosts, "localhost:5000")
+    update = ModelUpdate({str(i): torch.zeros(4) for i in range(6)}, {"localhost:5000": 1})
+    done = []
+    latencies = []
+    def enqueuer(host):
+        worst = 0
+        for i in range(per_thread):
+            start = time.perf_counter()
+            pending_work_queues.enqueue(ModelUpdate(dict(update.updates), update.update_metadata), host)
+            worst = max(worst, time.perf_counter() - start)
+        latencies.append(worst)
+        done.append(host)
+    def drainer():
+        while len(done) < len(hosts) or pending_work_queues.get_total_no_of_updates() > 0:
+            for host in hosts:
+                try:
+                    pending_work_queues.empty_model_and_metadata_from(host)
+                except EmptyQueueError:
+                    pass
+    threads = [Thread(target=enqueuer, args=(host,)) for host in hosts] + [Thread(target=drainer)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return num_enqueuers * per_thread / (time.time() - start), max(latencies) * 1000
+
+def main(per_thread=5000):
+    print(f"{'enqueuers':>10}{'stripes':>9}{'enqueues/s':>12}{'worst ms':>10}")
+    for num_enqueuers in [2, 8, 32]:
+        for num_stripes in [1, 64]:
+            rate, worst = run(num_stripes, num_enqueuers, per_thread)
+            print(f"{num_enqueuers:>10}{num_stripes:>9}{rate:>12.0f}{worst:>10.2f}")
+
+if __name__ == "__main__":
+    main()
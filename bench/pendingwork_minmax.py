@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# Cost of enqueue/dequeue on PendingWork with many peers, with the histogram
+# based min/max tracking versus rescanning every queue after each change.
+# Run from the repository root: python -m bench.pendingwork_minmax
+import random
+import time
+from src.pendingwork import PendingWork
+
+class RescanningPendingWork(PendingWork):
+    # Reference implementation: recompute min and max from scratch.
+    def _update_min_and_max(self, old_len, new_len):
+        lens = [self.queues[host].len for host in self.senders]
+        self.min_queue_len = min(lens) if lens else None
+        self.max_queue_len = max(lens) if lens else None
+
+def run(cls, hosts, ops):
+    pending_work_queues = cls(float('inf'))
+    pending_work_queues.setup(hosts[0], hosts[1:], hosts[0])
+    rng = random.Random(0)
+    picks = [rng.choice(hosts) for _ in range(ops)]
+    start = time.time()
+    for i, host in enumerate(picks):
+        if i % 2 == 0:
+            pending_work_queues.enqueue(i, host)
+        else:
+            pending_work_queues.enqueue(i, host)
+            pending_work_queues.dequeue(host)
+    return (time.time() - start) / (ops + ops // 2) * 1e6
+
+def main(ops=2000):
+    print(f"{'hosts':>8}{'histogram us/op':>18}{'rescan us/op':>16}")
+    for num_hosts in [10, 1000, 10000]:
+        hosts = ["10.0.%d.%d:5000" % (i // 256, i % 256) for i in range(num_hosts)]
+        print(f"{num_hosts:>8}{run(PendingWork, hosts, ops):>18.2f}{run(RescanningPendingWork, hosts, ops):>16.2f}")
+
+if __name__ == "__main__":
+    main()
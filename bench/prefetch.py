@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+# Solver.train's minibatches as list(train_loader) versus prefetched on a
+# background thread (PrefetchedMinibatches): time until the first backprop
+# can start, time for the whole pass including backprop, and peak resident
+# memory of the process. Each run is a separate process so peaks do not
+# mix. A third of MNIST (random images) is loaded through DataLoader.
+# Run from the repository root: python -m bench.prefetch
+import resource
+import time
+import torch
+import torch.nn as nn
+from multiprocessing import get_context
+from torch.utils.data import DataLoader
+from src.neural_net import Net
+from src.prefetch import PrefetchedMinibatches
+from bench.batch_loader import FakeMNIST
+
+def run(prefetch, queue):
+    torch.manual_seed(0)
+    dataset = FakeMNIST(20000)
+    loader = DataLoader(dataset, batch_size=100, shuffle=True)
+    net = Net()
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.005)
+    loss_fn = nn.CrossEntropyLoss()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    minibatches = PrefetchedMinibatches(loader) if prefetch else list(loader)
+    first = None
+    for j in range(len(minibatches)):
+        images, labels = minibatches[j]
+        if first is None:
+            first = time.perf_counter() - start
+        loss_fn(net(images.view(-1, 28*28)), labels).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    total = time.perf_counter() - start
+    if prefetch:
+        minibatches.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((first, total, (peak - before) / 1024))
+
+def main():
+    context = get_context('spawn')
+    print(f"{'mode':>9}{'first ms':>10}{'pass s':>8}{'peak MB':>9}")
+    for prefetch in [False, True]:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(prefetch, queue))
+        process.start()
+        first, total, peak = queue.get()
+        process.join()
+        print(f"{'prefetch' if prefetch else 'list':>9}{first * 1e3:>10.1f}{total:>8.2f}{peak:>9.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# Two-node send rate: a receiver node runs main.py's Flask app in a child
+# process and this process posts MNIST model updates to it, once with a bare
+# requests.post per update and once through Sender's keep-alive session.
+# Werkzeug 2.1 and later close every connection regardless of protocol_version,
+# so the pooled numbers only improve with the Werkzeug pinned in requirements.txt.
+# Run from the repository root: python -m bench.sender_pool
+import subprocess
+import sys
+import time
+import requests
+from src.neural_net import Net
+from src.sender import Sender, SENDER_HEADER
+from src.update_metadata.model_update import ModelUpdate
+
+RECEIVER = "localhost:5990"
+SENDER = "localhost:5991"
+
+RECEIVER_SCRIPT = """
+import main
+main.pending_work_queues.setup({receiver!r}, [{sender!r}], {receiver!r})
+main.pending_work_queues.k = float('inf')
+main.pending_work_queues.queue_capacity = None
+main.app.run(host='localhost', port={port}, request_handler=main.KeepAliveRequestHandler)
+"""
+
+def start_receiver():
+    script = RECEIVER_SCRIPT.format(receiver=RECEIVER, sender=SENDER, port=RECEIVER.split(":")[1])
+    proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get("http://" + RECEIVER + "/")
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("receiver did not start")
+
+def rate(post, payload, n):
+    headers = {SENDER_HEADER: SENDER, 'Content-Type': 'application/octet-stream'}
+    start = time.time()
+    for _ in range(n):
+        post("/send_update", data=payload, headers=headers).raise_for_status()
+    return n / (time.time() - start)
+
+def main(n=200):
+    net = Net()
+    updates = { str(idx): params.clone() for idx, params in enumerate(net.parameters()) }
+    payloads = {
+        'MNIST update': ModelUpdate(updates, {SENDER: 1}).to_bytes(),
+        'empty update': ModelUpdate({}, {SENDER: 1}).to_bytes(),
+    }
+    proc = start_receiver()
+    try:
+        sender = Sender(1000)
+        sender.setup(SENDER, [RECEIVER], [])
+        print(f"{'payload':<14}{'requests.post/s':>18}{'pooled/s':>12}")
+        for name, payload in payloads.items():
+            bare = rate(lambda path, **kw: requests.post("http://" + RECEIVER + path, **kw), payload, n)
+            pooled = rate(lambda path, **kw: sender._post(RECEIVER, path, **kw), payload, n)
+            print(f"{name:<14}{bare:>18.1f}{pooled:>12.1f}")
+        sender.close()
+    finally:
+        proc.kill()
+
+if __name__ == "__main__":
+    main()
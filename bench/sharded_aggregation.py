@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# Scaling of the weighted sum of received updates when it is split into
+# shards on an AggregationPool, over thread counts and no. of updates.
+# The model is Net for CIFAR10 inputs (about 1.6M parameters), and updates
+# are decoded from the wire format like received ones. "1 thread" is the
+# plain weighted_sum, which still uses torch's own intra-op threads.
+# Run from the repository root: python -m bench.sharded_aggregation
+import os
+import time
+import torch
+from src.neural_net import Net
+from src.aggregation import weighted_sum, AggregationPool
+from src.update_metadata.model_update import ModelUpdate
+
+THREADS = [1, 2, 4, 8]
+
+def run(fn, alphas, weight_list, keys, repeat):
+    out = fn(alphas, weight_list, keys)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(alphas, weight_list, keys, out)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    print(f"{os.cpu_count()} cores, {torch.get_num_threads()} torch threads")
+    net = Net(image_dim=3*32*32)
+    own = {str(idx): params.data for idx, params in enumerate(net.parameters())}
+    keys = list(own.keys())
+    pools = {n: AggregationPool(n) for n in THREADS[1:]}
+    print(f"{'updates':>8}" + ''.join(f"{str(n) + ' thr ms':>11}" for n in THREADS))
+    for updates in [2, 8, 32]:
+        weight_list = [ModelUpdate.from_bytes(ModelUpdate(
+            {k: torch.randn_like(v) for k, v in own.items()}, {}).to_bytes()).updates for _ in range(updates)]
+        alphas = [1.0 / updates] * updates
+        repeat = max(3, 100 // updates)
+        times = [run(weighted_sum, alphas, weight_list, keys, repeat)]
+        times += [run(pools[n].weighted_sum, alphas, weight_list, keys, repeat) for n in THREADS[1:]]
+        print(f"{updates:>8}" + ''.join(f"{t:>11.2f}" for t in times))
+    for pool in pools.values():
+        pool.close()
+
+if __name__ == "__main__":
+    main()
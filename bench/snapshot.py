@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+# Cost of taking a snapshot of the Net and encoding it for sending, as
+# minibatch_backprop_and_update_weights does after every step: cloning every
+# parameter and encoding them one by one, versus encoding straight from the
+# Net's flat parameter buffer.
+# Run from the repository root: python -m bench.snapshot
+import time
+import torch
+from src.neural_net import Net
+from src.update_metadata.model_update import ModelUpdate
+
+def cloned(net, metadata):
+    updates = { str(idx): params.clone() for idx, params in enumerate(net.parameters()) }
+    return ModelUpdate(updates, metadata).to_bytes()
+
+def flat(net, metadata):
+    updates = { str(idx): params.data for idx, params in enumerate(net.parameters()) }
+    return ModelUpdate(updates, metadata).to_bytes()
+
+def run(fn, net, metadata, repeat=200):
+    fn(net, metadata)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(net, metadata)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    net = Net()
+    metadata = {"localhost:50%02d" % i: i for i in range(8)}
+    print(f"{'snapshot':>10}{'ms':>8}")
+    for fn in [cloned, flat]:
+        print(f"{fn.__name__:>10}{run(fn, net, metadata):>8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+# Compare the json and binary encodings of a ModelUpdate for the MNIST Net.
+# Run from the repository root: python -m bench.wire_format
+import json
+import timeit
+from src.neural_net import Net
+from src.update_metadata.model_update import ModelUpdate
+
+def main(repeat=20):
+    net = Net(image_dim=28*28)
+    updates = { str(idx): params.clone() for idx, params in enumerate(net.parameters()) }
+    metadata = {'localhost:5000': 120, 'localhost:5001': 95}
+    update = ModelUpdate(updates, metadata)
+
+    def json_encode():
+        return update.to_json()
+
+    def json_decode(payload):
+        return ModelUpdate.from_dict(ModelUpdate(**json.loads(payload)))
+
+    def bytes_encode():
+        return update.to_bytes()
+
+    def bytes_decode(payload):
+        return ModelUpdate.from_bytes(payload)
+
+    json_payload = json_encode()
+    bytes_payload = bytes_encode()
+    rows = [
+        ('json', len(json_payload.encode('utf-8')),
+            timeit.timeit(json_encode, number=repeat) / repeat,
+            timeit.timeit(lambda: json_decode(json_payload), number=repeat) / repeat),
+        ('binary', len(bytes_payload),
+            timeit.timeit(bytes_encode, number=repeat) / repeat,
+            timeit.timeit(lambda: bytes_decode(bytes_payload), number=repeat) / repeat),
+    ]
+    print(f"{'format':<8}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    for name, size, encode, decode in rows:
+        print(f"{name:<8}{size:>12}{encode * 1000:>12.3f}{decode * 1000:>12.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 from flask import Flask, request
 from src.pendingwork import PendingWork     
+from src.decoder import DecodePool
 from src.update_metadata.model_update import ModelUpdate
 from src.ml_thread import initialize_current_node          
+from src.sender import SENDER_HEADER, CREDITS_HEADER
+from src.util import DevicePushbackError, MalformedUpdateError
 import threading
 import json
 import sys
@@ -12,6 +15,14 @@ app = Flask(__name__)
 import logging
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
+from werkzeug.serving import WSGIRequestHandler
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # Answers with HTTP/1.1 so Sender's pooled connections are kept alive between updates.
+    # Nagle has to go too, or every reply on a kept-alive connection waits for a delayed ACK.
+    # Passed to app.run only, so other Werkzeug servers in the process are left alone.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
 
 class MlThread(object):
     # params: node [Solver] instance of Solver object
@@ -26,12 +37,15 @@ class MlThread(object):
         # self.node.evaluate()
         while self.close == False:
             # print("in loop", self.close)
-            self.node.send_after_death()
-        self.node.evaluate()
-        self.node.evaluate_matrix()
+            if not self.node.send_after_death():
+                # Every peer still has our final model queued
+                time.sleep(0.1)
+        self.node.evaluate_all()
         return
 
-pending_work_queues = PendingWork(100)
+pending_work_queues = PendingWork(100, queue_capacity=100)
+# Decodes received updates off the request threads, see receive_update
+decode_pool = DecodePool()
 node = None
 ml_thread = None
 
@@ -46,13 +60,45 @@ def close():
     print("changed to True")
     return "Close is running"
 
+def credit_headers(sender):
+    # Tell the sender how many more updates it may send us, so it stops
+    # before being pushed back (see Sender._read_credits)
+    credits = pending_work_queues.credits(sender)
+    return {} if credits is None else {CREDITS_HEADER: str(credits)}
+
+@app.errorhandler(DevicePushbackError)
+def push_back(e):
+    # The sender's queue is full: it keeps its updates until it has credits
+    # again. A batch may be pushed back while a few slots are still free, so
+    # tell the sender how many.
+    headers = credit_headers(request.headers[SENDER_HEADER]) if SENDER_HEADER in request.headers else {}
+    return "Pushed back", 429, headers or {CREDITS_HEADER: "0"}
+
+@app.errorhandler(MalformedUpdateError)
+def bad_update(e):
+    # A payload that is not a well-formed update is refused before it is queued
+    return "Malformed update: " + str(e), 400
+
+@app.route("/credits", methods=['GET'])
+def get_credits():
+    return "Credits", 200, credit_headers(request.headers[SENDER_HEADER])
+
 @app.route("/send_update", methods=['GET', 'POST'])
 def receive_update():
-    content = request.json
-    sender = content['sender']
-    update = content['update']
-    pending_work_queues.enqueue(ModelUpdate(**json.loads(update)), sender)
-    return "Send update is running"
+    # The body is a ModelUpdate in the binary wire format. It is queued right
+    # away, in order, while decode_pool decodes it without a copy.
+    sender = request.headers[SENDER_HEADER]
+    update = decode_pool.submit(request.get_data(cache=False))
+    pending_work_queues.enqueue(update, sender)
+    return "Send update is running", 200, credit_headers(sender)
+
+@app.route("/send_updates", methods=['POST'])
+def receive_updates():
+    # The body is a batch of ModelUpdates packed by ModelUpdate.pack_batch
+    sender = request.headers[SENDER_HEADER]
+    payloads = ModelUpdate.unpack_batch(request.get_data(cache=False))
+    pending_work_queues.enqueue_batch([decode_pool.submit(p) for p in payloads], sender)
+    return "Send updates is running", 200, credit_headers(sender)
 
 @app.route("/clear_all_queues", methods=['GET', 'POST'])
 def clear_all_queues():
@@ -97,7 +143,8 @@ if __name__ == "__main__":
     
     # Set up global queues with the hosts and leader
     pending_work_queues.setup(my_host, other_hosts, leader, other_leaders)
-    threading.Thread(target=app.run, kwargs=dict(host="localhost", port=port)).start()
+    threading.Thread(target=app.run, kwargs=dict(host="localhost", port=port,
+        request_handler=KeepAliveRequestHandler)).start()
     
     for i in range(10):
         # For purpose of automating evaluations, we changed ML thread to not actually be a thread
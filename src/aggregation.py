@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+def flat_view(tensors):
+    # :brief Get one 1-d tensor covering some tensors, without copying, if
+    # they lie back to back in the same storage (e.g. the tensors of an
+    # update decoded by ModelUpdate.from_bytes).
+    # :param tensors [array<torch.tensor>] the tensors, in storage order
+    # :return [torch.tensor] the flat view, or None if they are laid out any other way
+    first = tensors[0]
+    end = first.storage_offset()
+    for t in tensors:
+        if (not t.is_contiguous() or t.dtype != first.dtype
+                or t.untyped_storage().data_ptr() != first.untyped_storage().data_ptr()
+                or t.storage_offset() != end):
+            return None
+        end += t.numel()
+    return first.as_strided((end - first.storage_offset(),), (1,), first.storage_offset())
+
+def flatten(tensors):
+    # :brief Get some tensors as one 1-d tensor, copying only if they are not
+    # already back to back in memory.
+    # :param tensors [array<torch.tensor>] the tensors, in order
+    # :return [torch.tensor] the flat tensor
+    flat = flat_view(tensors)
+    if flat is None:
+        flat = torch.cat([t.reshape(-1) for t in tensors])
+    return flat
+
+def weighted_sum(alphas, weight_list, keys, out=None):
+    # :brief Sum some updates' parameters, each scaled by its alpha, as one
+    # flat tensor.
+    # Updates are read as flat tensors and accumulated in place into one
+    # buffer, so there is a single pass over each update and no temporary
+    # per update or per layer.
+    # :param alphas [array<float>] weight of every update
+    # :param weight_list [array<dict<str, torch.tensor>>] parameters of every update
+    # :param keys [array<str>] the parameters to sum, in the order to lay them out
+    # :param out [torch.tensor] optional buffer to reuse for the sum; ignored
+    #   if it does not fit
+    # :return [torch.tensor] the weighted sum of the flat parameters
+    with torch.no_grad():
+        first = True
+        for alpha, weight in zip(alphas, weight_list):
+            flat = flatten([weight[k] for k in keys])
+            if first:
+                if out is None or out.shape != flat.shape or out.dtype != flat.dtype or out.device != flat.device:
+                    out = torch.empty_like(flat)
+                torch.mul(flat, alpha, out=out)
+                first = False
+            else:
+                out.add_(flat, alpha=alpha)
+        return None if first else out
+
+def _weighted_sum_shard(alphas, flats, out, start, end):
+    # :brief Compute one slice of weighted_sum's result, for AggregationPool.
+    with torch.no_grad():
+        shard = out[start:end]
+        torch.mul(flats[0][start:end], alphas[0], out=shard)
+        for alpha, flat in zip(alphas[1:], flats[1:]):
+            shard.add_(flat[start:end], alpha=alpha)
+
+class AggregationPool(object):
+    # AggregationPool computes weighted_sum on a few threads. The flat
+    # parameter space is split into one contiguous shard per thread, and
+    # every thread sums all updates over its own shard, so no two threads
+    # write the same memory and each shard's slice of the result stays in
+    # cache while the updates stream through. Torch releases the GIL inside
+    # the additions, so the shards really run in parallel on many-core
+    # nodes. Shards are never smaller than min_shard_numel elements, which
+    # keeps small models on the calling thread.
+    # This class is thread safe.
+
+    def __init__(self, num_threads=2, min_shard_numel=1 << 16):
+        # :brief Create a new AggregationPool instance.
+        # :param num_threads [int] no. of threads, and so max no. of shards
+        # :param min_shard_numel [int] min no. of elements per shard
+        self.num_threads = num_threads
+        self.min_shard_numel = min_shard_numel
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='aggregate')
+
+    def weighted_sum(self, alphas, weight_list, keys, out=None):
+        # :brief Same as weighted_sum, split across the pool's threads.
+        # :param alphas [array<float>] weight of every update
+        # :param weight_list [array<dict<str, torch.tensor>>] parameters of every update
+        # :param keys [array<str>] the parameters to sum, in the order to lay them out
+        # :param out [torch.tensor] optional buffer to reuse for the sum; ignored
+        #   if it does not fit
+        # :return [torch.tensor] the weighted sum of the flat parameters
+        # :warning raises a ValueError if the updates are not all the same size
+        flats = [flatten([weight[k] for k in keys]) for weight in weight_list[:len(alphas)]]
+        if len(flats) == 0:
+            return None
+        first = flats[0]
+        for flat in flats:
+            if flat.shape != first.shape:
+                raise ValueError("cannot sum updates of %d and %d parameters" % (first.numel(), flat.numel()))
+        if out is None or out.shape != first.shape or out.dtype != first.dtype or out.device != first.device:
+            out = torch.empty_like(first)
+        numel = first.numel()
+        num_shards = max(1, min(self.num_threads, numel // self.min_shard_numel))
+        bounds = [numel * i // num_shards for i in range(num_shards + 1)]
+        if num_shards == 1:
+            _weighted_sum_shard(alphas, flats, out, 0, numel)
+            return out
+        futures = [self.executor.submit(_weighted_sum_shard, alphas, flats, out, bounds[i], bounds[i + 1])
+                   for i in range(num_shards)]
+        for future in futures:
+            future.result()
+        return out
+
+    def close(self):
+        # :brief Stop the pool's threads.
+        self.executor.shutdown()
+
+def unflatten_into(flat, parameters):
+    # :brief Point every parameter's data at its slice of a flat tensor.
+    # :param flat [torch.tensor] the flat parameters, as laid out by weighted_sum
+    # :param parameters [array<nn.Parameter>] the parameters, in the same order
+    start = 0
+    for params in parameters:
+        numel = params.numel()
+        params.data = flat[start:start + numel].view_as(params)
+        start += numel
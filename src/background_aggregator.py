@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+from threading import Condition, Thread
+
+class BackgroundAggregator(object):
+    # BackgroundAggregator aggregates a Solver's received updates on its own
+    # thread while the training thread keeps doing backprop.
+    # It sums the updates into a shadow buffer with Solver.aggregate_others,
+    # then waits for the training thread to call swap_in between minibatch
+    # groups, which installs the shadow buffer as the model's parameters.
+    # The buffer that swap_in replaces becomes the next shadow buffer, so the
+    # parameters are double buffered and nothing is allocated per aggregation.
+    # At most one aggregate waits to be swapped in; received updates keep
+    # queueing in PendingWork meanwhile. If aggregating raises, the thread
+    # exits and the exception is raised on the training thread by the next
+    # swap_in or stop.
+
+    def __init__(self, solver, poll_interval=0.1):
+        # :brief Create a new BackgroundAggregator instance.
+        # :param solver [Solver] the solver whose updates to aggregate
+        # :param poll_interval [float] max seconds between checks for stop()
+        self.solver = solver
+        self.poll_interval = poll_interval
+        self.condition = Condition()
+        # Aggregate waiting for swap_in, or None
+        self.ready = None
+        # Parameter buffer retired by the last swap_in, reused for the next sum
+        self.spare = None
+        self.stopped = False
+        self.thread = None
+        # Exception that ended the aggregator thread, until it is raised
+        self.error = None
+
+    def start(self):
+        # :brief Spawn the aggregator thread.
+        self.stopped = False
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # :brief Stop the aggregator thread and wait for it to exit.
+        # An aggregate that was not swapped in yet is dropped.
+        # :warning raises the exception that ended the aggregator thread, if
+        #   swap_in has not raised it already
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.ready = None
+        self._raise_error()
+
+    def _run(self):
+        # :brief Run the aggregation loop, keeping any exception that ends it for the training thread.
+        try:
+            self._aggregate_until_stopped()
+        except BaseException as e:
+            with self.condition:
+                self.error = e
+
+    def _aggregate_until_stopped(self):
+        # :brief Aggregate whenever updates are queued and the last aggregate was swapped in.
+        pending_work_queues = self.solver.pending_work_queues
+        while True:
+            with self.condition:
+                while self.ready is not None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            if not pending_work_queues.wait_for_updates(1, pending_work_queues.other_hosts, self.poll_interval):
+                continue
+            with self.condition:
+                spare, self.spare = self.spare, None
+            aggregate = self.solver.aggregate_others(spare)
+            with self.condition:
+                self.ready = aggregate
+
+    def swap_in(self):
+        # :brief Install the latest aggregate as the model's parameters, if there is one.
+        # Only call this from the training thread.
+        # :return [bool] True if an aggregate was swapped in
+        # :warning raises the exception that ended the aggregator thread, if any
+        self._raise_error()
+        with self.condition:
+            aggregate, self.ready = self.ready, None
+        if aggregate is None:
+            return False
+        replaced = self.solver.swap_in_aggregate(aggregate)
+        with self.condition:
+            self.spare = replaced
+            self.condition.notify_all()
+        return True
+
+    def _raise_error(self):
+        # :brief Raise the exception that ended the aggregator thread, once.
+        with self.condition:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
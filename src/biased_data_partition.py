@@ -1,9 +1,30 @@
 import numpy as np
+import torch
 import warnings
 from torchvision import datasets
 from torch.utils.data.dataset import Dataset
 from PIL import Image
 
+def label_indexes(targets, label_to_num_examples):
+    # :brief Pick the first examples of some labels, subject to
+    # CustomizedTrainMNIST.MAX_NUM_EXAMPLES_PER_CLASS.
+    # :param targets [torch.tensor] label of every example
+    # :param label_to_num_examples [dict<int, int>] Maps data label to number of examples desired
+    # :return [torch.tensor] indexes of the chosen examples, label by label in
+    #   the dict's order, and in dataset order within each label
+    targets = torch.as_tensor(targets)
+    # Indexes grouped by label, in dataset order within each label
+    by_label = torch.sort(targets, stable=True).indices
+    label_counts = torch.bincount(targets)
+    label_starts = torch.cumsum(label_counts, 0) - label_counts
+    index_set = []
+    for label, num_examples in label_to_num_examples.items():
+        num_examples = min(num_examples, CustomizedTrainMNIST.MAX_NUM_EXAMPLES_PER_CLASS)
+        if label < len(label_counts):
+            start = label_starts[label].item()
+            index_set.append(by_label[start:start + min(num_examples, label_counts[label].item())])
+    return torch.cat(index_set) if index_set else torch.zeros(0, dtype=torch.long)
+
 class CustomizedTrainMNIST(Dataset):
     # This was derived from counting the MNIST dataset.
     # Limiting factor is that there are only 5421 examples of digit 5
@@ -28,23 +49,13 @@ class CustomizedTrainMNIST(Dataset):
 
     # :param label_to_num_examples [dict<int, int>] Maps data label to number of examples desired
     # :brief Creates a dataset with num_examples of each label, subject to MAX_NUM_EXAMPLES_PER_CLASS
+    # Examples are picked by label straight from the targets tensor, and kept in
+    # one stacked uint8 tensor, so no image is decoded here.
+    # :return [tuple] (images [torch.tensor], labels [torch.tensor]) of the chosen examples
     def _trim_train_data(self, label_to_num_examples):
-        label_indexes = {}
-        for i in range(self._mnist_dataset.__len__()):
-            example = self._mnist_dataset.__getitem__(i)
-            label = example[1]
-            if label in label_to_num_examples:
-                if label not in label_indexes:
-                    label_indexes[label] = [i]
-                else:
-                    label_indexes[label].append(i)
-        index_set = []
-        for label, num_examples in label_to_num_examples.items():
-            num_examples = min(num_examples, CustomizedTrainMNIST.MAX_NUM_EXAMPLES_PER_CLASS)
-            index_set.extend(label_indexes[label][:num_examples])
-        new_dataset = [self._mnist_dataset.data[i] for i in index_set]
-        new_targets = [self._mnist_dataset.targets[i] for i in index_set]
-        return new_dataset, new_targets
+        targets = torch.as_tensor(self._mnist_dataset.targets)
+        index_set = label_indexes(targets, label_to_num_examples)
+        return self._mnist_dataset.data[index_set], targets[index_set]
 
     def __getitem__(self, index):
         img = self.data[index]
@@ -1,8 +1,10 @@
 import random
+import numpy as np
 import torch
 import torch.utils.data as data
 from torchvision import datasets, transforms
-from src.biased_data_partition import CustomizedTrainMNIST
+from src.biased_data_partition import CustomizedTrainMNIST, label_indexes
+from src.idx_dataset import MappedMNIST
 
 # Helper functions
 """ Dataset partitioning helper from https://seba-1511.github.io/tutorials/intermediate/dist_tuto.html"""
@@ -35,6 +37,68 @@ class DataPartitioner(object):
     def use(self, partition):
         return Partition(self.data, self.partitions[partition])
 
+def dataset_tensors(dataset):
+    # :brief Get the raw examples of a dataset as tensors, without its transform.
+    # :param dataset [Dataset] an MNIST or CIFAR10 dataset, a CustomizedTrainMNIST,
+    #   or a Partition of one of them
+    # :return [tuple] (uint8 images laid out N x C x H x W [torch.tensor], labels [torch.tensor])
+    if isinstance(dataset, Partition):
+        index = torch.as_tensor(dataset.index, dtype=torch.long)
+        images, labels = dataset.data.data, torch.as_tensor(dataset.data.targets, dtype=torch.long)[index]
+        # Only the partition is copied out of a memory map (see MappedMNIST)
+        images = images[index.numpy()] if isinstance(images, np.ndarray) else images[index]
+    else:
+        images, labels = dataset.data, torch.as_tensor(dataset.targets, dtype=torch.long)
+    if isinstance(images, np.memmap):
+        images = np.array(images)
+    images = torch.as_tensor(images)
+    if images.dim() == 3:
+        # Grayscale, N x H x W
+        images = images.unsqueeze(1)
+    else:
+        # N x H x W x C, like CIFAR10
+        images = images.permute(0, 3, 1, 2)
+    return images, labels
+
+class TensorBatchLoader(object):
+    # TensorBatchLoader yields minibatches like a DataLoader over a dataset
+    # whose transform is ToTensor, optionally followed by Normalize, but
+    # converts every example only once, up front, into one float tensor.
+    # Minibatches are then slices of it through a shuffled index, with no
+    # Python call per example. Meant for datasets that fit in memory.
+
+    def __init__(self, images, labels, batch_size=100, shuffle=True, mean=None, std=None):
+        # :brief Create a new TensorBatchLoader instance.
+        # :param images [torch.tensor] uint8 images laid out N x C x H x W
+        # :param labels [torch.tensor] label of every image
+        # :param batch_size [int] no. of examples per minibatch; the last one may be smaller
+        # :param shuffle [bool] draw examples in a new random order on every pass
+        # :param mean [tuple<float>] optional mean per channel to normalize by, like Normalize
+        # :param std [tuple<float>] standard deviation per channel, if mean is given
+        self.images = images.to(torch.float32).div_(255).contiguous()
+        if mean is not None:
+            channels = (1, -1, 1, 1)
+            self.images.sub_(torch.tensor(mean).view(channels)).div_(torch.tensor(std).view(channels))
+        self.labels = labels.to(torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        # :brief Iterate over one pass of minibatches.
+        # :return [iterator<tuple>] (images, labels) of every minibatch
+        num_examples = len(self.labels)
+        order = torch.randperm(num_examples) if self.shuffle else None
+        for start in range(0, num_examples, self.batch_size):
+            if order is None:
+                yield self.images[start:start + self.batch_size], self.labels[start:start + self.batch_size]
+            else:
+                index = order[start:start + self.batch_size]
+                yield self.images[index], self.labels[index]
+
+    def __len__(self):
+        # :brief Get the no. of minibatches in a pass.
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
 """ Partitioning MNIST adapted from https://seba-1511.github.io/tutorials/intermediate/dist_tuto.html"""
 def partition_dataset(dataset, curr_node: int, no_of_nodes: int):
     partition_sizes = [1.0 / no_of_nodes for _ in range(no_of_nodes)]
@@ -44,7 +108,11 @@ def partition_dataset(dataset, curr_node: int, no_of_nodes: int):
         batch_size=100,
         shuffle=True)
 
-def build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset='MNIST', dataset_dir='./data', batch_size=100, biased=False):
+def build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset='MNIST', dataset_dir='./data', batch_size=100, biased=False, tensor_loader=False, mapped=False):
+    # :param tensor_loader [bool] load the data into memory once and batch it
+    #   with TensorBatchLoader instead of DataLoader
+    # :param mapped [bool] read MNIST from memory maps of the raw files in
+    #   dataset_dir (see MappedMNIST), shared with other nodes on the machine
     dataset_ = {
         'MNIST': datasets.MNIST,
         'CIFAR10': datasets.CIFAR10
@@ -56,6 +124,24 @@ def build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset='MNIST
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
         ])
     }[dataset]
+    # The same normalization for TensorBatchLoader, as (mean, std)
+    normalization = {
+        'MNIST': (None, None),
+        'CIFAR10': ((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    }[dataset]
+
+    if mapped and dataset != 'MNIST':
+        raise ValueError("only MNIST can be read from memory maps")
+
+    def load(train):
+        if mapped:
+            return MappedMNIST(dataset_dir, train=train, transform=transform)
+        return dataset_(root=dataset_dir, train=train, transform=transform, download=True)
+
+    def make_loader(dataset, shuffle):
+        if tensor_loader:
+            return TensorBatchLoader(*dataset_tensors(dataset), batch_size, shuffle, *normalization)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
 
     sorted_node_ip_addrs = sorted([curr_node_ip_addr] + other_nodes_ip_addrs)
     no_of_nodes = len(sorted_node_ip_addrs)
@@ -75,24 +161,25 @@ def build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset='MNIST
             9: 5400,
         }
         list_of_dicts = partition_dict(no_of_nodes)
-        case_1_a = CustomizedTrainMNIST('../data', label_to_num_examples=list_of_dicts[self_idx], train=True, download=True,
-        transform=transforms.ToTensor())
-        train_loader = torch.utils.data.DataLoader(case_1_a, batch_size=batch_size, shuffle=True)
+        if mapped:
+            # The same examples, as indexes into the shared map
+            train_dataset = load(True)
+            case_1_a = Partition(train_dataset, label_indexes(train_dataset.targets, list_of_dicts[self_idx]).tolist())
+        else:
+            case_1_a = CustomizedTrainMNIST('../data', label_to_num_examples=list_of_dicts[self_idx], train=True, download=True,
+            transform=transforms.ToTensor())
+        train_loader = make_loader(case_1_a, True)
     else:
         sorted_node_ip_addrs = sorted([curr_node_ip_addr] + other_nodes_ip_addrs)
         no_of_nodes = len(sorted_node_ip_addrs)
-        train_dataset = dataset_(root=dataset_dir, train=True, transform=transform, download=True)
+        train_dataset = load(True)
         # Equal partition of the data
         partition_sizes = [1.0 / no_of_nodes] * no_of_nodes
         partition = DataPartitioner(train_dataset, partition_sizes)
-        train_loader = torch.utils.data.DataLoader(
-            partition.use(self_idx),
-            batch_size=batch_size,
-            shuffle=True
-        )
-
-    test_dataset = dataset_(root=dataset_dir, train=False, transform=transform, download=True)
-    test_loader = data.DataLoader(dataset=test_dataset, batch_size=batch_size, shuffle=False)
+        train_loader = make_loader(partition.use(self_idx), True)
+
+    test_dataset = load(False)
+    test_loader = make_loader(test_dataset, False)
     return train_loader, test_loader
 
 def partition_dict(no_of_nodes):
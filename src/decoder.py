@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from src.update_metadata.model_update import ModelUpdate
+
+class PendingDecode(object):
+    # PendingDecode stands in for a received ModelUpdate that a DecodePool
+    # is still decoding. It can be queued like the update itself; whoever
+    # dequeues it calls result(), which by then has usually long finished.
+
+    def __init__(self, future, nbytes):
+        # :brief Create a new PendingDecode instance.
+        # :param future [Future] the pool's decode of the payload
+        # :param nbytes [int] size of the payload, so queues can count its bytes
+        self.future = future
+        self.nbytes = nbytes
+
+    def done(self):
+        # :brief Check if the update has been decoded.
+        return self.future.done()
+
+    def result(self):
+        # :brief Get the decoded update, waiting for it if need be.
+        # :return [ModelUpdate] the decoded update
+        # :warning raises a MalformedUpdateError if the payload was not in the wire format
+        return self.future.result()
+
+class DecodePool(object):
+    # DecodePool decodes received model updates on a few worker threads, so
+    # neither the thread that received them nor the one that aggregates them
+    # spends time on it. Decoded tensors are views into the received payload,
+    # which holds every parameter in one contiguous buffer (see
+    # ModelUpdate.from_bytes). At most max_pending payloads are waiting or
+    # being decoded at once; submit blocks the receiving thread beyond that.
+    # This class is thread safe.
+
+    def __init__(self, num_workers=2, max_pending=64):
+        # :brief Create a new DecodePool instance.
+        # :param num_workers [int] no. of decoding threads
+        # :param max_pending [int] max no. of payloads submitted but not yet decoded
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='decode')
+        self.slots = BoundedSemaphore(max_pending)
+
+    def submit(self, payload):
+        # :brief Start decoding an encoded update.
+        # :param payload [bytes-like] an update encoded by ModelUpdate.to_bytes
+        # :return [PendingDecode] the update being decoded
+        # :warning raises a MalformedUpdateError right away if payload is not a well-formed
+        #   update (see ModelUpdate.check_bytes), so it is never queued
+        ModelUpdate.check_bytes(payload)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._decode, payload)
+        except BaseException:
+            self.slots.release()
+            raise
+        return PendingDecode(future, len(payload))
+
+    def _decode(self, payload):
+        # :brief Decode a payload on a worker thread and free its slot.
+        try:
+            return ModelUpdate.from_bytes(payload)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        # :brief Finish the decodes in progress and stop the worker threads.
+        self.executor.shutdown()
+
+def decoded(item):
+    # :brief Get the update a queued item stands for once it is decoded.
+    # :param item [Object] an item dequeued from an UpdateQueue
+    # :return [Object] the item itself, or the update it stands in for
+    if isinstance(item, PendingDecode):
+        return item.result()
+    return item
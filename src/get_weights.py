@@ -1,20 +1,53 @@
+import numpy as np
+
+# Below this many entries (updates x hosts), numpy's fixed cost per call is
+# more than it saves, so plain loops are used (see bench/get_weights.py)
+SMALL_INPUT_ENTRIES = 400
+
+def inverse_norm(v):
+    # :brief Get the unnormalized weight of one update vector, 1 / its L2 norm.
+    # :param v [array<float>] an update vector
+    # :return [float] the weight, 0 for a vector of zeros
+    # One vector has as many entries as there are hosts, too few for numpy to pay off
+    l = sum(float(e)**2 for e in v)**0.5
+    return 1.0 / l if l > 0 else 0.0
+
+def get_weights_array(m):
+    # :brief Get the weights for a matrix of update vectors in one vectorized call.
+    # Every row is weighted by 1 / its L2 norm, normalized so the weights sum
+    # to 1. Rows of zeros get no weight; if every row is zeros, all rows are
+    # weighted equally.
+    # :param m [np.ndarray] (updates x hosts) matrix, one update vector per row
+    # :return [np.ndarray] the weight of every row
+    m = np.asarray(m, dtype=np.float64)
+    if m.shape[0] == 0:
+        return np.zeros(0)
+    norms = np.linalg.norm(m.reshape(m.shape[0], -1), axis=1)
+    inverse = np.zeros_like(norms)
+    np.divide(1.0, norms, out=inverse, where=norms > 0)
+    total = inverse.sum()
+    if total == 0:
+        return np.full(len(norms), 1.0 / len(norms))
+    return inverse / total
+
 def get_weights(vs):
     # :brief Get the weights for some set of update vectorsself.
-    # :param vs [array<array<float>>] some update vectors
+    # Same weights as get_weights_array; small lists of vectors skip numpy.
+    # :param vs [array<array<float>>] some update vectors, or a matrix of them
     # :return a [array<float>] a list of weights in the same order
-    ls = []
+    if not isinstance(vs, np.ndarray) and sum(len(v) for v in vs) < SMALL_INPUT_ENTRIES:
+        return _get_weights_loop(vs)
+    return get_weights_array(vs).tolist()
+
+def _get_weights_loop(vs):
+    # :brief get_weights for a few update vectors, in plain Python.
+    inverse = []
     for v in vs:
         l = 0.0
         for e in v:
             l += e**2
-        l = l**0.5
-        ls.append(l)
-    s = 0.0
-    ret = []
-    for l in ls:
-        x = 1.0 / l
-        s += x
-        ret.append(x)
-    for k in range(len(ls)):
-        ret[k] /= s
-    return ret
+        inverse.append(1.0 / l**0.5 if l > 0 else 0.0)
+    s = sum(inverse)
+    if s == 0:
+        return [1.0 / len(inverse)] * len(inverse) if len(inverse) > 0 else []
+    return [x / s for x in inverse]
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+import os
+import struct
+import numpy as np
+import torch
+from torch.utils.data.dataset import Dataset
+from PIL import Image
+
+# numpy dtype of every IDX element type code; multi-byte types are big endian
+IDX_DTYPES = {
+    0x08: np.dtype('u1'),
+    0x09: np.dtype('i1'),
+    0x0B: np.dtype('>i2'),
+    0x0C: np.dtype('>i4'),
+    0x0D: np.dtype('>f4'),
+    0x0E: np.dtype('>f8'),
+}
+
+def read_idx(path):
+    # :brief Memory-map an IDX file (the format of MNIST's raw *-ubyte files)
+    # read-only, without reading its data.
+    # Every process that maps the same file shares one copy of it in the
+    # page cache, and only the pages actually read are ever loaded.
+    # :param path [str] path of the uncompressed IDX file
+    # :return [np.memmap] the file's data, shaped as its header says
+    # :warning raises a ValueError if the file is not in the IDX format
+    with open(path, 'rb') as f:
+        header = f.read(4)
+        if len(header) != 4 or header[0] != 0 or header[1] != 0 or header[2] not in IDX_DTYPES:
+            raise ValueError("%s is not an IDX file" % path)
+        num_dims = header[3]
+        shape = struct.unpack('>%dI' % num_dims, f.read(4 * num_dims))
+    dtype = IDX_DTYPES[header[2]]
+    offset = 4 + 4 * num_dims
+    if os.path.getsize(path) != offset + int(np.prod(shape)) * dtype.itemsize:
+        raise ValueError("%s does not match its IDX header" % path)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+class MappedMNIST(Dataset):
+    # MappedMNIST reads MNIST like torchvision's datasets.MNIST, but from
+    # read-only memory maps of the raw IDX files rather than from tensors
+    # loaded into each process. Nodes on the same machine then share the
+    # dataset's pages, and a Partition of it is only a list of indexes into
+    # the shared map. Labels are small and are loaded as a tensor.
+    # The files are never downloaded.
+
+    def __init__(self, root, train=True, transform=None, target_transform=None):
+        # :brief Create a new MappedMNIST instance.
+        # :param root [str] directory that holds MNIST/raw, like datasets.MNIST's root
+        # :param train [bool] the train set if True, else the test set
+        # :param transform [callable] optional transform of every PIL image
+        # :param target_transform [callable] optional transform of every label
+        # :warning raises a FileNotFoundError if the raw files are missing
+        prefix = 'train' if train else 't10k'
+        raw_dir = os.path.join(root, 'MNIST', 'raw')
+        self.data = read_idx(os.path.join(raw_dir, prefix + '-images-idx3-ubyte'))
+        self.targets = torch.from_numpy(np.array(read_idx(os.path.join(raw_dir, prefix + '-labels-idx1-ubyte')), dtype=np.int64))
+        self.transform = transform
+        self.target_transform = target_transform
+
+    def __getitem__(self, index):
+        img = Image.fromarray(np.asarray(self.data[index]), mode='L')
+        target = int(self.targets[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return (img, target)
+
+    def __len__(self):
+        return len(self.data)
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from threading import Condition
+from threading import Condition, Lock
 import time
 from collections import deque
 
@@ -16,17 +16,29 @@ from src.data_partition import build_dataset_loader
 from src.neural_net import Net
 from src.sender import Sender
 from src.util import EmptyQueueError, ExtraFatal
+from src.aggregation import weighted_sum, flatten
+from src.background_aggregator import BackgroundAggregator
+from src.prefetch import PrefetchedMinibatches
 
 # Create a function that creates nodes that hold partitioned training data
-def initialize_current_node(pending_work_queues, dataset='MNIST', dataset_dir='./data', biased = False):
+def initialize_current_node(pending_work_queues, dataset='MNIST', dataset_dir='./data', biased = False, background_aggregation = False, aggregation_pool = None, fuse_minibatches = False, tensor_loader = False, mapped = False):
     curr_node_ip_addr = pending_work_queues.my_host
     other_nodes_ip_addrs = pending_work_queues.other_hosts
-    train_loader, test_loader = build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset, dataset_dir, 100, biased)
+    train_loader, test_loader = build_dataset_loader(curr_node_ip_addr, other_nodes_ip_addrs, dataset, dataset_dir, 100, biased, tensor_loader, mapped)
     sender_queues = Sender(1000)
-    return Solver(train_loader, test_loader, pending_work_queues, sender_queues, dataset, 10, 0.005)
+    return Solver(train_loader, test_loader, pending_work_queues, sender_queues, dataset, 10, 0.005,
+        background_aggregation=background_aggregation, aggregation_pool=aggregation_pool,
+        fuse_minibatches=fuse_minibatches)
 
 class Solver(object):
-    def __init__(self, train_loader, test_loader, pending_work_queues, sender_queues, dataset='MNIST', n_epochs=25, lr=0.005, k=2):
+    def __init__(self, train_loader, test_loader, pending_work_queues, sender_queues, dataset='MNIST', n_epochs=25, lr=0.005, k=2, background_aggregation=False, aggregation_pool=None, fuse_minibatches=False, prefetch=16):
+        # :param background_aggregation [bool] aggregate received updates on a
+        #   BackgroundAggregator thread while training goes on
+        # :param aggregation_pool [AggregationPool] optional threads to split
+        #   the sum of received updates across
+        # :param fuse_minibatches [bool] run the freq minibatches between two
+        #   weight updates as one forward and backward pass
+        # :param prefetch [int] no. of training minibatches to load ahead of backprop
         self.n_epochs = n_epochs
         self.curr_epoch = 0
         self.train_loader = train_loader
@@ -35,6 +47,10 @@ class Solver(object):
         self.net = Net(image_dim=self.image_dim)
         self.parameter_pointers = self.get_nn_module_parameter_pointers(self.net)
         self.loss_fn = nn.CrossEntropyLoss()
+        # Per-example losses, for fused minibatches
+        self.example_loss_fn = nn.CrossEntropyLoss(reduction='none')
+        self.fuse_minibatches = fuse_minibatches
+        self.prefetch = prefetch
         self.sender_queues = sender_queues
         self.sender_queues.setup(pending_work_queues.my_host, pending_work_queues.other_hosts, pending_work_queues.other_leaders)
         self.sender_queues.run()
@@ -47,10 +63,15 @@ class Solver(object):
         self.fairness_state = DeviceFairnessReceiverState(
             k,
             device_ip_addr_to_epoch_dict)
+        pending_work_queues.setup_weights(self.fairness_state.get_weight)
         if torch.cuda.is_available():
             self.net = self.net.cuda()
         self.condition = Condition()
         self.ten_recent_loss_list = deque(10*[0.000], 10)
+        # Guards fairness_state against the aggregator thread reading it
+        self.fairness_lock = Lock()
+        self.aggregator = BackgroundAggregator(self) if background_aggregation else None
+        self.aggregation_pool = aggregation_pool
 
     # :brief nn.module.parameters() yields a generator of nn.Parameter, but unfortunately
     #   we can't use it to later the original, so we need to remember pointers for each
@@ -66,6 +87,9 @@ class Solver(object):
 
         j = idx
 
+        if self.fuse_minibatches:
+            j = self.fused_backprop(minibatches, idx, freq)
+
         # Run backprop freq times
         while j < idx + freq and j < len(minibatches):
             images, labels = minibatches[j]
@@ -87,33 +111,92 @@ class Solver(object):
         self.optimizer.zero_grad()
 
         # Update metadata
-        self.fairness_state.update_internal_state_after_backprop(self.ip_addr, freq)
+        with self.fairness_lock:
+            self.fairness_state.update_internal_state_after_backprop(self.ip_addr, freq)
         # Send out the model update to other hosts' queues
         # if self.ip_addr == 'localhost:5000':
              # time.sleep(1)
-        minibatch_updates = { idx: params.clone() for idx, params in self.parameter_pointers.items() }
+        # No clone: the parameters are views into self.net.flat, which
+        # to_bytes copies into the encoded update in one go
+        minibatch_updates = { idx: params.data for idx, params in self.parameter_pointers.items() }
         # if self.ip_addr == "localhost:5000":
         #     if j % 10 ==0:
         #         self.sender_queues.enqueue(ModelUpdate(
         #             updates=minibatch_updates,
-        #             update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_json())
+        #             update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_bytes())
         #         return j
         # else:
+        # Encode once; every peer's queue shares the same bytes
         self.sender_queues.enqueue(ModelUpdate(
             updates=minibatch_updates,
-            update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_json())
+            update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_bytes())
         # print(f"Minibatch {j-1} | loss: {minibatch_loss:.4f}")
 
         return j
     
+    def fused_backprop(self, minibatches, idx, freq):
+        # :brief Backprop on up to freq minibatches in a single forward and
+        # backward pass over all their examples.
+        # The loss is the sum of every minibatch's mean loss, so gradients
+        # are the same as backprop on each minibatch in turn, and every
+        # minibatch's loss is recorded in ten_recent_loss_list as before.
+        # :param minibatches [array<tuple>] (images, labels) of every minibatch
+        # :param idx [int] index of the first minibatch to use
+        # :param freq [int] max no. of minibatches to use
+        # :return [int] index of the next minibatch to use
+        window = minibatches[idx:idx + freq]
+        if len(window) == 0:
+            return idx
+        images = torch.cat([images.view(-1, self.image_dim) for images, _ in window])
+        labels = torch.cat([labels for _, labels in window])
+        sizes = torch.tensor([len(minibatch_labels) for _, minibatch_labels in window])
+        segments = torch.repeat_interleave(torch.arange(len(window)), sizes)
+        if torch.cuda.is_available():
+            images = images.cuda()
+            labels = labels.cuda()
+            sizes = sizes.cuda()
+            segments = segments.cuda()
+        losses = self.example_loss_fn(self.net(images), labels)
+        minibatch_losses = torch.zeros(len(window), dtype=losses.dtype, device=losses.device)
+        minibatch_losses = minibatch_losses.index_add(0, segments, losses) / sizes
+        minibatch_losses.sum().backward()
+        # Calculate loss for each minibatch, averaged across no. of examples in it
+        for minibatch_loss, size in zip(minibatch_losses.tolist(), sizes.tolist()):
+            self.ten_recent_loss_list.appendleft(minibatch_loss / size)
+        return idx + len(window)
+
     def send_after_death(self):
-        minibatch_updates = { idx: params.clone() for idx, params in self.parameter_pointers.items() }
+        # :brief Send our final model to peers that have no unsent copy of it.
+        # The model no longer changes once training is over, so a snapshot
+        # still queued for a peer is replaced rather than added to, and none
+        # is encoded while every peer has one queued.
+        # :return [bool] True if a snapshot was enqueued
+        if not self.sender_queues.needs_update():
+            return False
+        minibatch_updates = { idx: params.data for idx, params in self.parameter_pointers.items() }
         self.sender_queues.enqueue(ModelUpdate(
             updates=minibatch_updates,
-            update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_json())
+            update_metadata=self.fairness_state.device_ip_addr_to_epoch_dict).to_bytes(), latest_only=True)
+        return True
         
     
     def aggregate_received_updates(self):
+        # :brief Aggregate every received update into the model, on the calling thread.
+        aggregate = self.aggregate_others()
+        if aggregate is not None:
+            self.swap_in_aggregate(aggregate)
+
+    def aggregate_others(self, out=None):
+        # :brief Drain the received updates and sum them, each scaled by its alpha.
+        # Alphas are computed against our own metadata as it is now, but our
+        # own parameters are left out of the sum and only added in by
+        # swap_in_aggregate. Parameters are never read here, so this can run
+        # on another thread while training goes on (see BackgroundAggregator).
+        # :param out [torch.tensor] optional buffer to reuse for the sum
+        # :return [tuple] (flat weighted sum of the received updates, our own alpha,
+        #   set of host ids in all metadata), or None if nothing was received
+        if self.pending_work_queues.running_aggregate:
+            return self.aggregate_running_sums(out)
         metadata_list = []
         weight_list = []
 
@@ -121,8 +204,6 @@ class Solver(object):
         # (Cannot assume that this is the same/other_hosts all the time because metadata
         # could come from nodes outside the cluster)
         host_id_list = []
-        
-        models = []
 
         for host_id in self.pending_work_queues.other_hosts:
             # This should be a ModelUpdate object
@@ -140,68 +221,121 @@ class Solver(object):
             except EmptyQueueError:
                 # print('EMPTY Q:', host_id)
                 continue
-        
+        if len(weight_list) == 0:
+            return None
+
+        # Our own update goes last
+        own_metadata = self.own_metadata()
+        metadata_list.append(own_metadata)
+        host_id_list.extend(own_metadata.keys())
         # Remove duplicate host id's
-        # metadata_list.append(self.update_metadata)
-        # weight_list.append(self.minibatch_updates)
-        metadata_list.append(self.fairness_state.device_ip_addr_to_epoch_dict)
-        weight_list.append(self.parameter_pointers)
-        host_id_list.extend(self.fairness_state.device_ip_addr_to_epoch_dict.keys())
         host_id_list = set(host_id_list)
-        # self.minibatch_updates = None
-        # self.update_metadata = None
-        flattened_metadata_list = self.fairness_state.flatten_metadata(metadata_list, host_id_list)
+        flattened_metadata_list = self.fairness_state.metadata_vectors(metadata_list, host_id_list)
         alphas = self.fairness_state.get_alphas(flattened_metadata_list)
 
         # Sanity check
-        if (len(alphas) != len(weight_list)) or (len(weight_list) != len(metadata_list)):
+        if (len(alphas) != len(weight_list) + 1) or (len(weight_list) + 1 != len(metadata_list)):
             print(len(alphas), 'alphas')
-            print(len(weight_list), 'weights')
+            print(len(weight_list) + 1, 'weights')
             print(len(metadata_list), 'metadata')
             raise ValueError("Something very wrong with our alphas")
 
-        self.fairness_state.update_internal_state_after_aggregation(
-            alphas, 
-            flattened_metadata_list,
-            host_id_list)
-        # Update weights by overwriting self.parameter_pointers
-        for idx, _ in self.parameter_pointers.items():
-            # PyTorch doesn’t allow in-place operations on variables you create directly
-            # (such as parameters of your model). Hence the verbose y = y + x syntax.
-            # print(weight_list)
-            sum_updates = sum([
-                alpha * weight[idx] for alpha, weight in zip(alphas, weight_list)])
-            #print("sum updates for", idx, sum_updates)
-            #print("parameterpointers for", idx, self.parameter_pointers[idx].data)
-            self.parameter_pointers[idx].data = sum_updates
-            # print("combo", idx, self.parameter_pointers[idx].data)
-        return
+        # All layers are summed at once as flat vectors, in shards on the
+        # aggregation pool if there is one
+        sum_fn = weighted_sum if self.aggregation_pool is None else self.aggregation_pool.weighted_sum
+        sum_updates = sum_fn(alphas[:-1], weight_list, list(self.parameter_pointers.keys()), out)
+        return sum_updates, alphas[-1], host_id_list
+
+    def aggregate_running_sums(self, out=None):
+        # :brief Same as aggregate_others, for pending work queues that fold
+        # updates into a RunningAggregate per host as they arrive.
+        # Each update's alpha is its get_weight weight over the sum of all
+        # weights, so the weighted sums only need dividing by that sum.
+        own_metadata = self.own_metadata()
+        own_weight = self.fairness_state.get_weight(own_metadata.values())
+        total_weight = own_weight
+        host_id_list = set(own_metadata.keys())
+        keys = list(self.parameter_pointers.keys())
+        sum_updates = None
+        for host_id in self.pending_work_queues.other_hosts:
+            try:
+                aggregate = self.pending_work_queues.take_aggregate(host_id)
+            except EmptyQueueError:
+                continue
+            flat = flatten([aggregate.weighted_sum[idx] for idx in keys])
+            if sum_updates is None:
+                sum_updates = out if out is not None and out.shape == flat.shape and out.dtype == flat.dtype else torch.empty_like(flat)
+                sum_updates.copy_(flat)
+            else:
+                sum_updates.add_(flat)
+            total_weight += aggregate.total_weight
+            host_id_list.update(aggregate.host_ids)
+        if sum_updates is None:
+            return None
+        return sum_updates.div_(total_weight), own_weight / total_weight, host_id_list
+
+    def swap_in_aggregate(self, aggregate):
+        # :brief Make an aggregate from aggregate_others the model's parameters.
+        # Our own parameters and metadata enter with the alpha computed back
+        # then but as they are now, which is exactly the synchronous result
+        # if no training happened in between.
+        # Only call this from the training thread.
+        # :param aggregate [tuple] the return value of aggregate_others
+        # :return [torch.tensor] the flat parameter buffer that was replaced
+        sum_updates, own_alpha, host_id_list = aggregate
+        with self.fairness_lock:
+            own_metadata = self.fairness_state.device_ip_addr_to_epoch_dict
+            host_id_list = host_id_list | set(own_metadata.keys())
+            # Only our own update's alpha and metadata shape the new state
+            # (see update_internal_state_after_aggregation)
+            self.fairness_state.update_internal_state_after_aggregation(
+                [own_alpha],
+                self.fairness_state.flatten_metadata([own_metadata], host_id_list),
+                host_id_list)
+        replaced = self.net.flat
+        with torch.no_grad():
+            self.net.load_flat(sum_updates.add_(replaced, alpha=own_alpha))
+        return replaced
+
+    def own_metadata(self):
+        # :brief Get a copy of our own metadata that the training thread will not change.
+        with self.fairness_lock:
+            return dict(self.fairness_state.device_ip_addr_to_epoch_dict)
 
     def train(self):
         freq = 5
         start_time = time.time()
-        minibatches = list(self.train_loader)
+        # Minibatches are loaded on another thread while training goes on
+        minibatches = PrefetchedMinibatches(self.train_loader, max(self.prefetch, freq))
         i = 0
+        if self.aggregator is not None:
+            self.aggregator.start()
         while i < len(minibatches) and not self.convergent(): 
             # Check if we can backprop
             i = self.minibatch_backprop_and_update_weights(minibatches, i, freq)
                 #if self.pending_work_queues.is_leader() and self.curr_epoch > 1 and (self.curr_epoch % 2 == 0 or self.curr_epoch % 5 == 0):
                 #if self.curr_epoch % 5 == 0:
                 #    print("Initiating Inter-cluster non-blocking communication")
-                #    self.sender_queues.enqueue(model_update.to_json(), True)
+                #    self.sender_queues.enqueue(model_update.to_bytes(), True)
                 #if self.curr_epoch % 2 == 0:
                 #    print("Initiating Local Synchronization")
-                #    self.local_synchronize(model_update.to_json())
+                #    self.local_synchronize(model_update.to_bytes())
 
             # To model synchronicity
-            # while self.pending_work_queues.total_no_of_updates < len(self.pending_work_queues.other_hosts):
-            #      time.sleep(0.0001)
+            # self.pending_work_queues.wait_for_updates(len(self.pending_work_queues.other_hosts))
             # self.aggregate_received_updates()
 
             # Normal way: 
+            if self.aggregator is not None:
+                # Aggregation already happened on the aggregator thread
+                self.aggregator.swap_in()
+                continue
             while self.pending_work_queues.total_no_of_updates > 0:
                 self.aggregate_received_updates()
 
+        minibatches.close()
+        if self.aggregator is not None:
+            self.aggregator.stop()
         if self.convergent():
             print("Converge at Minibatch ", i)
         if i == len(minibatches):
@@ -221,36 +355,54 @@ class Solver(object):
         return False
             
 
-    def evaluate(self):
-        total = 0
-        correct = 0
-        self.net.eval()
-        for images, labels in self.test_loader:
-            images = Variable(images).view(-1, self.image_dim)
-            if torch.cuda.is_available():
-                images = images.cuda()
-            logits = self.net(images)
-            _, predicted = torch.max(logits.data, 1)
-            total += labels.size(0)
-            correct += (predicted.cpu() == labels).sum()
-        print(f'Accuracy: {100 * correct / total:.2f}%')
-        
-    def evaluate_matrix(self):
+    def confusion_matrix(self):
+        # :brief Classify the whole test set in one pass, without autograd.
+        # :return [torch.tensor] matrix[c][p] is the no. of test examples of
+        #   class c that were predicted as class p
         self.net.eval()
-        for images, labels in self.test_loader:
-            label_to_correct = {0: [], 1: [], 2: [], 3:[], 4: [], 5: [], 6: [], 7: [], 8:[], 9: []}
-            images = Variable(images).view(-1, self.image_dim)
-            if torch.cuda.is_available():
-                images = images.cuda()
-            logits = self.net(images)
-            _, predicted = torch.max(logits.data, 1)
-            predicted_tensor = predicted.cpu()
-            for idx in range(100):
-                label_to_correct[labels[idx].item()].append((labels[idx] == predicted_tensor[idx]).item())
-        label_to_accuracy = {0: 0, 1: 0, 2: 0, 3:0, 4: 0, 5: 0, 6: 0, 7: 0, 8:0 , 9: 0}
-        for label in label_to_correct: 
-            label_to_accuracy[label] = round(sum(label_to_correct[label])/len(label_to_correct[label]), 2)
+        counts = None
+        with torch.inference_mode():
+            for images, labels in self.test_loader:
+                images = images.view(-1, self.image_dim)
+                if torch.cuda.is_available():
+                    images = images.cuda()
+                logits = self.net(images)
+                num_classes = logits.shape[1]
+                predicted = logits.argmax(1).cpu()
+                # Every (class, prediction) pair gets its own bin
+                batch_counts = torch.bincount(labels * num_classes + predicted, minlength=num_classes * num_classes)
+                counts = batch_counts if counts is None else counts + batch_counts
+        if counts is None:
+            return torch.zeros(0, 0, dtype=torch.long)
+        return counts.view(num_classes, num_classes)
+
+    def evaluate(self, matrix=None):
+        # :brief Print the accuracy over the whole test set.
+        # :param matrix [torch.tensor] optional result of confusion_matrix to reuse
+        if matrix is None:
+            matrix = self.confusion_matrix()
+        correct = matrix.diagonal().sum().item()
+        total = matrix.sum().item()
+        print(f'Accuracy: {100 * correct / max(total, 1):.2f}%')
+
+    def evaluate_matrix(self, matrix=None):
+        # :brief Print the accuracy on every class in the test set.
+        # :param matrix [torch.tensor] optional result of confusion_matrix to reuse
+        if matrix is None:
+            matrix = self.confusion_matrix()
+        totals = matrix.sum(1)
+        label_to_accuracy = {}
+        for label, (correct, total) in enumerate(zip(matrix.diagonal().tolist(), totals.tolist())):
+            if total > 0:
+                label_to_accuracy[label] = round(correct / total, 2)
         print("ACCURACY", label_to_accuracy)
+
+    def evaluate_all(self):
+        # :brief Print both the overall and the per-class accuracy, from one
+        # pass over the test set.
+        matrix = self.confusion_matrix()
+        self.evaluate(matrix)
+        self.evaluate_matrix(matrix)
     
     def local_synchronize(self, update):
         # :brief Synchronize all devices in the cluster with an update.
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import numpy as np
 import torch
+from src.aggregation import unflatten_into
 
 class Net(nn.Module):
     def __init__(self, image_dim=28*28):
@@ -17,10 +18,36 @@ class Net(nn.Module):
         torch.manual_seed(2)
              
         self.net.apply(weights_init_uniform)     
+        self.flatten_parameters()
             
     def forward(self, x):
         return self.net(x)
 
+    def flatten_parameters(self):
+        # :brief Move every parameter into one contiguous buffer, self.flat,
+        # and make the parameters views into it, in parameters() order.
+        # A snapshot of the whole model is then a single copy of self.flat.
+        with torch.no_grad():
+            flat = torch.cat([params.data.reshape(-1) for params in self.parameters()])
+        self.load_flat(flat)
+
+    def load_flat(self, flat):
+        # :brief Make a flat tensor the model's parameters, without copying it.
+        # :param flat [torch.tensor] every parameter back to back, in parameters() order
+        # :warning raises a ValueError if flat does not have one element per parameter
+        params = list(self.parameters())
+        if flat.numel() != sum(p.numel() for p in params):
+            raise ValueError("flat parameters do not match the model")
+        unflatten_into(flat, params)
+        self.flat = flat
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting the model (e.g. cuda()) replaces every parameter's
+        # data, so gather them into one buffer again
+        super(Net, self)._apply(fn, *args, **kwargs)
+        self.flatten_parameters()
+        return self
+
 # From https://stackoverflow.com/questions/49433936/how-to-initialize-weights-in-pytorch        
 # takes in a module and applies the specified weight initialization
 def weights_init_uniform(m):
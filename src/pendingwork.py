@@ -1,6 +1,11 @@
 #!/usr/bin/python3
-from threading import RLock
-from src.updatequeue import UpdateQueue
+from threading import Condition, Lock, RLock
+from src.updatequeue import UpdateQueue, payload_size
+from src.rwlock import RWLock
+from src.spill import SpilledUpdate, spill, unspill
+from src.decoder import PendingDecode, decoded
+from src.running_aggregate import RunningAggregate
+from src.get_weights import inverse_norm
 import random
 from src.util import DevicePushbackError, EmptyQueueError, ExtraFatal
 from src.update_metadata.model_update import ModelUpdate
@@ -11,18 +16,78 @@ class PendingWork(object):
     # for one tenant only, and it does not include
     # a global model queue. This class is thread safe.
     # TODO(ml): Add a global model queue.
-
-    def __init__(self, max_qlen_ratio):
+    #
+    # Locking: self.lock is a reader-writer lock over the set of queues.
+    # Replacing queues, and operations that span all queues, take it for
+    # writing. A queue for a new host is added under the read lock and
+    # new_queue_lock (see _new_queue). Everything else takes it for reading
+    # plus the lock of the host's stripe (see host_lock), so updates from
+    # hosts on different stripes never wait for each other. There is one
+    # stripe by default: the work under a host lock is short and holds the
+    # GIL, so more stripes gain no throughput and only add GIL handoffs that
+    # raise worst-case latency (see bench/pendingwork_contention.py).
+    # count_lock guards total_no_of_updates, queued_bytes and the queue
+    # length histogram.
+    #
+    # Updates may be queued while a DecodePool is still decoding them, as a
+    # PendingDecode. Like spilled updates, they are resolved when dequeued.
+    #
+    # Memory: with a memory_budget, the oldest updates of the largest queue
+    # are spilled to files on local disk whenever the queued updates hold
+    # more bytes than the budget (see _enforce_memory_budget). Spilled
+    # updates are paged back in when they are dequeued, so callers never
+    # see them. With running_aggregate, each host has a RunningAggregate in
+    # place of its queue, so memory does not grow with the backlog at all;
+    # it is drained with take_aggregate instead of dequeued from.
+
+    def __init__(self, max_qlen_ratio, num_stripes=1, memory_budget=None, spill_dir=None, queue_capacity=None, running_aggregate=False):
         # :brief Create a new PendingWork instance.
+        # :param max_qlen_ratio [float] max ratio between a queue's length and
+        #   the shortest queue's length before enqueues are pushed back; only
+        #   hosts that have sent updates count, and none while one is drained
+        # :param num_stripes [int] no. of locks the host queues are spread over;
+        #   only worth raising if per-host work releases the GIL on several cores
+        # :param memory_budget [int] max no. of bytes queued updates may hold in
+        #   RAM before they spill to disk; no limit if None
+        # :param spill_dir [str] directory for spilled updates; the system temp dir if None
+        # :param queue_capacity [int] max no. of updates queued per host before
+        #   enqueues are pushed back; no limit if None
+        # :param running_aggregate [bool] fold each host's updates into a
+        #   RunningAggregate as they arrive instead of queueing them
         self.queues = {}
-        self.lock = RLock()
+        self.lock = RWLock()
+        # Serializes creating queues for new hosts under the read lock
+        self.new_queue_lock = Lock()
+        self.host_locks = [RLock() for _ in range(num_stripes)]
+        self.count_lock = Lock()
+        # Notified whenever updates are enqueued (see wait_for_updates)
+        self.updates_available = Condition(self.count_lock)
         self.my_host = ''
         self.other_hosts = []
         self.other_leaders = []
         self.num_devices = 0
         self.total_no_of_updates = 0
         self.min_queue_len = None
+        self.max_queue_len = None
+        # Histogram of queue lengths: maps a length to the no. of queues that long.
+        # Only the queues of senders count: a host's queue joins it with the
+        # host's first update, so the queue of my_host, and of peers that
+        # never send, cannot pin min_queue_len at 0.
+        self.queue_len_counts = {}
+        self.senders = set()
         self.k = max_qlen_ratio
+        self.queue_capacity = queue_capacity
+        self.running_aggregate = running_aggregate
+        # Unnormalized weight of an update's metadata, for running aggregates
+        self.weight_fn = inverse_norm
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        # No. of payload bytes held in RAM by all queues
+        self.queued_bytes = 0
+        # Maps a host to the index in its queue before which nothing is left
+        # to spill. Spilling goes oldest first, so spilled updates always
+        # sit at the front of a queue.
+        self.spill_cursors = {}
         self.leader = ""
         self.frozen = False
         self.node = None
@@ -37,10 +102,26 @@ class PendingWork(object):
         self.leader = leader
         self.num_devices = 1 + len(other_hosts) + len(other_leaders)
         self.write()
-        self.queues[my_host] = UpdateQueue()
-        for host in other_hosts + other_leaders:
-            self.queues[host] = UpdateQueue()
-        self.release()
+        try:
+            self._new_queue(my_host)
+            for host in other_hosts + other_leaders:
+                self._new_queue(host)
+        finally:
+            self.release()
+
+    def setup_weights(self, weight_fn):
+        # :brief Set how running aggregates weight the updates folded into them.
+        # Updates folded in before keep the weight they were given.
+        # :param weight_fn [function] maps an update's metadata values to its
+        #   unnormalized weight (see DeviceFairnessReceiverState.get_weight)
+        self.write()
+        try:
+            self.weight_fn = weight_fn
+            for queue in self.queues.values():
+                if isinstance(queue, RunningAggregate):
+                    queue.weight_fn = weight_fn
+        finally:
+            self.release()
 
     def is_leader(self):
         return self.my_host == self.leader
@@ -59,23 +140,25 @@ class PendingWork(object):
         # If the queue is frozen (during synchronization) and receive non-leader, do not enqueue:
         if self.frozen and host != self.leader:
             return
-        self.write()
-        if not host in self.queues:
-            # Creates queue if none exists
-            # Will never push back for creating new queue
-            self.queues[host] = UpdateQueue()
-            self.queues[host].enqueue(update)
-            self.total_no_of_updates += 1
-            self._update_min_and_max()
+        # Creates queue if none exists
+        # Will never push back for creating new queue
+        queue = self._lock_queue(host)
+        try:
+            with self.host_lock(host):
+                if self._should_push_back(queue):
+                    raise DevicePushbackError("could not enqueue new update")
+                old_nbytes = queue.nbytes
+                queue.enqueue(update)
+                with self.count_lock:
+                    self.total_no_of_updates += 1
+                    self.queued_bytes += queue.nbytes - old_nbytes
+                    old_len = queue.len - 1 if host in self.senders else None
+                    self.senders.add(host)
+                    self._update_min_and_max(old_len, queue.len)
+                    self.updates_available.notify_all()
+            self._enforce_memory_budget()
+        finally:
             self.release()
-            return
-        queue = self.queues[host]
-        if self.min_queue_len != None:
-            if queue.len > self.k * self.min_queue_len:
-                self.release()
-                raise DevicePushbackError("could not enqueue new update")
-        queue.enqueue(update)
-        self.total_no_of_updates += 1
         # Wake ml thread up if it's sleeping because it couldn't backprop
         # or aggregate
         if self.node is not None:
@@ -83,69 +166,157 @@ class PendingWork(object):
                 # print("INCOMING UPDATE WAKE UP ML THREAD")
                 self.node.condition.notify()
 
-        self._update_min_and_max()
-        self.release()
+    def enqueue_batch(self, updates, host):
+        # :brief Add several updates from one host under a single lock acquisition.
+        # Pushback is decided once for the whole batch: either every update is
+        # enqueued or none is, so the batch is pushed back unless the queue has
+        # a free slot for each of its updates.
+        # :param updates [array<ModelUpdate>] model updates, oldest first
+        # :param host [str] the id for the host that generated the updates
+        if self.frozen and host != self.leader:
+            return
+        queue = self._lock_queue(host)
+        try:
+            with self.host_lock(host):
+                if self._should_push_back(queue, len(updates)):
+                    raise DevicePushbackError("could not enqueue new updates")
+                old_len, old_nbytes = queue.len, queue.nbytes
+                try:
+                    for update in updates:
+                        queue.enqueue(update)
+                finally:
+                    # Count whatever made it in, even if an update failed
+                    with self.count_lock:
+                        self.total_no_of_updates += queue.len - old_len
+                        self.queued_bytes += queue.nbytes - old_nbytes
+                        if host in self.senders:
+                            self._update_min_and_max(old_len, queue.len)
+                        elif queue.len > old_len:
+                            self.senders.add(host)
+                            self._update_min_and_max(None, queue.len)
+                        self.updates_available.notify_all()
+            self._enforce_memory_budget()
+        finally:
+            self.release()
+        if self.node is not None:
+            with self.node.condition:
+                self.node.condition.notify()
+
+    def wait_for_updates(self, min_count, hosts=None, timeout=None):
+        # :brief Block until at least min_count updates are queued.
+        # The calling thread sleeps on a condition variable that every enqueue
+        # notifies, so there is no polling.
+        # :param min_count [int] no. of queued updates to wait for
+        # :param hosts [array<str>] only count updates from these hosts; all hosts if None
+        # :param timeout [float] max seconds to wait; forever if None
+        # :return [bool] True if enough updates are queued, False if timed out
+        with self.updates_available:
+            return self.updates_available.wait_for(
+                lambda: self._count_queued(hosts) >= min_count, timeout)
+
+    def credits(self, host):
+        # :brief Get the no. of updates a host may still send before its
+        # enqueues are pushed back. Receivers advertise this to senders so
+        # they stop sending instead of being pushed back (see Sender).
+        # :param host [str] the id of the sending host
+        # :return [int] the no. of free slots in the host's queue, or None if unlimited
+        queue = self._lock_queue(host)
+        try:
+            with self.host_lock(host):
+                return self._free_slots(queue)
+        finally:
+            self.release()
+
+    def _count_queued(self, hosts):
+        # :brief Count the updates queued from some hosts.
+        # Requires that count_lock already be held.
+        if hosts is None:
+            return self.total_no_of_updates
+        return sum(self.queues[host].len for host in hosts if host in self.queues)
 
     def empty_model_and_metadata_from(self, host: str):
-        self.write()
-        if self.total_no_of_updates == 0:
+        queue = self._lock_queue(host)
+        try:
+            if self.total_no_of_updates == 0:
+                raise EmptyQueueError("All queues empty")
+            model_updates = []
+            with self.host_lock(host):
+                old_nbytes = queue.nbytes
+                while (queue.len > 0):
+                    model_updates.append(queue.dequeue())
+                self.spill_cursors.pop(host, None)
+                if len(model_updates) > 0:
+                    with self.count_lock:
+                        self.total_no_of_updates -= len(model_updates)
+                        self.queued_bytes -= old_nbytes
+                        self._update_min_and_max(len(model_updates), 0)
+        finally:
             self.release()
-            raise EmptyQueueError("All queues empty")
 
         weight_list = []
         metadata_list = []
         id_list = []
 
-        if not host in self.queues:
-            # Creates queue if none exists
-            # Will never push back for creating new queue
-            self.queues[host] = UpdateQueue()
-            self._update_min_and_max()
-
-        while (self.queues[host].len > 0):
-            model_update_dict = self.dequeue(host)
+        # Page spilled updates back in, and wait for pending decodes, outside the locks
+        model_updates = [self._ready(update) for update in model_updates]
+        for model_update_dict in model_updates:
             model_update = ModelUpdate.from_dict(model_update_dict)
             weight_list.append(model_update_dict.updates)
             metadata_list.append(model_update_dict.update_metadata)
             id_list.extend(model_update_dict.update_metadata.keys())
-            
 
         if len(weight_list) == 0 or len(metadata_list) == 0:
-            self.release()
             raise EmptyQueueError("could not pop from queue for host: " + host)
 
-
-        self._update_min_and_max()
-        self.release()
         return (weight_list, metadata_list, id_list)
 
+    def take_aggregate(self, host: str) -> RunningAggregate:
+        # :brief Take the updates folded in for a host so far, leaving its
+        # aggregate empty. Only for PendingWork with running_aggregate.
+        # :return [RunningAggregate] the host's aggregate
+        # :warning Raises an EmptyQueueError if no update arrived from the host.
+        queue = self._lock_queue(host)
+        try:
+            if self.total_no_of_updates == 0:
+                raise EmptyQueueError("All queues empty")
+            ret = None
+            with self.host_lock(host):
+                if queue.len > 0:
+                    ret = queue.take()
+                    with self.count_lock:
+                        self.total_no_of_updates -= ret.len
+                        self.queued_bytes -= ret.nbytes
+                        self._update_min_and_max(ret.len, 0)
+        finally:
+            self.release()
+        if ret == None:
+            raise EmptyQueueError("could not pop from queue for host: " + host)
+        # Updates that were still being decoded are folded in here, with no lock held
+        ret.fold_pending()
+        return ret
+
     def dequeue(self, host: str) -> ModelUpdate:
         # :brief Pop an update from the given host's queue
         # :return [ModelUpdate] a dequeued ModelUpdate object
         # :warning Raises an EmptyQueueError when no element could be returned.
-        self.write()
-        if self.total_no_of_updates == 0:
+        queue = self._lock_queue(host)
+        try:
+            if self.total_no_of_updates == 0:
+                raise EmptyQueueError("All queues empty")
+            ret = None
+            with self.host_lock(host):
+                if (queue.len > 0):
+                    ret = queue.dequeue()
+                    self._dequeued(host)
+                    with self.count_lock:
+                        self.total_no_of_updates -= 1
+                        self.queued_bytes -= payload_size(ret)
+                        self._update_min_and_max(queue.len + 1, queue.len)
+        finally:
             self.release()
-            raise EmptyQueueError("All queues empty")
-
-        ret = None
-        if not host in self.queues:
-            # Creates queue if none exists
-            # Will never push back for creating new queue
-            self.queues[host] = UpdateQueue()
-            self._update_min_and_max()
-
-        if (self.queues[host].len > 0):
-            ret = self.queues[host].dequeue()
-
         if ret == None:
-            self.release()
             raise EmptyQueueError("could not pop from queue for host: " + host)
-
-        self.total_no_of_updates -= 1
-        self._update_min_and_max()
-        self.release()
-        return ret
+        return self._ready(ret)
 
     def clear_all(self):
         # Stop all enqueues from non-leader
@@ -158,35 +329,39 @@ class PendingWork(object):
         # :brief Clear every host's queue
         # :return nothing
         self.write()
-        for queue in self.queues:
-            self.total_no_of_updates -= self.queues[queue].len
-            self.queues[queue].clear()
-        self.release()
-        return
+        try:
+            with self.count_lock:
+                for queue in self.queues:
+                    old_len = self.queues[queue].len
+                    self.total_no_of_updates -= old_len
+                    self.queued_bytes -= self.queues[queue].nbytes
+                    self._discard_spilled(queue)
+                    self.queues[queue].clear()
+                    if queue in self.senders:
+                        self._update_min_and_max(old_len, 0)
+        finally:
+            self.release()
 
     def peek(self, host: str) -> ModelUpdate:
         # :brief Pop an update from the given host's queue
         # :return [ModelUpdate] a dequeued ModelUpdate object
         # :warning Raises an EmptyQueueError when no element could be returned.
-        self.read()
-        if self.total_no_of_updates == 0:
+        queue = self._lock_queue(host)
+        try:
+            if self.total_no_of_updates == 0:
+                raise EmptyQueueError("All queues empty")
+            ret = None
+            with self.host_lock(host):
+                if (queue.len > 0):
+                    ret = queue.peek()
+                    if isinstance(ret, SpilledUpdate):
+                        # The update stays spilled; only map it in
+                        ret = ret.read()
+                    ret = decoded(ret)
+        finally:
             self.release()
-            raise EmptyQueueError("All queues empty")
-
-        ret = None
-        if not host in self.queues:
-            # Creates queue if none exists
-            # Will never push back for creating new queue
-            self.queues[host] = UpdateQueue()
-
-        if (self.queues[host].len > 0):
-            ret = self.queues[host].peek()
-
         if ret == None:
-            self.release()
             raise EmptyQueueError("could not pop from queue for host: " + host)
-
-        self.release()
         return ret
 
     def dequeue_random(self) -> ModelUpdate:
@@ -196,70 +371,226 @@ class PendingWork(object):
         # :return [ModelUpdate] a dequeued ModelUpdate object
         # :warning Raises an EmptyQueueError when no element could be returned.
         self.write()
-        if self.total_no_of_updates == 0:
+        try:
+            if self.total_no_of_updates == 0:
+                raise EmptyQueueError("")
+            ret = None
+            r = random.randint(0, max(self.total_no_of_updates - 1, 0))
+            with self.count_lock:
+                for key in self.queues:
+                    queue = self.queues[key]
+                    if queue.len > r:
+                        ret = queue.dequeue()
+                        self._dequeued(key)
+                        self.queued_bytes -= payload_size(ret)
+                        self._update_min_and_max(queue.len + 1, queue.len)
+                        break
+                    else:
+                        r -= queue.len
+                if ret == None:
+                    # This should not happen
+                    raise ExtraFatal("could not pop from any queue")
+                self.total_no_of_updates -= 1
+        finally:
             self.release()
-            raise EmptyQueueError("")
-        ret = None
-        r = random.randint(0, max(self.total_no_of_updates - 1, 0))
-        for key in self.queues:
-            queue = self.queues[key]
-            if queue.len > r:
-                ret = queue.dequeue()
-                break
-            else:
-                r -= queue.len
-        if ret == None:
-            # This should not happen
+        return self._ready(ret)
+
+    def host_lock(self, host):
+        # :brief Get the lock guarding a host's queue.
+        # Hosts are spread over a fixed set of locks by hash.
+        # :return [RLock] the lock of the host's stripe
+        return self.host_locks[hash(host) % len(self.host_locks)]
+
+    def _lock_queue(self, host):
+        # :brief Read lock self and get a host's queue, creating it if none exists.
+        # Creating a queue needs no write lock (see _new_queue), so this works
+        # for a thread that already holds self for reading, too.
+        # Release with self.release(), in a finally block so that nothing
+        # raised while the lock is held can leave it held.
+        # :return [UpdateQueue] the host's queue
+        self.read()
+        try:
+            queue = self.queues.get(host)
+            if queue is None:
+                with self.new_queue_lock:
+                    if not host in self.queues:
+                        self._new_queue(host)
+                    queue = self.queues[host]
+        except BaseException:
             self.release()
-            raise ExtraFatal("could not pop from any queue")
-        self.total_no_of_updates -= 1
-        self._update_min_and_max()
-        self.release()
-        return ret
-
-    def _update_min_and_max(self):
-        # :brief Recalculate min and max queue lengths.
-        # Requires that self already be locked.
+            raise
+        return queue
+
+    def _new_queue(self, host):
+        # :brief Create an empty queue for a host, replacing any existing one.
+        # The queue goes into a copy of self.queues that then replaces it, so
+        # threads reading the old dict are never disturbed.
+        # Requires that self already be write locked, or, for a host with no
+        # queue yet, read locked with new_queue_lock held.
+        with self.count_lock:
+            if host in self.queues:
+                self.total_no_of_updates -= self.queues[host].len
+                self.queued_bytes -= self.queues[host].nbytes
+                self._discard_spilled(host)
+            if host in self.senders:
+                # The new queue joins the histogram with the host's next update
+                self.senders.discard(host)
+                self._update_min_and_max(self.queues[host].len, None)
+        queues = dict(self.queues)
+        queues[host] = RunningAggregate(self.weight_fn) if self.running_aggregate else UpdateQueue()
+        self.queues = queues
+
+    def _enforce_memory_budget(self):
+        # :brief Spill the oldest updates of the largest queue until the queued
+        # updates fit in memory_budget again.
+        # Only ModelUpdates, decoded or not, are spilled; if the largest queue has none left in
+        # RAM, the budget is left exceeded rather than spilling from others.
+        # Requires that self be read locked once and no host lock be held.
+        while self.memory_budget is not None and self.queued_bytes > self.memory_budget:
+            host = max(self.queues, key=lambda h: self.queues[h].nbytes)
+            with self.host_lock(host):
+                if not self._spill_oldest(host):
+                    return
+
+    def _spill_oldest(self, host):
+        # :brief Spill the oldest update of a host's queue still held in RAM.
+        # Requires that the host's queue already be locked.
+        # :return [bool] False if there was nothing left to spill
+        queue = self.queues[host]
+        if not isinstance(queue, UpdateQueue):
+            return False
+        i = self.spill_cursors.get(host, 0)
+        while i < queue.len:
+            item = queue.queue[i]
+            i += 1
+            update = item
+            if isinstance(item, PendingDecode) and item.done() and item.future.exception() is None:
+                update = item.result()
+            if isinstance(update, ModelUpdate):
+                queue.replace(i - 1, spill(update, self.spill_dir))
+                self.spill_cursors[host] = i
+                with self.count_lock:
+                    self.queued_bytes -= payload_size(item)
+                return True
+        self.spill_cursors[host] = i
+        return False
+
+    def _ready(self, item):
+        # :brief Get the update a dequeued item stands for (see SpilledUpdate
+        # and PendingDecode).
+        return decoded(unspill(item))
+
+    def _dequeued(self, host):
+        # :brief Move a host's spill cursor after its oldest update was dequeued.
+        # Requires that the host's queue already be locked.
+        if self.spill_cursors.get(host, 0) > 0:
+            self.spill_cursors[host] -= 1
+
+    def _discard_spilled(self, host):
+        # :brief Delete the files of a host's spilled updates before its queue
+        # is cleared or replaced.
+        # Requires that self already be write locked.
+        if not isinstance(self.queues[host], UpdateQueue):
+            return
+        for update in self.queues[host].queue:
+            if isinstance(update, SpilledUpdate):
+                update.discard()
+        self.spill_cursors.pop(host, None)
+
+    def _should_push_back(self, queue, count=1):
+        # :brief Check if a queue has no room for count more updates (see _free_slots).
+        # Requires that the host's queue already be locked.
+        free = self._free_slots(queue)
+        return free is not None and free < count
+
+    def _free_slots(self, queue):
+        # :brief Get the no. of updates that can be added to a queue before it
+        # is at queue_capacity or more than k times longer than the shortest
+        # queue of a sender. There is no ratio to enforce while a sender's
+        # queue is empty.
+        # Requires that the host's queue already be locked.
+        # :return [int] the no. of free slots, or None if unlimited
+        free = None
+        if self.queue_capacity is not None:
+            free = self.queue_capacity - queue.len
+        if self.min_queue_len and self.k * self.min_queue_len < float('inf'):
+            ratio_free = int(self.k * self.min_queue_len) + 1 - queue.len
+            free = ratio_free if free is None else min(free, ratio_free)
+        return None if free is None else max(0, free)
+
+    def _update_min_and_max(self, old_len, new_len):
+        # :brief Move one queue from old_len to new_len in the histogram of queue
+        # lengths, and update the min and max queue lengths from it.
+        # Only queues of senders are in the histogram (see self.senders).
+        # When the last queue at the min (max) length moves, the new min (max) is
+        # found by walking the histogram towards new_len, so a change of one
+        # costs O(1) and a change of n costs at most O(n), which the n
+        # enqueues that grew the queue already paid for.
+        # Requires that count_lock already be held.
         # Should not be called from outside this class (a private method).
-        # TODO(gs): There is a faster way to do this since this method scales with O(n)
-        # where n is the number of queues. It would essentially be to keep a histogram of counts
-        # in a vector. The worst case would be the same, but average performance *should* improve.
-        # However, I think that may be harder to maintain so I will leave this here until
-        # scale becomes a problem.
-        lo = None
-        for queue in self.queues:
-            if lo == None:
-                lo = len(queue)
-            if len(queue) < lo and lo != 1:
-                lo = len(queue)
-        self.min_queue_len = lo
+        # :param old_len [int] the queue's length before, or None if it joins the histogram
+        # :param new_len [int] the queue's length now, or None if it leaves the histogram
+        counts = self.queue_len_counts
+        if old_len is not None:
+            counts[old_len] -= 1
+            if counts[old_len] == 0:
+                del counts[old_len]
+        if new_len is not None:
+            counts[new_len] = counts.get(new_len, 0) + 1
+        if not counts:
+            self.min_queue_len = self.max_queue_len = None
+            return
+
+        if new_len is not None and (self.min_queue_len is None or new_len < self.min_queue_len):
+            self.min_queue_len = new_len
+        elif old_len == self.min_queue_len and old_len not in counts:
+            lo = old_len + 1
+            while lo not in counts:
+                lo += 1
+            self.min_queue_len = lo
+
+        if new_len is not None and (self.max_queue_len is None or new_len > self.max_queue_len):
+            self.max_queue_len = new_len
+        elif old_len == self.max_queue_len and old_len not in counts:
+            hi = old_len - 1
+            while hi not in counts:
+                hi -= 1
+            self.max_queue_len = hi
 
     # Call `read` before reading, and `release` after reading.
     # Call `write` before writing, and `release` after writing.
+    # Release in a finally block, or an exception leaves self locked for good.
 
     def read(self):
         # :brief Read lock self.
-        self.lock.acquire(blocking=0)
+        self.lock.read()
 
     def write(self):
         # :brief Write lock self.
-        self.lock.acquire(blocking=1)
+        self.lock.write()
 
     def release(self):
-        # :brief Release any locks.
+        # :brief Release the lock most recently taken with `read` or `write`.
         self.lock.release()
 
     def __str__(self):
         # :brief Print out elements in all queues, for debugging purposes.
         # :return [str] the PendingWork queues as a string
         self.read()
-        re = "\nPendingWork:\n"
-        for qid in self.queues:
-            re = re + qid + ":" + str(self.queues[qid].queue) + "\n"
-        self.release()
+        try:
+            re = "\nPendingWork:\n"
+            for qid in self.queues:
+                with self.host_lock(qid):
+                    queue = self.queues[qid]
+                    re = re + qid + ":" + str(queue.queue if isinstance(queue, UpdateQueue) else queue) + "\n"
+        finally:
+            self.release()
         return re
     
     def get_total_no_of_updates(self):
         # :brief Get self's total_no_of_updates
         # :return [int] the value of total_no_of_updates
-        return self.total_no_of_updates
+        self.read()
+        total = self.total_no_of_updates
+        self.release()
+        return total
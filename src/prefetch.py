@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+from collections import deque
+from threading import Condition, Thread
+
+class PrefetchedMinibatches(object):
+    # PrefetchedMinibatches stands in for list(loader) in Solver.train. A
+    # background thread draws minibatches from the loader into a buffer of
+    # at most capacity minibatches (plus the one it is waiting to add), so
+    # training starts as soon as the first one is ready and the whole
+    # partition is never resident at once.
+    # It is indexed like the list, but only forwards: reading minibatch j
+    # releases every minibatch before j, which can then not be read again.
+    # This class is thread safe.
+
+    def __init__(self, loader, capacity=16):
+        # :brief Create a new PrefetchedMinibatches instance and start prefetching.
+        # :param loader [iterable] a DataLoader or TensorBatchLoader; it must have a len()
+        # :param capacity [int] max no. of minibatches buffered ahead of the reader
+        self.len = len(loader)
+        self.capacity = capacity
+        self.condition = Condition()
+        # The buffered minibatches, which are the last ones loaded
+        self.buffer = deque()
+        # No. of minibatches drawn from the loader so far
+        self.loaded = 0
+        # Minibatches before this index are released and never buffered again
+        self.released = 0
+        # Highest index a reader is waiting for, which may go past capacity
+        self.wanted = -1
+        self.error = None
+        self.stopped = False
+        self.thread = Thread(target=self._run, args=(loader,), daemon=True)
+        self.thread.start()
+
+    def _run(self, loader):
+        # :brief Fill the buffer from the loader until it runs out or close() is called.
+        try:
+            for minibatch in loader:
+                with self.condition:
+                    while len(self.buffer) >= self.capacity and self.loaded > self.wanted and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    self.buffer.append(minibatch)
+                    self.loaded += 1
+                    self._release(self.released)
+                    self.condition.notify_all()
+        except BaseException as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+        with self.condition:
+            # The loader may yield fewer minibatches than it said
+            self.len = self.loaded
+            self.condition.notify_all()
+
+    def _release(self, index):
+        # :brief Drop the minibatches before an index, including ones not loaded yet.
+        # Must be called with self.condition held.
+        self.released = max(self.released, index)
+        while self.buffer and self.loaded - len(self.buffer) < self.released:
+            self.buffer.popleft()
+
+    def _get(self, index, release=True):
+        # :brief Wait for a minibatch.
+        # :param index [int] minibatch index
+        # :param release [bool] release the minibatches before it
+        # :warning raises an IndexError if it is out of range, was released,
+        #   or close() was called
+        # :warning raises whatever the loader raised, if it failed before it
+        with self.condition:
+            if index < self.released or self.stopped:
+                raise IndexError("minibatch %d was already released" % index)
+            if release:
+                self._release(index)
+                self.condition.notify_all()
+            while index >= self.loaded:
+                if index >= self.len:
+                    raise IndexError("minibatch index %d out of range" % index)
+                if self.error is not None:
+                    raise self.error
+                if index > self.wanted:
+                    # Let the loader go past capacity to reach it
+                    self.wanted = index
+                    self.condition.notify_all()
+                self.condition.wait()
+            return self.buffer[index - (self.loaded - len(self.buffer))]
+
+    def __getitem__(self, index):
+        # :brief Get a minibatch, or a list of them for a slice.
+        # A slice holds on to all of its minibatches, and releases the ones before it.
+        # :param index [int or slice] minibatch index, counted from the start of the pass
+        # :return [tuple or array<tuple>] (images, labels) of the minibatch(es)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if start >= stop:
+                return []
+            return [self._get(start)] + [self._get(j, release=False) for j in range(start + step, stop, step)]
+        return self._get(index)
+
+    def __len__(self):
+        # :brief Get the no. of minibatches in the pass.
+        with self.condition:
+            return self.len
+
+    def close(self):
+        # :brief Stop prefetching and drop the buffered minibatches.
+        with self.condition:
+            self.stopped = True
+            self.buffer.clear()
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import torch
+from src.decoder import PendingDecode
+from src.get_weights import inverse_norm
+
+class RunningAggregate(object):
+    # RunningAggregate takes the place of a host's UpdateQueue in PendingWork
+    # when updates are folded in as they arrive (see PendingWork's
+    # running_aggregate). Rather than the updates it keeps what aggregation
+    # needs from them: the sum of their parameters, each scaled by the
+    # unnormalized weight of its metadata (see
+    # DeviceFairnessReceiverState.get_weight), the sum of those weights, and
+    # every host id seen in their metadata. Normalizing by the sum of weights
+    # gives the same result as get_alphas over the individual updates, while
+    # memory stays one model's worth however many arrive.
+    # Updates still being decoded (PendingDecode) are never waited for on the
+    # receiving thread: they are held until a later enqueue finds them
+    # decoded, or until fold_pending on the draining side, so at most the
+    # DecodePool's in-flight payloads are held besides the sums.
+    # Like UpdateQueue, len counts the updates in it. This class is not
+    # thread safe.
+
+    def __init__(self, weight_fn=inverse_norm):
+        # :brief Create a new, empty RunningAggregate instance.
+        # :param weight_fn [function] maps an update's metadata values to its
+        #   unnormalized weight
+        self.weight_fn = weight_fn
+        self.pending = []
+        self.weighted_sum = {}
+        self.total_weight = 0.0
+        self.host_ids = set()
+        self.len = 0
+        self.nbytes = 0
+
+    def enqueue(self, update):
+        # :brief Fold an update into the aggregate, or hold it until it is decoded.
+        # Never waits for a decode.
+        # :param update [ModelUpdate] a received update, or a PendingDecode of one
+        if isinstance(update, PendingDecode):
+            self.pending.append(update)
+            self.nbytes += update.nbytes
+        else:
+            self._fold(update)
+        self.len += 1
+        self._fold_decoded()
+
+    def fold_pending(self):
+        # :brief Fold in every held update, waiting for those still being decoded.
+        # :warning raises a MalformedUpdateError if a held payload could not be decoded;
+        #   that update is dropped
+        while len(self.pending) > 0:
+            item = self.pending.pop(0)
+            self.nbytes -= item.nbytes
+            self._fold(item.result())
+
+    def _fold_decoded(self):
+        # :brief Fold in the held updates that have finished decoding.
+        # A failed decode stays held, so it is raised by fold_pending on the
+        # draining side rather than on the receiving thread.
+        done, held = [], []
+        for item in self.pending:
+            if item.done() and item.future.exception() is None:
+                done.append(item)
+            else:
+                held.append(item)
+        self.pending = held
+        for item in done:
+            self.nbytes -= item.nbytes
+            self._fold(item.result())
+
+    def _fold(self, update):
+        # :brief Add a decoded update to the sums.
+        metadata = update.update_metadata
+        weight = self.weight_fn(metadata.values())
+        with torch.no_grad():
+            for key, params in update.updates.items():
+                params = torch.as_tensor(params)
+                if key in self.weighted_sum:
+                    self.weighted_sum[key].add_(params, alpha=weight)
+                else:
+                    # A new tensor, so the update's buffer can be freed
+                    self.weighted_sum[key] = params.to(torch.float32) * weight
+                    self.nbytes += self.weighted_sum[key].numel() * self.weighted_sum[key].element_size()
+        self.total_weight += weight
+        self.host_ids.update(metadata.keys())
+
+    def take(self):
+        # :brief Move everything enqueued so far to a new aggregate, leaving this one empty.
+        # Held updates are moved as they are; call fold_pending on the new aggregate.
+        # :return [RunningAggregate] the new aggregate
+        ret = RunningAggregate(self.weight_fn)
+        ret.pending = self.pending
+        ret.weighted_sum, ret.total_weight, ret.host_ids = self.weighted_sum, self.total_weight, self.host_ids
+        ret.len, ret.nbytes = self.len, self.nbytes
+        self.clear()
+        return ret
+
+    def dequeue(self):
+        # :warning always raises a RuntimeError; use PendingWork.take_aggregate
+        raise RuntimeError("a running aggregate holds no individual updates")
+
+    def peek(self):
+        # :warning always raises a RuntimeError; use PendingWork.take_aggregate
+        raise RuntimeError("a running aggregate holds no individual updates")
+
+    def clear(self):
+        self.pending = []
+        self.weighted_sum = {}
+        self.total_weight = 0.0
+        self.host_ids = set()
+        self.len = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        # :brief Get the no. of updates folded into the aggregate.
+        return self.len
+
+    def __repr__(self):
+        return "RunningAggregate(%d updates, weight %f)" % (self.len, self.total_weight)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+from threading import Condition, Lock, get_ident
+
+class RWLock(object):
+    # RWLock is a reader-writer lock: any number of threads may hold it
+    # for reading, or exactly one for writing. Waiting writers go first, so
+    # a steady stream of readers cannot starve them.
+    # It is reentrant: a thread holding the lock for writing may take it
+    # again for reading or writing, and a reader may take it again for
+    # reading. Upgrading a read lock to a write lock is not supported.
+
+    def __init__(self):
+        # :brief Create a new RWLock instance.
+        self.mutex = Lock()
+        self.condition = Condition(self.mutex)
+        self.writer = None
+        self.writers_waiting = 0
+        # Maps a thread id to the stack of locks it holds, 'r' or 'w',
+        # so release() knows what to give back
+        self.held = {}
+        self.num_readers = 0
+
+    def read(self):
+        # :brief Acquire the lock for reading.
+        me = get_ident()
+        with self.mutex:
+            held = self.held.get(me)
+            if held:
+                # Reentrant: nest inside whatever this thread already holds
+                held.append(held[-1] if self.writer == me else 'r')
+                if held[-1] == 'r':
+                    self.num_readers += 1
+                return
+            while self.writer is not None or self.writers_waiting > 0:
+                self.condition.wait()
+            self.num_readers += 1
+            self.held[me] = ['r']
+
+    def write(self):
+        # :brief Acquire the lock for writing.
+        # :warning raises a RuntimeError if the thread holds a read lock
+        me = get_ident()
+        with self.mutex:
+            if self.writer == me:
+                self.held[me].append('w')
+                return
+            if me in self.held:
+                raise RuntimeError("cannot upgrade a read lock to a write lock")
+            self.writers_waiting += 1
+            while self.writer is not None or self.num_readers > 0:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = me
+            self.held[me] = ['w']
+
+    def release(self):
+        # :brief Release the lock most recently acquired by this thread.
+        # :warning raises a RuntimeError if the thread does not hold the lock
+        me = get_ident()
+        with self.mutex:
+            held = self.held.get(me)
+            if not held:
+                raise RuntimeError("cannot release un-acquired lock")
+            kind = held.pop()
+            if kind == 'r':
+                self.num_readers -= 1
+            if held:
+                return
+            del self.held[me]
+            if kind == 'w':
+                self.writer = None
+                self.condition.notify_all()
+            elif self.num_readers == 0 and self.writers_waiting > 0:
+                self.condition.notify_all()
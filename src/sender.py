@@ -1,14 +1,35 @@
-from threading import RLock, Event, Condition, Thread
+from threading import RLock, Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
 from src.util import EmptyQueueError, DevicePushbackError
 from src.updatequeue import UpdateQueue
+from src.update_metadata.model_update import ModelUpdate
+
+# Model updates go out as the raw request body, so the sender id travels in a header
+SENDER_HEADER = 'X-Sender'
+# Receivers answer with the no. of updates the sender may still send them
+# (see PendingWork.credits); no header means there is no limit
+CREDITS_HEADER = 'X-Credits'
+# Seconds between two sends to a peer that is keeping up
+BASE_WAIT_TIME = .1
 
 class Sender(object):
-    def __init__(self, k):
+    def __init__(self, k, pool_size=1, idle_timeout=30, max_batch_bytes=16 * 1024 * 1024, max_wait_time=5, max_server_errors=5):
         # :brief Create a new Sender instance.
+        # :param pool_size [int] max keep-alive connections kept open to each peer
+        # :param idle_timeout [float] seconds a peer's connections may sit unused
+        #   before they are dropped and reopened on the next send
+        # :param max_batch_bytes [int] model updates queued for a peer are sent
+        #   together in one request of at most this many bytes
+        # :param max_wait_time [float] cap on the seconds between sends to a
+        #   failing peer; failures double the wait up to it
+        # :param max_server_errors [int] no. of 5xx in a row after which the
+        #   items sent are given up on like a 4xx
         self.lock = RLock()
         self.my_host = None
         self.other_hosts = None
@@ -19,30 +40,63 @@ class Sender(object):
         self.last_sent_times = {}
         self.wait_times = {}
         self.host_locks = {}
+        # Maps a host to the no. of updates it last said we may send it, or
+        # None if unlimited. Only touched by the host's send coroutine.
+        self.credits = {}
+        # Maps a host to the no. of queued items still to be sent one per
+        # request because a batch of them was rejected. Only touched by the
+        # host's send coroutine.
+        self.send_singly = {}
+        # Maps a host to the no. of 5xx it answered in a row. Only touched by
+        # the host's send coroutine.
+        self.server_errors = {}
+        self.max_wait_time = max_wait_time
+        self.max_server_errors = max_server_errors
+        # Hosts whose queues keep only the newest unsent model update
+        self.coalescing_hosts = set()
         # Includes both the queues for other_hosts and other_leaders
         self.queues = {}
         self.total_no_of_updates = 0 
         self.min_queue_len = None
         self.k = k
-        self.condition = Condition()
+        # Send engine state, created by run(). Each peer has its own coroutine
+        # that sleeps on its wakeup event until something is queued for it.
+        self.loop = None
+        self.executor = None
+        self.thread = None
+        self.wakeups = {}
+        self.pool_size = pool_size
+        self.max_batch_bytes = max_batch_bytes
+        self.idle_timeout = idle_timeout
+        # One keep-alive session per peer, reused across _update_host calls
+        self.sessions = {}
+        self.session_last_used = {}
 
-    def setup(self, my_host, other_hosts, other_leaders):
+    def setup(self, my_host, other_hosts, other_leaders, coalescing_hosts = []):
         # :brief Set up a queue for each host.
         # :param my_host [str] an id for this server
         # :param other_hosts [array<str>] the id of the other hosts
+        # :param coalescing_hosts [array<str>] hosts that only need the latest
+        #   model update: a newer update replaces an unsent one still queued
+        #   for them (see enqueue)
         self.my_host = my_host
         self.other_hosts = other_hosts
         self.other_leaders = other_leaders
+        self.coalescing_hosts = set(coalescing_hosts)
         self.num_devices = 1 + len(other_hosts) + len(other_leaders)
         self.write()
-        self.wait_times[my_host] = .1
+        self.wait_times[my_host] = BASE_WAIT_TIME
         self.last_sent_times[my_host] = 0
         self.host_locks[my_host] = RLock()
         for host in other_hosts + other_leaders:
             self.queues[host] = UpdateQueue()
-            self.wait_times[host] = .1
+            self.wait_times[host] = BASE_WAIT_TIME
             self.last_sent_times[host] = 0
             self.host_locks[host] = RLock()
+            self.wakeups[host] = asyncio.Event()
+            self.credits[host] = None
+            self.send_singly[host] = 0
+            self.server_errors[host] = 0
         self.release()
     
     def dequeue_every_queue(self):
@@ -50,51 +104,118 @@ class Sender(object):
         # :return nothing
         self.write()
         for queue in self.queues:
-            self.total_no_of_updates -= len(self.queues[queue])
+            self._add_to_total(-len(self.queues[queue]))
             self.queues[queue].clear()
         self.release()
         return
 
-    def enqueue(self, update, other_leaders = False):
+    def enqueue(self, update, other_leaders = False, latest_only = False):
         # :brief Add an update to hosts in same cluster if False.
         # Add the update to other_leaders if flag is set as True.
         # :param update [Object] a model update that needs to be processed
         # :param host [str] the id for the host that generated the update
+        # :param latest_only [bool] replace an unsent model update queued for
+        #   any host, as if every host were coalescing (see _coalesce)
         queues = self.other_leaders if other_leaders else self.other_hosts 
         
         for host in queues:
            #  print("SEND TO", host)
             self.write_host(host)
             queue = self.queues[host]
+            if self._coalesce(host, queue, update, latest_only):
+                self.release_host(host)
+                continue
             if self.min_queue_len != None:
                 if queue.len > self.k * self.min_queue_len:
                     self.release_host(host)
                     raise DevicePushbackError("could not enqueue new update")
             queue.enqueue(update)
-            self.total_no_of_updates += 1
+            self._add_to_total(1)
             self._update_min_and_max()
             self.release_host(host)
-        # Enqueuing notifies the sender thread
-        with self.condition:
-            self.condition.notify()
-            # print("ML THREAD WOKE UP SENDER THREAD")
-    
+            # Enqueuing wakes up that host's coroutine in the send engine
+            self._wake(host)
+
+    def _coalesce(self, host, queue, update, latest_only=False):
+        # :brief Replace the newest queued model update of a coalescing host.
+        # Only the tail is ever replaced, so control messages keep their place
+        # and the queue never holds two model updates in a row.
+        # Requires that the host already be locked.
+        # :param latest_only [bool] coalesce even if the host is not coalescing
+        # :return [bool] True if update took the place of a queued one
+        if (host not in self.coalescing_hosts and not latest_only) or not isinstance(update, bytes):
+            return False
+        if not self._has_unsent_update(queue):
+            return False
+        queue.replace_last(update)
+        return True
+
+    def needs_update(self, other_leaders = False):
+        # :brief Check if some host has no unsent model update at the end of its queue.
+        # :param other_leaders [bool] check other_leaders instead of the hosts in our cluster
+        # :return [bool] True if an update enqueued now would not just replace queued ones
+        for host in (self.other_leaders if other_leaders else self.other_hosts):
+            self.write_host(host)
+            unsent = self._has_unsent_update(self.queues[host])
+            self.release_host(host)
+            if not unsent:
+                return True
+        return False
+
+    def _has_unsent_update(self, queue):
+        # :brief Check if a queue ends in a model update.
+        # Requires that the host already be locked.
+        return queue.len > 0 and isinstance(queue.peek_last(), bytes)
+
     def run(self):
-        # :brief Spawn a new thread and begin sending update requests to other devices
-        t = Thread(target=self._actually_run)
-        t.start()
+        # :brief Spawn a new thread running the send engine's event loop
+        # and begin sending update requests to other devices
+        self.loop = asyncio.new_event_loop()
+        # One worker per peer, so requests to different peers can be in flight together
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.queues)))
+        self.thread = Thread(target=self._actually_run, daemon=True)
+        self.thread.start()
 
     def _actually_run(self):
-        # :brief Send updates to peers when possible.
+        # :brief Run one send coroutine per peer until close() stops the loop.
+        asyncio.set_event_loop(self.loop)
+        tasks = [self.loop.create_task(self._send_to(host)) for host in self.queues]
+        self.loop.run_forever()
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    async def _send_to(self, host):
+        # :brief Send a peer's queued updates, one request at a time.
+        # The coroutine sleeps until something is queued and then until the
+        # peer's backoff window (last_sent_times + wait_times) has passed, so
+        # no CPU is spent while there is nothing that may be sent.
+        queue = self.queues[host]
+        wakeup = self.wakeups[host]
         while True:
-            if self.total_no_of_updates > 0:
-                for host in self.queues:
-                    self._update_host(host)
-            else:
-                with self.condition:
-                    # print("SENDER THREAD SLEEPING")
-                    self.condition.wait()
-                # print("SENDER THREAD WOKE UP FROM ML THREAD")
+            if len(queue) == 0:
+                # enqueue sets the event from the loop thread, so clearing
+                # and checking here cannot miss a wakeup
+                wakeup.clear()
+                if len(queue) == 0:
+                    await wakeup.wait()
+                continue
+            delay = self.last_sent_times[host] + self.wait_times[host] - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self.loop.run_in_executor(self.executor, self._update_host, host)
+
+    def _wake(self, host):
+        # :brief Wake up the send coroutine of a host. Safe to call from any thread.
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeups[host].set)
+
+    def _add_to_total(self, n):
+        # :brief Adjust total_no_of_updates; enqueue and the send workers race on it.
+        with self.lock:
+            self.total_no_of_updates += n
     
     # TODO (GS): To update min_queue_len after each enqueue and dequeue
     def _update_min_and_max(self):
@@ -106,29 +227,171 @@ class Sender(object):
         # popped from that hosts queue.
         if time.time() < self.last_sent_times[host] + self.wait_times[host]:
             return
-        self.read_host(host)
+        # Only the dequeue holds the host lock, so enqueue never waits on the network.
+        # The rest is touched by this host's send coroutine alone.
+        self.write_host(host)
         queue = self.queues[host]
-        update = None
-        try:
-            update = queue.dequeue()
-            self.total_no_of_updates -= 1
-        except EmptyQueueError:
+        if self.credits[host] == 0 and len(queue) > 0 and isinstance(queue.peek(), bytes):
             self.release_host(host)
+            # Out of credits: ask for more rather than sending updates the
+            # peer would push back. Control messages still go through.
+            self._poll_credits(host)
             return
-        if 'CLEAR' in update:
-            res = requests.post("http://" + host + "/clear_all_queues", json={"sender": self.my_host, "epoch": update['epoch']})
-        elif 'CLOSE' in update:
-                        res = requests.post("http://" + host + "/close", json={"sender": self.my_host})
-        else:
-            res = requests.post("http://" + host + "/send_update", json={"sender": self.my_host, "update": update})
-        if res.status_code >= 400 and res.status_code < 500:
-            self.wait_times[host] *= 2
-            self.release_host(host)
+        max_count = 1 if self.send_singly[host] > 0 else self.credits[host]
+        batch = self._dequeue_batch(queue, max_count)
+        self.release_host(host)
+        if len(batch) == 0:
             return
+        self._add_to_total(-len(batch))
+        retry = False
+        try:
+            if len(batch) == 1:
+                res = self._post_update(host, batch[0])
+            else:
+                res = self._post_batch(host, batch)
+            if isinstance(batch[0], bytes):
+                self._read_credits(host, res)
+            # A 429 means we ran out of credits, a 5xx that the peer failed;
+            # either way the updates were not taken and are sent again later
+            retry = res.status_code == 429 or res.status_code >= 500
+            failed = res.status_code >= 400 and res.status_code != 429
+            self.server_errors[host] = self.server_errors[host] + 1 if res.status_code >= 500 else 0
+            if self.server_errors[host] > self.max_server_errors:
+                # Resending would likely fail forever and hold up the rest of
+                # the queue: give up on these items as on a 4xx
+                retry = False
+                self.server_errors[host] = 0
+        except requests.RequestException:
+            # Peer is down or unreachable: keep the items, control messages
+            # included, to send again once it is back, and back off the same way
+            retry = True
+            failed = True
         self.last_sent_times[host] = time.time()
-        self.wait_times[host] = max(0.1, self.wait_times[host] - .1)
+        if failed and not retry and len(batch) > 1:
+            # A 4xx for a batch refuses all of it, maybe for one bad update:
+            # resend its updates one at a time so only that one is dropped
+            retry = True
+            self.send_singly[host] = len(batch)
+        elif not retry and self.send_singly[host] > 0:
+            self.send_singly[host] -= 1
+        if retry:
+            self._requeue(host, batch)
+        if failed:
+            self.wait_times[host] = min(self.wait_times[host] * 2, self.max_wait_time)
+            return
+        self.wait_times[host] = BASE_WAIT_TIME
         self._update_min_and_max()
-        self.release_host(host)     
+
+    def _read_credits(self, host, res):
+        # :brief Remember the credits a peer advertised in a response.
+        # :param res [requests.Response] the peer's response to an update
+        credits = res.headers.get(CREDITS_HEADER)
+        if credits is not None:
+            self.credits[host] = int(credits)
+        elif res.status_code == 429:
+            self.credits[host] = 0
+        elif res.status_code < 400:
+            self.credits[host] = None
+
+    def _poll_credits(self, host):
+        # :brief Ask a peer that gave us no credits whether it has room again.
+        # Polls are spaced like sends, by the host's wait time.
+        try:
+            res = self._session(host).get("http://" + host + "/credits", headers={
+                SENDER_HEADER: self.my_host})
+            self._read_credits(host, res)
+        except requests.RequestException:
+            pass
+        self.last_sent_times[host] = time.time()
+
+    def _requeue(self, host, batch):
+        # :brief Put items a peer did not take back at the front of its queue.
+        # A coalescing host's bounced model update is dropped if a newer one
+        # was queued meanwhile.
+        self.write_host(host)
+        queue = self.queues[host]
+        if host in self.coalescing_hosts and len(queue) > 0 and isinstance(queue.peek(), bytes):
+            batch = [update for update in batch if not isinstance(update, bytes)]
+        for update in reversed(batch):
+            queue.push_front(update)
+        self._add_to_total(len(batch))
+        self.release_host(host)
+
+    def _dequeue_batch(self, queue, max_count=None):
+        # :brief Pop the next item of a queue, plus the model updates right
+        # behind it while they fit in max_batch_bytes.
+        # Requires that the host already be locked.
+        # :param max_count [int] max no. of model updates to pop; no limit if None
+        # :return [array<Object>] the popped items, empty if the queue was empty
+        try:
+            batch = [queue.dequeue()]
+        except EmptyQueueError:
+            return []
+        if not isinstance(batch[0], bytes):
+            return batch
+        size = len(batch[0])
+        while len(queue) > 0 and (max_count is None or len(batch) < max_count):
+            update = queue.peek()
+            if not isinstance(update, bytes) or size + len(update) > self.max_batch_bytes:
+                break
+            batch.append(queue.dequeue())
+            size += len(update)
+        return batch
+
+    def _post_batch(self, host, updates):
+        # :brief Send several encoded model updates to a peer in one request.
+        # :return [requests.Response] the peer's response
+        return self._post(host, "/send_updates", data=ModelUpdate.pack_batch(updates), headers={
+            SENDER_HEADER: self.my_host,
+            'Content-Type': 'application/octet-stream'})
+
+    def _post_update(self, host, update):
+        # :brief Send one queued item to a peer.
+        # :return [requests.Response] the peer's response
+        # Control messages are dicts, model updates are bytes
+        if isinstance(update, dict) and 'CLEAR' in update:
+            return self._post(host, "/clear_all_queues", json={"sender": self.my_host, "epoch": update['epoch']})
+        if isinstance(update, dict) and 'CLOSE' in update:
+            return self._post(host, "/close", json={"sender": self.my_host})
+        # update is already encoded (ModelUpdate.to_bytes), send it as is
+        return self._post(host, "/send_update", data=update, headers={
+            SENDER_HEADER: self.my_host,
+            'Content-Type': 'application/octet-stream'})
+
+    def _post(self, host, path, **kwargs):
+        # :brief POST to a peer over its pooled keep-alive connection.
+        # :param host [str] the id of the peer
+        # :param path [str] the endpoint on the peer, e.g. "/send_update"
+        # :return [requests.Response] the peer's response
+        return self._session(host).post("http://" + host + path, **kwargs)
+
+    def _session(self, host):
+        # :brief Get the keep-alive session for a peer, replacing it if it has
+        # been idle for longer than idle_timeout.
+        # Only called from the host's own send coroutine.
+        now = time.time()
+        session = self.sessions.get(host)
+        if session is not None and now - self.session_last_used[host] > self.idle_timeout:
+            session.close()
+            session = None
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            self.sessions[host] = session
+        self.session_last_used[host] = now
+        return session
+
+    def close(self):
+        # :brief Stop the send engine and close the keep-alive connections to every peer.
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.executor.shutdown()
+            self.thread = None
+        for host in list(self.sessions):
+            self.sessions.pop(host).close()
+
     # Call `read` before reading, and `release` after reading.
     # Call `write` before writing, and `release` after writing.
 
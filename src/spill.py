@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+import mmap
+import os
+import tempfile
+from src.update_metadata.model_update import ModelUpdate
+
+class SpilledUpdate(object):
+    # SpilledUpdate stands in for a queued ModelUpdate whose payload was
+    # moved out of RAM into a file on local disk (see spill). It holds no
+    # payload bytes itself, so it counts as 0 bytes in an UpdateQueue.
+    nbytes = 0
+
+    def __init__(self, path, size):
+        # :brief Create a new SpilledUpdate instance.
+        # :param path [str] the file holding the encoded update
+        # :param size [int] the no. of bytes in the file
+        self.path = path
+        self.size = size
+
+    def read(self):
+        # :brief Page the update back in, keeping its file.
+        # The file is memory mapped copy-on-write, so the returned tensors
+        # are views into the mapping and pages are only read when touched.
+        # The mapping outlives the file and is unmapped once the tensors are
+        # garbage collected.
+        # :return [ModelUpdate] the update that was spilled
+        with open(self.path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_COPY)
+        return ModelUpdate.from_bytes(buf)
+
+    def load(self):
+        # :brief Page the update back in and delete its file.
+        # :return [ModelUpdate] the update that was spilled
+        update = self.read()
+        self.discard()
+        return update
+
+    def discard(self):
+        # :brief Delete the update's file without loading it.
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return "SpilledUpdate(%r)" % self.path
+
+def spill(update, spill_dir=None):
+    # :brief Write an update to a file on local disk.
+    # :param update [ModelUpdate] the update to move out of RAM
+    # :param spill_dir [str] directory for the file; the system temp dir if None
+    # :return [SpilledUpdate] a placeholder to queue in place of the update
+    data = update.to_bytes()
+    fd, path = tempfile.mkstemp(prefix='update-', suffix='.spill', dir=spill_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return SpilledUpdate(path, len(data))
+
+def unspill(item):
+    # :brief Page an item back in if it was spilled.
+    # :param item [Object] an item dequeued from an UpdateQueue
+    # :return [Object] the item itself, or the update it stands in for
+    if isinstance(item, SpilledUpdate):
+        return item.load()
+    return item
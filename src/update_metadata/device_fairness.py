@@ -1,7 +1,9 @@
+import itertools
+import numpy as np
 from src.util import ExtraFatal
 from src.update_metadata.update_fairness_interface import UpdateMetadata, UpdateReceiverState
 from src.update_metadata.model_update import ModelUpdate
-from src.get_weights import get_weights
+from src.get_weights import get_weights, inverse_norm, SMALL_INPUT_ENTRIES
 
 class DeviceFairnessUpdateMetadata(UpdateMetadata):
     # :brief Store metadata for an update to guarantee device-based fairness
@@ -42,14 +44,15 @@ class DeviceFairnessReceiverState(UpdateReceiverState):
     # :param alphas [list[float]]
     # :param vectors [list[list[float]]]
     def fairness_fn(self, alphas, dicts, thresh):
-        temp = {}
-        for d, alpha in zip(dicts, alphas):
-            for key, val in d.items():
-                if key not in temp:
-                    temp[key] = val * alpha
-                else:
-                    temp[key] += val * alpha
-        return self.fairness_for_one_vec(temp.values(), thresh)
+        if sum(len(d) for d in dicts) < SMALL_INPUT_ENTRIES:
+            temp = {}
+            for d, alpha in zip(dicts, alphas):
+                for key, val in d.items():
+                    temp[key] = temp.get(key, 0) + val * alpha
+            return self.fairness_for_one_vec(temp.values(), thresh)
+        keys = list(dict.fromkeys(key for d in dicts for key in d))
+        temp = np.asarray(alphas, dtype=np.float64) @ self.metadata_matrix(dicts, keys)
+        return self.fairness_for_one_vec(temp, thresh)
 
     # :returns 
     #    - alphas [array<float>]
@@ -59,17 +62,48 @@ class DeviceFairnessReceiverState(UpdateReceiverState):
         # Our method
         return get_weights(v)
 
+    # :brief Unnormalized weight of one update, for summing updates as they
+    #   arrive (see RunningAggregate). Normalizing these over a set of updates
+    #   must give get_alphas, so switch both together.
+    # :param v [array<float>] an update's metadata vector
+    # :returns [float] the weight
+    def get_weight(self, v):
+        # The Federated AVG
+        # return 1.0
+        # Our method
+        return inverse_norm(v)
+
     def flatten_metadata(self, metadata_list, host_id_list):
-        v = []
-        for metadata in metadata_list:
-            v_i = []
-            for host_id in host_id_list:
-                if host_id in metadata:
-                    v_i.append(metadata[host_id])
-                else:
-                    v_i.append(0)
-            v.append(v_i)
-        return v
+        v = self.metadata_vectors(metadata_list, host_id_list)
+        return v if isinstance(v, list) else v.tolist()
+
+    # :brief Metadata vectors for get_alphas: flatten_metadata's lists for a
+    #   few updates and hosts, where they are cheapest, else metadata_matrix
+    # :returns [list[list[float]] or np.ndarray] one row per update
+    def metadata_vectors(self, metadata_list, host_id_list):
+        if len(metadata_list) * len(host_id_list) >= SMALL_INPUT_ENTRIES:
+            return self.metadata_matrix(metadata_list, host_id_list)
+        return [[metadata.get(host_id, 0) for host_id in host_id_list] for metadata in metadata_list]
+
+    # :brief Array version of flatten_metadata, for get_alphas on many updates and hosts
+    # :param metadata_list [list[dict<str, float>]] metadata of every update
+    # :param host_id_list [list[str]] the hosts to lay out, in column order
+    # :returns [np.ndarray] (updates x hosts) matrix, 0 where an update has no entry for a host
+    def metadata_matrix(self, metadata_list, host_id_list):
+        column = {host_id: j for j, host_id in enumerate(host_id_list)}.get
+        lengths = [len(metadata) for metadata in metadata_list]
+        count = sum(lengths)
+        # Scatter every (update, host, value) entry at once; hosts not in
+        # host_id_list get column -1 and are dropped
+        cols = np.fromiter(map(column, (host_id for metadata in metadata_list for host_id in metadata),
+            itertools.repeat(-1)), dtype=np.intp, count=count)
+        vals = np.fromiter((val for metadata in metadata_list for val in metadata.values()),
+            dtype=np.float64, count=count)
+        rows = np.repeat(np.arange(len(metadata_list)), lengths)
+        keep = cols >= 0
+        m = np.zeros((len(metadata_list), len(host_id_list)))
+        m[rows[keep], cols[keep]] = vals[keep]
+        return m
 
     # :brief Checks if we can backprop. Relies only on internal state.
     def check_fairness_before_backprop(self) -> bool:
@@ -1,14 +1,45 @@
 import json
+import struct
+import warnings
+import numpy as np
 import torch
+from src.aggregation import flat_view
+from src.util import MalformedUpdateError
+
+# Binary wire format (see ModelUpdate.to_bytes):
+#   prefix   [12 bytes]  magic b'MUPD', u8 version, 3 pad bytes, u32 header length
+#   header   [n bytes]   utf-8 json: update_metadata and (key, shape) of every tensor,
+#                        padded with spaces so the data region is 8-byte aligned
+#   data     [4*m bytes] every tensor as little-endian float32, back to back in header order
+WIRE_MAGIC = b'MUPD'
+WIRE_VERSION = 1
+WIRE_PREFIX = struct.Struct('<4sB3xI')
+WIRE_DTYPE = np.dtype('<f4')
+WIRE_ALIGNMENT = 8
+
+# Batch of encoded updates (see ModelUpdate.pack_batch):
+#   prefix   [12 bytes]  magic b'MUPB', u8 version, 3 pad bytes, u32 no. of updates
+#   lengths  [8*n bytes] u64 length of every update
+#   updates  every update, each padded to WIRE_ALIGNMENT so its data region stays aligned
+BATCH_MAGIC = b'MUPB'
+BATCH_PREFIX = struct.Struct('<4sB3xI')
 
 class ModelUpdate(object):
-    def __init__(self, updates, update_metadata):
+    def __init__(self, updates, update_metadata, flat=None):
         # :brief Store a model update sent by a device from its local data
-        # :param updates [dict<int, torch.tensor>] maps the int i-th module of the network to the 
+        # :param updates [dict<int, torch.tensor>] maps the int i-th module of the network to the
         #     gradient update. Only int needed because all devices have same network arch
         # :param update_metadata [dict] arbitrary dict
+        # :param flat [torch.tensor] optional 1-d tensor holding every tensor in
+        #     updates back to back, which are views into it
         self.updates = updates
         self.update_metadata = update_metadata
+        self.flat = flat
+
+    @property
+    def nbytes(self):
+        # :brief No. of bytes held by the update's tensors
+        return sum(v.numel() * v.element_size() for v in self.updates.values() if torch.is_tensor(v))
 
     def to_json(self):
         # :brief Converts current object into a json representation
@@ -17,9 +48,135 @@ class ModelUpdate(object):
             'update_metadata': self.update_metadata
         })
 
+    def to_bytes(self):
+        # :brief Converts current object into the binary wire format.
+        # The tensors are read through numpy views, so the only copy of the
+        # parameters is the one into the returned buffer. Tensors that lie back
+        # to back in memory (e.g. the parameters of a Net) are copied in one go.
+        # :return [bytes] the encoded update
+        keys = [str(k) for k in self.updates]
+        tensors = [self.updates[k].data for k in self.updates]
+        header = json.dumps({
+            'update_metadata': self.update_metadata,
+            'tensors': [[k, list(t.shape)] for k, t in zip(keys, tensors)]
+        }).encode('utf-8')
+        header += b' ' * (-(WIRE_PREFIX.size + len(header)) % WIRE_ALIGNMENT)
+        chunks = [WIRE_PREFIX.pack(WIRE_MAGIC, WIRE_VERSION, len(header)), header]
+        flat = flat_view(tensors) if len(tensors) > 0 else None
+        if flat is not None:
+            tensors = [flat]
+        for a in (t.cpu().contiguous().numpy() for t in tensors):
+            if a.dtype != WIRE_DTYPE:
+                a = a.astype(WIRE_DTYPE)
+            chunks.append(memoryview(a).cast('B'))
+        return b''.join(chunks)
+
+    @staticmethod
+    def from_bytes(buf):
+        # :brief Converts the binary wire format back into an object.
+        # The returned tensors are views into buf, nothing is copied. If buf is
+        # read-only (e.g. bytes) the tensors must not be written to.
+        # :param buf [bytes-like] an update encoded by ModelUpdate.to_bytes
+        # :return [ModelUpdate] the decoded update
+        # :warning raises a MalformedUpdateError if buf is not in the wire format
+        header, data_offset, count = ModelUpdate._read_header(buf)
+        with warnings.catch_warnings():
+            # Torch warns about views of read-only buffers; see the note above
+            warnings.simplefilter('ignore', UserWarning)
+            flat = torch.from_numpy(np.frombuffer(buf, dtype=WIRE_DTYPE, count=count, offset=data_offset))
+        updates = {}
+        start = 0
+        for key, shape in header['tensors']:
+            numel = int(np.prod(shape, dtype=np.int64))
+            updates[key] = flat[start:start + numel].view(shape)
+            start += numel
+        return ModelUpdate(updates, header['update_metadata'], flat)
+
+    @staticmethod
+    def check_bytes(buf):
+        # :brief Check that a buffer holds a well-formed encoded update: its
+        # prefix, its header, and a data region as long as the header says.
+        # Only the small header is parsed, the data is not read.
+        # :param buf [bytes-like] a buffer that should hold an encoded update
+        # :return [int] the length of the update's header
+        # :warning raises a MalformedUpdateError if buf is not in the wire format
+        return ModelUpdate._read_header(buf)[1] - WIRE_PREFIX.size
+
+    @staticmethod
+    def _read_header(buf):
+        # :brief Parse and validate the prefix and header of an encoded update.
+        # :param buf [bytes-like] a buffer that should hold an encoded update
+        # :return [tuple] (header [dict], offset of the data region [int],
+        #   no. of floats in the data region [int])
+        # :warning raises a MalformedUpdateError if buf is not in the wire format
+        if len(buf) < WIRE_PREFIX.size:
+            raise MalformedUpdateError("model update is too short")
+        magic, version, header_len = WIRE_PREFIX.unpack_from(buf, 0)
+        if magic != WIRE_MAGIC or version != WIRE_VERSION:
+            raise MalformedUpdateError("unknown model update format")
+        data_offset = WIRE_PREFIX.size + header_len
+        if data_offset > len(buf):
+            raise MalformedUpdateError("model update header is truncated")
+        try:
+            header = json.loads(bytes(memoryview(buf)[WIRE_PREFIX.size:data_offset]).decode('utf-8'))
+            metadata, tensors = header['update_metadata'], header['tensors']
+            numel = 0
+            for key, shape in tensors:
+                if not isinstance(key, str) or not all(isinstance(d, int) and d >= 0 for d in shape):
+                    raise MalformedUpdateError("bad tensor in model update header")
+                numel += int(np.prod(shape, dtype=np.int64))
+        except MalformedUpdateError:
+            raise
+        except (ValueError, KeyError, TypeError) as e:
+            # Includes bad utf-8 and bad json, both ValueErrors
+            raise MalformedUpdateError("bad model update header") from e
+        if not isinstance(metadata, dict):
+            raise MalformedUpdateError("bad model update metadata")
+        if len(buf) - data_offset != numel * WIRE_DTYPE.itemsize:
+            raise MalformedUpdateError("model update data does not match its header")
+        return header, data_offset, numel
+
+    @staticmethod
+    def pack_batch(payloads):
+        # :brief Pack several encoded updates into one buffer.
+        # :param payloads [array<bytes>] updates encoded by ModelUpdate.to_bytes
+        # :return [bytes] the packed batch
+        chunks = [BATCH_PREFIX.pack(BATCH_MAGIC, WIRE_VERSION, len(payloads))]
+        chunks.append(struct.pack('<%dQ' % len(payloads), *[len(p) for p in payloads]))
+        for p in payloads:
+            chunks.append(p)
+            chunks.append(b'\0' * (-len(p) % WIRE_ALIGNMENT))
+        return b''.join(chunks)
+
+    @staticmethod
+    def unpack_batch(buf):
+        # :brief Split a buffer packed by ModelUpdate.pack_batch without copying it.
+        # :param buf [bytes-like] the packed batch
+        # :return [array<memoryview>] every encoded update, in order
+        # :warning raises a MalformedUpdateError if buf is not a packed batch
+        if len(buf) < BATCH_PREFIX.size:
+            raise MalformedUpdateError("model update batch is too short")
+        magic, version, count = BATCH_PREFIX.unpack_from(buf, 0)
+        if magic != BATCH_MAGIC or version != WIRE_VERSION:
+            raise MalformedUpdateError("unknown model update batch format")
+        try:
+            lengths = struct.unpack_from('<%dQ' % count, buf, BATCH_PREFIX.size)
+        except struct.error as e:
+            raise MalformedUpdateError("model update batch is truncated") from e
+        view = memoryview(buf)
+        start = BATCH_PREFIX.size + 8 * count
+        payloads = []
+        for length in lengths:
+            if start + length > len(buf):
+                raise MalformedUpdateError("model update batch is truncated")
+            payloads.append(view[start:start + length])
+            start += length + (-length % WIRE_ALIGNMENT)
+        return payloads
+
     @staticmethod
     def from_dict(d):
         # :brief Converts dict version of model update into an object form
         model_update_obj = d
-        model_update_obj.updates = {k: torch.Tensor(v) for k,v in model_update_obj.updates.items()}
+        # Updates decoded from the wire format already hold tensors
+        model_update_obj.updates = {k: v if torch.is_tensor(v) else torch.Tensor(v) for k,v in model_update_obj.updates.items()}
         return model_update_obj
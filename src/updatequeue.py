@@ -1,20 +1,43 @@
 #!/usr/bin/python3
+from collections import deque
 from src.util import EmptyQueueError
 
+def payload_size(data):
+    # :brief Get the no. of payload bytes an item holds.
+    # :param data [Object] an item of an UpdateQueue
+    # :return [int] len() of encoded updates, nbytes of decoded ones
+    #   (e.g. ModelUpdate), and 0 for anything else such as control messages
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, memoryview):
+        return data.nbytes
+    return getattr(data, 'nbytes', 0)
+
 class UpdateQueue(object):
     # UpdateQueue encapsulates a queue of model updates.
+    # Enqueue and dequeue are O(1), and the queue keeps track of the
+    # no. of payload bytes it holds so callers can cap memory in bytes.
     # This class is not thread safe.
 
     def __init__(self):
         # :brief Create a new UpdateQueue instance.
-        self.queue = []
+        self.queue = deque()
         self.len = 0
+        self.nbytes = 0
 
     def enqueue(self, data):
         # :brief Enqueue some data.
         # :param data [Object] some object to add to the queue
         self.queue.append(data)
         self.len += 1
+        self.nbytes += payload_size(data)
+
+    def push_front(self, data):
+        # :brief Put data back at the front of the queue, e.g. after a failed send.
+        # :param data [Object] some object to dequeue next
+        self.queue.appendleft(data)
+        self.len += 1
+        self.nbytes += payload_size(data)
 
     def dequeue(self):
         # :brief Dequeue an element of the queue.
@@ -22,14 +45,40 @@ class UpdateQueue(object):
         # :warning raises an EmptyQueueError if the queue is empty
         if self.len < 1:
             raise EmptyQueueError("could not pop from empty queue")
-        ret = self.queue[0]
-        self.queue = self.queue[1:]
+        ret = self.queue.popleft()
         self.len -= 1
+        self.nbytes -= payload_size(ret)
         return ret
-    
+
+    def peek_last(self):
+        # :brief Get the newest element in the queue without dequeing it.
+        # :return [Object] the newest element of the queue
+        # :warning raises an EmptyQueueError if the queue is empty
+        if self.len < 1:
+            raise EmptyQueueError("could not peek on empty queue")
+        return self.queue[-1]
+
+    def replace_last(self, data):
+        # :brief Overwrite the newest element of the queue.
+        # :param data [Object] the object that takes its place
+        # :warning raises an EmptyQueueError if the queue is empty
+        if self.len < 1:
+            raise EmptyQueueError("could not replace in empty queue")
+        self.nbytes += payload_size(data) - payload_size(self.queue[-1])
+        self.queue[-1] = data
+
+    def replace(self, index, data):
+        # :brief Overwrite the element at a position in the queue.
+        # :param index [int] position counted from the oldest element
+        # :param data [Object] the object that takes its place
+        # :warning raises an IndexError if there is no such element
+        self.nbytes += payload_size(data) - payload_size(self.queue[index])
+        self.queue[index] = data
+
     def clear(self):
-        del self.queue[:]
-        self.len = 0 
+        self.queue.clear()
+        self.len = 0
+        self.nbytes = 0
 
     def peek(self):
         # :brief Get the next element in the queue without dequeing it.
@@ -42,4 +91,4 @@ class UpdateQueue(object):
     def __len__(self):
         # :brief Get the length of the queue.
         # :return [int] the length of the queue
-        return self.len
\ No newline at end of file
+        return self.len
@@ -8,6 +8,11 @@ class DevicePushbackError(Exception):
     # enqueue another update.
     pass
 
+class MalformedUpdateError(ValueError):
+    # MalformedUpdateError is raised when a received payload
+    # is not an update (or batch of updates) in the wire format.
+    pass
+
 class ExtraFatal(Exception):
     # ExtraFatal error is designed to kill the server
     # when it is in a state that should not be possible.
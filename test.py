@@ -4,9 +4,18 @@ import unit.test_unit as test_unit
 import unit.ml_thread as ml_thread
 import unit.pendingwork as pendingwork
 import unit.updatequeue as updatequeue
+import unit.rwlock as rwlock
 import unit.sender as sender
+import unit.decoder as decoder
+import unit.running_aggregate as running_aggregate
+import unit.aggregation as aggregation
+import unit.neural_net as neural_net
+import unit.background_aggregator as background_aggregator
+import unit.prefetch as prefetch
+import unit.idx_dataset as idx_dataset
 import unit.get_weights as get_weights
 import unit.update_metadata.device_fairness as device_fairness
+import unit.update_metadata.model_update as model_update
 import unit.biased_data_partition as biased_data_partition
 import unit.data_partition as data_partition
 
@@ -15,12 +24,36 @@ def main():
     test_unit.add_tests(calc)
     data_partition.add_tests(calc)
     # ml_thread.add_tests(calc)
+    # The other ml_thread tests need MNIST
+    calc.add_test(ml_thread.test_fused_backprop)
+    calc.add_test(ml_thread.test_confusion_matrix)
+    calc.add_test(ml_thread.test_send_after_death)
     device_fairness.add_tests(calc)
-    # updatequeue.add_tests(calc)
-    # sender.add_tests(calc)
+    model_update.add_tests(calc)
+    updatequeue.add_tests(calc)
+    rwlock.add_tests(calc)
+    sender.add_tests(calc)
     # biased_data_partition.add_tests(calc)
+    calc.add_test(biased_data_partition.test_trim_train_data)
     # pendingwork.add_tests(calc)
-    # get_weights.add_tests(calc)
+    # test_pending_work needs MNIST
+    calc.add_test(pendingwork.test_enqueue_batch)
+    calc.add_test(pendingwork.test_min_and_max_queue_len)
+    calc.add_test(pendingwork.test_push_back)
+    calc.add_test(pendingwork.test_concurrent_enqueue)
+    calc.add_test(pendingwork.test_new_host_queue)
+    calc.add_test(pendingwork.test_failed_enqueue_unlocks)
+    calc.add_test(pendingwork.test_wait_for_updates)
+    calc.add_test(pendingwork.test_memory_budget)
+    calc.add_test(pendingwork.test_credits)
+    decoder.add_tests(calc)
+    running_aggregate.add_tests(calc)
+    aggregation.add_tests(calc)
+    neural_net.add_tests(calc)
+    background_aggregator.add_tests(calc)
+    prefetch.add_tests(calc)
+    idx_dataset.add_tests(calc)
+    get_weights.add_tests(calc)
     #updatequeue.add_tests(calc)
     #sender.add_tests(calc)
     calc.run()
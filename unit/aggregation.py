@@ -0,0 +1,68 @@
+import torch
+from unit.unit import TestCalculator
+from src.aggregation import flat_view, flatten, weighted_sum, unflatten_into, AggregationPool
+from src.update_metadata.model_update import ModelUpdate
+
+def test_flat_view(calc):
+    calc.context("test_flat_view")
+    update = {'0': torch.randn(3, 4), '1': torch.randn(4)}
+    decoded = ModelUpdate.from_bytes(bytearray(ModelUpdate(update, {}).to_bytes()))
+
+    # Decoded updates are already flat, so no copy is made
+    flat = flat_view(list(decoded.updates.values()))
+    calc.check(flat.data_ptr() == decoded.flat.data_ptr() and flat.numel() == 16)
+    # Tensors in separate or out of order storage are not
+    calc.check(flat_view(list(update.values())) == None)
+    calc.check(flat_view([decoded.updates['1'], decoded.updates['0']]) == None)
+    calc.check(torch.equal(flatten(list(update.values())), torch.cat([update['0'].view(-1), update['1']])))
+
+def test_weighted_sum(calc):
+    calc.context("test_weighted_sum")
+    keys = ['0', '1']
+    weight_list = [{'0': torch.randn(3, 4), '1': torch.randn(4)} for _ in range(5)]
+    weight_list[1] = ModelUpdate.from_bytes(ModelUpdate(weight_list[1], {}).to_bytes()).updates
+    alphas = [0.1, 0.2, 0.3, 0.15, 0.25]
+
+    # Matches the per-layer sum of alpha * weight
+    flat = weighted_sum(alphas, weight_list, keys)
+    for i, k in enumerate(keys):
+        expected = sum([alpha * weight[k] for alpha, weight in zip(alphas, weight_list)])
+        part = flat[:12].view(3, 4) if i == 0 else flat[12:]
+        calc.check(torch.allclose(part, expected, atol=1e-6))
+
+    # Parameters become views into the sum
+    parameters = [torch.nn.Parameter(torch.zeros(3, 4)), torch.nn.Parameter(torch.zeros(4))]
+    unflatten_into(flat, parameters)
+    calc.check(parameters[0].shape == (3, 4) and torch.equal(parameters[1].data, flat[12:]))
+    calc.check(flat_view([p.data for p in parameters]).data_ptr() == flat.data_ptr())
+
+def test_aggregation_pool(calc):
+    calc.context("test_aggregation_pool")
+    keys = ['0', '1']
+    weight_list = [ModelUpdate.from_bytes(ModelUpdate({'0': torch.randn(30, 4), '1': torch.randn(7)}, {}).to_bytes()).updates
+                   for _ in range(4)]
+    alphas = [0.4, 0.3, 0.2, 0.1]
+    expected = weighted_sum(alphas, weight_list, keys)
+    pool = AggregationPool(3, min_shard_numel=10)
+
+    # Uneven shards give the same sum as one thread
+    flat = pool.weighted_sum(alphas, weight_list, keys)
+    calc.check(torch.allclose(flat, expected, atol=1e-6))
+    # The out buffer is reused when it fits
+    calc.check(pool.weighted_sum(alphas, weight_list, keys, flat).data_ptr() == flat.data_ptr())
+    calc.check(pool.weighted_sum([], [], keys) == None)
+    # Too small to split, so summed on the calling thread
+    calc.check(torch.allclose(AggregationPool(3).weighted_sum(alphas, weight_list, keys), expected, atol=1e-6))
+
+    weight_list[2] = {'0': torch.randn(30, 4), '1': torch.randn(8)}
+    try:
+        pool.weighted_sum(alphas, weight_list, keys)
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+    pool.close()
+
+def add_tests(calc):
+    calc.add_test(test_flat_view)
+    calc.add_test(test_weighted_sum)
+    calc.add_test(test_aggregation_pool)
@@ -0,0 +1,96 @@
+import time
+import torch
+from unit.unit import TestCalculator
+from src.pendingwork import PendingWork
+from src.ml_thread import Solver
+from src.sender import Sender
+from src.update_metadata.model_update import ModelUpdate
+
+def make_solver(background):
+    hosts = ["localhost:5001", "localhost:5002"]
+    pending_work_queues = PendingWork(100)
+    pending_work_queues.setup("localhost:5000", hosts, "localhost:5000")
+    solver = Solver(None, None, pending_work_queues, Sender(20), background_aggregation=background)
+    solver.fairness_state.update_internal_state_after_backprop("localhost:5000", 5)
+    torch.manual_seed(0)
+    for i in range(4):
+        updates = { idx: torch.randn_like(params) for idx, params in solver.parameter_pointers.items() }
+        metadata = {"localhost:5000": 5, hosts[i % 2]: i + 1}
+        pending_work_queues.enqueue(ModelUpdate(updates, metadata), hosts[i % 2])
+    return solver
+
+def test_background_aggregator(calc):
+    calc.context("test_background_aggregator")
+    solvers = [make_solver(False), make_solver(True)]
+    aggregator = solvers[1].aggregator
+
+    # The aggregate is built in the background, without touching the model
+    before = solvers[1].net.flat.clone()
+    aggregator.start()
+    deadline = time.time() + 5
+    while aggregator.ready is None and time.time() < deadline:
+        time.sleep(0.01)
+    calc.check(aggregator.ready is not None)
+    calc.check(torch.equal(before, solvers[1].net.flat))
+    calc.check(solvers[1].pending_work_queues.get_total_no_of_updates() == 0)
+
+    # Training moves the model on before the swap; the result is the same as
+    # aggregating synchronously after that training
+    delta = torch.randn_like(before)
+    for solver in solvers:
+        solver.net.flat.add_(delta)
+    solvers[0].aggregate_received_updates()
+    replaced = solvers[1].net.flat
+    calc.check(aggregator.swap_in() == True)
+    calc.check(torch.allclose(solvers[0].net.flat, solvers[1].net.flat, atol=1e-6))
+    state = [solver.fairness_state.device_ip_addr_to_epoch_dict for solver in solvers]
+    calc.check(state[0] == state[1])
+    calc.check(aggregator.swap_in() == False)
+
+    # The replaced buffer is reused for the next aggregate
+    solvers[1].pending_work_queues.enqueue(ModelUpdate(
+        { idx: torch.zeros_like(p) for idx, p in solvers[1].parameter_pointers.items() },
+        {"localhost:5001": 9}), "localhost:5001")
+    deadline = time.time() + 5
+    while aggregator.ready is None and time.time() < deadline:
+        time.sleep(0.01)
+    calc.check(aggregator.ready is not None and aggregator.ready[0] is replaced)
+    aggregator.stop()
+    calc.check(aggregator.thread is None)
+    for solver in solvers:
+        solver.sender_queues.close()
+
+def test_background_aggregator_error(calc):
+    calc.context("test_background_aggregator_error")
+    solver = make_solver(True)
+    aggregator = solver.aggregator
+    def fail(out=None):
+        raise ValueError("Something very wrong with our alphas")
+    solver.aggregate_others = fail
+
+    # The exception ends the thread and is raised on the training thread
+    aggregator.start()
+    aggregator.thread.join(5)
+    calc.check(not aggregator.thread.is_alive())
+    try:
+        aggregator.swap_in()
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+    # Only once; otherwise stop raises it
+    calc.check(aggregator.swap_in() == False)
+    aggregator.stop()
+
+    aggregator.start()
+    aggregator.thread.join(5)
+    try:
+        aggregator.stop()
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+    calc.check(aggregator.thread is None)
+    solver.sender_queues.close()
+
+def add_tests(calc):
+    calc.add_test(test_background_aggregator)
+    calc.add_test(test_background_aggregator_error)
@@ -1,3 +1,5 @@
+import torch
+from types import SimpleNamespace
 from unit.unit import TestCalculator
 from torchvision import transforms
 from torch.utils.data import DataLoader
@@ -42,6 +44,29 @@ def test_biased_data_partition(calc):
                 d[label] += 1
     compare_dicts(calc, d, d_1)
 
+def test_trim_train_data(calc):
+    calc.context("test trim train data")
+    torch.manual_seed(0)
+    targets = torch.randint(0, 10, (1000,))
+    images = torch.randint(0, 256, (1000, 28, 28), dtype=torch.uint8)
+    # Skip MNIST itself and trim a stand-in for it
+    dataset = CustomizedTrainMNIST.__new__(CustomizedTrainMNIST)
+    dataset._mnist_dataset = SimpleNamespace(data=images, targets=targets)
+    dataset.transform = None
+    dataset.target_transform = None
+    label_to_num_examples = {3: 20, 0: 5, 7: 10000}
+    (dataset.data, dataset.targets) = dataset._trim_train_data(label_to_num_examples)
+
+    # The first examples of every label, label by label, as one uint8 tensor
+    expected = [i for i in range(1000) if targets[i] == 3][:20] + [i for i in range(1000) if targets[i] == 0][:5] \
+        + [i for i in range(1000) if targets[i] == 7]
+    calc.check(dataset.data.dtype == torch.uint8 and dataset.data.shape == (len(expected), 28, 28))
+    calc.check(torch.equal(dataset.data, images[expected]))
+    calc.check(dataset.targets.tolist() == targets[expected].tolist())
+    img, target = dataset[21]
+    calc.check(target == 0 and img.size == (28, 28))
+
 def add_tests(calc):
     calc.add_test(test_biased_data_partition)
+    calc.add_test(test_trim_train_data)
 
@@ -1,6 +1,11 @@
 
+import numpy as np
+import torch
+from types import SimpleNamespace
+from PIL import Image
+from torchvision import transforms
 from unit.unit import TestCalculator
-from src.data_partition import partition_dict
+from src.data_partition import partition_dict, dataset_tensors, Partition, TensorBatchLoader
 
 
 def test_partition_dict(calc):
@@ -12,5 +17,34 @@ def test_partition_dict(calc):
 
 
 
+def test_tensor_batch_loader(calc):
+    calc.context("test_tensor_batch_loader")
+    torch.manual_seed(0)
+    # Stand-in for MNIST: uint8 N x H x W images, labels are the example no.
+    mnist = SimpleNamespace(data=torch.randint(0, 256, (250, 28, 28), dtype=torch.uint8), targets=torch.arange(250))
+    loader = TensorBatchLoader(*dataset_tensors(mnist), batch_size=100, shuffle=False)
+    batches = list(loader)
+    calc.check(len(loader) == 3 and [len(labels) for _, labels in batches] == [100, 100, 50])
+    # Same values as ToTensor on every image
+    images, labels = batches[2]
+    expected = transforms.ToTensor()(Image.fromarray(mnist.data[207].numpy(), mode='L'))
+    calc.check(images.shape == (50, 1, 28, 28) and torch.equal(images[7], expected) and labels[7] == 207)
+
+    # A shuffled pass has every example of a partition once
+    partition = Partition(mnist, [5, 2, 9, 100, 41])
+    loader = TensorBatchLoader(*dataset_tensors(partition), batch_size=2)
+    labels = torch.cat([labels for _, labels in loader])
+    calc.check(sorted(labels.tolist()) == [2, 5, 9, 41, 100])
+
+    # Stand-in for CIFAR10: N x H x W x C images, normalized like Normalize
+    cifar = SimpleNamespace(data=np.random.randint(0, 256, (4, 32, 32, 3), dtype=np.uint8), targets=[3, 1, 4, 1])
+    mean, std = (0.5, 0.4, 0.3), (0.2, 0.3, 0.4)
+    loader = TensorBatchLoader(*dataset_tensors(cifar), batch_size=4, shuffle=False, mean=mean, std=std)
+    images, labels = next(iter(loader))
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)])
+    calc.check(torch.allclose(images[2], transform(Image.fromarray(cifar.data[2])), atol=1e-6))
+    calc.check(labels.tolist() == [3, 1, 4, 1])
+
 def add_tests(calc):
-    calc.add_test(test_partition_dict)
\ No newline at end of file
+    calc.add_test(test_partition_dict)
+    calc.add_test(test_tensor_batch_loader)
\ No newline at end of file
@@ -0,0 +1,91 @@
+import torch
+from unit.unit import TestCalculator
+from src.decoder import DecodePool, decoded
+from src.pendingwork import PendingWork
+from src.update_metadata.model_update import ModelUpdate
+
+def test_decode_pool(calc):
+    calc.context("test_decode_pool")
+    pool = DecodePool(num_workers=2, max_pending=2)
+    payload = ModelUpdate({'0': torch.arange(6.).view(2, 3)}, {"localhost:5001": 1}).to_bytes()
+
+    # Payloads are decoded into views of one contiguous tensor
+    pending = pool.submit(payload)
+    calc.check(pending.nbytes == len(payload))
+    update = pending.result()
+    calc.check(pending.done())
+    calc.check(torch.equal(update.updates['0'], torch.arange(6.).view(2, 3)))
+    calc.check(update.flat.is_contiguous() and update.flat.numel() == 6)
+    calc.check(decoded(pending) is update and decoded("CLOSE") == "CLOSE")
+
+    # Garbage is refused before it takes a slot
+    try:
+        pool.submit(b"not an update")
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+
+    # Slots are given back, so many more payloads than max_pending get through
+    updates = [pool.submit(payload) for _ in range(50)]
+    calc.check(all(u.result().update_metadata == {"localhost:5001": 1} for u in updates))
+    pool.close()
+
+def test_pending_work_decodes(calc):
+    calc.context("test_pending_work_decodes")
+    pool = DecodePool()
+    pending_work_queues = PendingWork(100)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    for i in range(3):
+        payload = ModelUpdate({'0': torch.full((4,), float(i))}, {"localhost:5001": i}).to_bytes()
+        pending_work_queues.enqueue(pool.submit(payload), "localhost:5001")
+
+    # Queued decodes come out as decoded updates, in order
+    calc.check(pending_work_queues.peek("localhost:5001").update_metadata == {"localhost:5001": 0})
+    calc.check(pending_work_queues.dequeue("localhost:5001").update_metadata == {"localhost:5001": 0})
+    weights, metadata, _ = pending_work_queues.empty_model_and_metadata_from("localhost:5001")
+    calc.check([m["localhost:5001"] for m in metadata] == [1, 2])
+    calc.check(torch.equal(weights[1]['0'], torch.full((4,), 2.)))
+    pool.close()
+
+def test_corrupt_update_rejected(calc):
+    calc.context("test_corrupt_update_rejected")
+    import main
+    from src.ml_thread import Solver
+    from src.sender import Sender, SENDER_HEADER
+    main.pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    solver = Solver(None, None, main.pending_work_queues, Sender(20))
+    solver.sender_queues.close()
+    client = main.app.test_client()
+    headers = {SENDER_HEADER: "localhost:5001"}
+    good = ModelUpdate({ idx: torch.ones_like(p) for idx, p in solver.parameter_pointers.items() },
+                       {"localhost:5001": 1}).to_bytes()
+
+    # A broken header, or data cut short, is refused on the request thread
+    header_len = ModelUpdate.check_bytes(good)
+    corrupt_header = good[:12] + b'{' * header_len + good[12 + header_len:]
+    for payload in [corrupt_header, good[:-4]]:
+        calc.check(client.post("/send_update", data=payload, headers=headers).status_code == 400)
+    calc.check(main.pending_work_queues.get_total_no_of_updates() == 0)
+
+    # and aggregation only ever sees the good updates
+    calc.check(client.post("/send_update", data=good, headers=headers).status_code == 200)
+    before = solver.net.flat.clone()
+    solver.aggregate_received_updates()
+    calc.check(main.pending_work_queues.get_total_no_of_updates() == 0)
+    calc.check(not torch.equal(before, solver.net.flat))
+
+    # Other errors on the receiving side are not blamed on the payload, so
+    # the sender keeps the update (see Sender._update_host)
+    enqueue = main.pending_work_queues.enqueue
+    def broken_enqueue(update, host):
+        raise ValueError("bug on the receiving side")
+    main.pending_work_queues.enqueue = broken_enqueue
+    calc.check(client.post("/send_update", data=good, headers=headers).status_code == 500)
+    main.pending_work_queues.enqueue = enqueue
+    # A batch that is not a batch is refused too
+    calc.check(client.post("/send_updates", data=b"MUPB" + b"\0" * 8, headers=headers).status_code == 400)
+
+def add_tests(calc):
+    calc.add_test(test_decode_pool)
+    calc.add_test(test_pending_work_decodes)
+    calc.add_test(test_corrupt_update_rejected)
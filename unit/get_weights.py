@@ -1,4 +1,6 @@
-from src.get_weights import get_weights
+import random
+import numpy as np
+from src.get_weights import get_weights, get_weights_array, inverse_norm
 
 def check(az):
     s = 0.0
@@ -17,5 +19,32 @@ def test_get_weights(calc):
     az = get_weights(vs)
     calc.check(az)
 
+def loop_weights(vs):
+    # The nested-loop implementation get_weights_array replaced
+    ls = [sum(e**2 for e in v)**0.5 for v in vs]
+    s = sum(1.0 / l for l in ls)
+    return [(1.0 / l) / s for l in ls]
+
+def test_get_weights_array(calc):
+    calc.context("test_get_weights_array")
+    rng = random.Random(0)
+    vs = [[rng.uniform(0, 100) for _ in range(50)] for _ in range(300)]
+    calc.check(np.allclose(get_weights_array(np.array(vs)), loop_weights(vs), rtol=1e-12))
+    calc.check(np.allclose(get_weights(vs), loop_weights(vs), rtol=1e-12))
+    calc.check(abs(inverse_norm([3, 4]) - 0.2) < 1e-12)
+
+    # Zero rows get no weight instead of dividing by zero
+    calc.check(get_weights([[3, 4], [0, 0], [0, 5]]) == [0.5, 0.0, 0.5])
+    calc.check(inverse_norm([0, 0]) == 0.0)
+    # If every row is zero, they are weighted equally
+    calc.check(get_weights([[0, 0], [0, 0]]) == [0.5, 0.5])
+    calc.check(get_weights([]) == [])
+
+    # Small inputs skip numpy and give the same weights
+    for vs in [[[3, 4], [0, 0], [0, 5]], [[0, 0], [0, 0]], [[1, 2, 3], [4, 5, 6]]]:
+        calc.check(np.allclose(get_weights(vs), get_weights_array(vs), rtol=1e-12))
+    calc.check(np.allclose(get_weights(np.array([[1, 2], [3, 4]])), get_weights([[1, 2], [3, 4]]), rtol=1e-12))
+
 def add_tests(calc):
     calc.add_test(test_get_weights)
+    calc.add_test(test_get_weights_array)
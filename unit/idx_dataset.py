@@ -0,0 +1,59 @@
+import os
+import struct
+import tempfile
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from unit.unit import TestCalculator
+from src.idx_dataset import read_idx, MappedMNIST
+from src.data_partition import Partition, dataset_tensors
+
+def write_idx(path, array, type_code):
+    with open(path, 'wb') as f:
+        f.write(bytes([0, 0, type_code, array.ndim]))
+        f.write(struct.pack('>%dI' % array.ndim, *array.shape))
+        f.write(array.tobytes())
+
+def test_read_idx(calc):
+    calc.context("test_read_idx")
+    with tempfile.TemporaryDirectory() as root:
+        raw_dir = os.path.join(root, 'MNIST', 'raw')
+        os.makedirs(raw_dir)
+        images = np.random.randint(0, 256, (30, 28, 28), dtype=np.uint8)
+        labels = np.arange(30, dtype=np.uint8) % 10
+        write_idx(os.path.join(raw_dir, 'train-images-idx3-ubyte'), images, 0x08)
+        write_idx(os.path.join(raw_dir, 'train-labels-idx1-ubyte'), labels, 0x08)
+        ints = np.array([[1, -2], [300000, 4]], dtype='>i4')
+        write_idx(os.path.join(root, 'ints'), ints, 0x0C)
+
+        # Mapped read-only, with the shape and type from the header
+        mapped = read_idx(os.path.join(raw_dir, 'train-images-idx3-ubyte'))
+        calc.check(mapped.shape == (30, 28, 28) and np.array_equal(mapped, images))
+        calc.check(not mapped.flags.writeable)
+        calc.check(read_idx(os.path.join(root, 'ints')).tolist() == ints.tolist())
+        # Files cut short or not in the format are refused
+        with open(os.path.join(root, 'short'), 'wb') as f:
+            f.write(bytes([0, 0, 0x08, 1]) + struct.pack('>I', 5) + b'abc')
+        with open(os.path.join(root, 'text'), 'wb') as f:
+            f.write(b'not an idx file')
+        for name in ['short', 'text']:
+            try:
+                read_idx(os.path.join(root, name))
+                calc.check(False)
+            except ValueError:
+                calc.check(True)
+
+        # Examples are the same as torchvision's MNIST would give
+        dataset = MappedMNIST(root, train=True, transform=transforms.ToTensor())
+        img, target = dataset[12]
+        calc.check(len(dataset) == 30 and target == 2)
+        calc.check(torch.equal(img, transforms.ToTensor()(Image.fromarray(images[12], mode='L'))))
+        # A partition is copied out of the map only when loaded into memory
+        part_images, part_labels = dataset_tensors(Partition(dataset, [4, 17, 9]))
+        calc.check(torch.equal(part_images, torch.from_numpy(images[[4, 17, 9]]).unsqueeze(1)))
+        calc.check(part_labels.tolist() == [4, 7, 9])
+        del dataset, mapped
+
+def add_tests(calc):
+    calc.add_test(test_read_idx)
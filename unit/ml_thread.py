@@ -1,7 +1,11 @@
 
+import io
+import torch
+from contextlib import redirect_stdout
 from unit.unit import TestCalculator
-from src.ml_thread import initialize_current_node
+from src.ml_thread import initialize_current_node, Solver
 from src.pendingwork import PendingWork
+from src.sender import Sender
 
 
 def test_convergence(calc):
@@ -37,6 +41,90 @@ def test_ml_thread(calc):
     node_3.evaluate()
     calc.check(True)
 
+def make_solver(test_loader=None, **kwargs):
+    # A one-peer Solver whose updates are encoded but never sent; close
+    # its sender_queues when done
+    pending_work_queues = PendingWork(5)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    solver = Solver(None, test_loader, pending_work_queues, Sender(20), **kwargs)
+    solver.sender_queues.enqueue = lambda update: None
+    return solver
+
+def test_fused_backprop(calc):
+    calc.context("test_fused_backprop")
+    torch.manual_seed(0)
+    # The last window is short, and so is its last minibatch
+    minibatches = [(torch.rand(100, 1, 28, 28), torch.randint(0, 10, (100,))) for _ in range(6)]
+    minibatches.append((torch.rand(30, 1, 28, 28), torch.randint(0, 10, (30,))))
+    solvers = []
+    for fuse in [False, True]:
+        solver = make_solver(fuse_minibatches=fuse)
+        j = 0
+        while j < len(minibatches):
+            j = solver.minibatch_backprop_and_update_weights(minibatches, j, 5)
+        calc.check(j == len(minibatches))
+        solvers.append(solver)
+
+    # Same loss history as one pass per minibatch
+    calc.check(all(abs(a - b) < 1e-7 for a, b in zip(solvers[0].ten_recent_loss_list, solvers[1].ten_recent_loss_list)))
+    calc.check(solvers[1].ten_recent_loss_list[6] != 0.0)
+
+    # Same gradients as backprop on each minibatch in turn
+    solver = solvers[1]
+    solver.fused_backprop(minibatches, 2, 5)
+    fused = torch.cat([p.grad.view(-1) for p in solver.net.parameters()])
+    solver.optimizer.zero_grad()
+    for images, labels in minibatches[2:]:
+        solver.loss_fn(solver.net(images.view(-1, 28*28)), labels).backward()
+    calc.check(torch.allclose(fused, torch.cat([p.grad.view(-1) for p in solver.net.parameters()]), atol=1e-7))
+    for solver in solvers:
+        solver.sender_queues.close()
+
+def test_send_after_death(calc):
+    calc.context("test_send_after_death")
+    solver = make_solver()
+    # With the real enqueue and the send engine stopped, as if the peer were unreachable
+    del solver.sender_queues.enqueue
+    solver.sender_queues.close()
+    queue = solver.sender_queues.queues["localhost:5001"]
+    sent = [solver.send_after_death() for _ in range(1000)]
+    calc.check(sent[0] == True and not any(sent[1:]))
+    calc.check(len(queue) == 1 and solver.sender_queues.total_no_of_updates == 1)
+    # A snapshot after a control message is queued behind it, then replaced
+    solver.sender_queues.enqueue({"CLEAR": True, "epoch": 1})
+    calc.check(solver.send_after_death() == True and len(queue) == 3)
+    solver.sender_queues.enqueue(b"newer", latest_only=True)
+    calc.check(len(queue) == 3 and queue.peek_last() == b"newer")
+
+def test_confusion_matrix(calc):
+    calc.context("test_confusion_matrix")
+    torch.manual_seed(0)
+    # Batches of any size
+    test_loader = [(torch.rand(n, 1, 28, 28), torch.randint(0, 10, (n,))) for n in [37, 100, 5]]
+    solver = make_solver(test_loader)
+
+    expected = torch.zeros(10, 10, dtype=torch.long)
+    for images, labels in test_loader:
+        predicted = solver.net(images.view(-1, 28*28)).argmax(1)
+        for label, prediction in zip(labels.tolist(), predicted.tolist()):
+            expected[label][prediction] += 1
+    matrix = solver.confusion_matrix()
+    calc.check(torch.equal(matrix, expected))
+    calc.check(matrix.sum().item() == 142)
+
+    # Overall and per-class accuracy both come from the same matrix
+    out = io.StringIO()
+    with redirect_stdout(out):
+        solver.evaluate_all()
+    lines = out.getvalue().splitlines()
+    calc.check(lines[0] == f'Accuracy: {100 * expected.diagonal().sum().item() / 142:.2f}%')
+    per_class = {c: round(expected[c][c].item() / expected[c].sum().item(), 2) for c in range(10) if expected[c].sum() > 0}
+    calc.check(lines[1] == "ACCURACY " + str(per_class))
+    solver.sender_queues.close()
+
 def add_tests(calc):
     calc.add_test(test_convergence)
+    calc.add_test(test_fused_backprop)
+    calc.add_test(test_confusion_matrix)
+    calc.add_test(test_send_after_death)
     #calc.add_test(test_ml_thread)
\ No newline at end of file
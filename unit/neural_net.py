@@ -0,0 +1,44 @@
+import torch
+from unit.unit import TestCalculator
+from src.neural_net import Net
+from src.aggregation import flat_view
+from src.update_metadata.model_update import ModelUpdate
+
+def test_flat_parameters(calc):
+    calc.context("test_flat_parameters")
+    net = Net()
+    params = list(net.parameters())
+
+    # Every parameter is a view into net.flat, in order
+    calc.check(net.flat.numel() == sum(p.numel() for p in params))
+    calc.check(flat_view([p.data for p in params]).data_ptr() == net.flat.data_ptr())
+
+    # Training steps update net.flat in place
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.01)
+    before = net.flat.clone()
+    net(torch.randn(4, 28*28)).sum().backward()
+    optimizer.step()
+    calc.check(not torch.equal(before, net.flat))
+
+    # Loading a flat tensor makes it the parameters, without a copy
+    flat = torch.zeros_like(net.flat)
+    net.load_flat(flat)
+    calc.check(params[0].data.data_ptr() == flat.data_ptr() and net.flat is flat)
+    try:
+        net.load_flat(torch.zeros(3))
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+
+    # Casting the model gathers the parameters again
+    net.double()
+    calc.check(net.flat.dtype == torch.float64)
+    calc.check(flat_view([p.data for p in net.parameters()]).data_ptr() == net.flat.data_ptr())
+
+    # The encoded update is the flat buffer
+    updates = { str(idx): p.data for idx, p in enumerate(Net().parameters()) }
+    decoded = ModelUpdate.from_bytes(ModelUpdate(updates, {}).to_bytes())
+    calc.check(torch.equal(decoded.flat, torch.cat([p.view(-1) for p in updates.values()])))
+
+def add_tests(calc):
+    calc.add_test(test_flat_parameters)
@@ -1,6 +1,12 @@
 from unit.unit import TestCalculator
 from src.pendingwork import PendingWork
-from src.util import EmptyQueueError
+import os
+import random
+import tempfile
+import time
+import torch
+from threading import Thread
+from src.util import EmptyQueueError, DevicePushbackError
 from src.ml_thread import initialize_current_node   
 from src.update_metadata.model_update import ModelUpdate
 
@@ -94,5 +100,254 @@ def test_pending_work(calc):
     calc.check(pending_work_queues.get_total_no_of_updates() == 2)
 
 
+def test_enqueue_batch(calc):
+    calc.context("test_enqueue_batch")
+    pending_work_queues = PendingWork(100)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001", "localhost:5002"], "localhost:5000")
+
+    # A batch lands in order in the sender's queue
+    pending_work_queues.enqueue_batch(["a", "b", "c"], "localhost:5001")
+    calc.check(pending_work_queues.get_total_no_of_updates() == 3)
+    calc.check([pending_work_queues.dequeue("localhost:5001") for _ in range(3)] == ["a", "b", "c"])
+
+    # Unknown senders get a queue, like enqueue
+    pending_work_queues.enqueue_batch(["d"], "localhost:5009")
+    calc.check(pending_work_queues.peek("localhost:5009") == "d")
+
+    # Frozen queues drop batches from non-leaders
+    pending_work_queues.freeze_node()
+    pending_work_queues.enqueue_batch(["e", "f"], "localhost:5002")
+    calc.check(pending_work_queues.get_total_no_of_updates() == 1)
+
+def test_min_and_max_queue_len(calc):
+    calc.context("test_min_and_max_queue_len")
+    hosts = ["localhost:50%02d" % i for i in range(20)]
+    pending_work_queues = PendingWork(float('inf'))
+    pending_work_queues.setup(hosts[0], hosts[1:], hosts[0])
+    rng = random.Random(0)
+    senders = set()
+    ok = True
+    for step in range(3000):
+        op = rng.random()
+        host = rng.choice(hosts[1:] if op < 0.6 else hosts)
+        if op < 0.55:
+            pending_work_queues.enqueue(step, host)
+        elif op < 0.6:
+            pending_work_queues.enqueue_batch([step] * rng.randint(1, 5), host)
+        elif op < 0.98:
+            try:
+                pending_work_queues.dequeue(host)
+            except EmptyQueueError:
+                pass
+        else:
+            pending_work_queues.dequeue_every_queue()
+        # Only queues that have had an update count; the own queue never gets one
+        if op < 0.6:
+            senders.add(host)
+        lens = [len(pending_work_queues.queues[h]) for h in senders]
+        ok = ok and pending_work_queues.min_queue_len == min(lens, default=None)
+        ok = ok and pending_work_queues.max_queue_len == max(lens, default=None)
+    calc.check(ok)
+
+def test_push_back(calc):
+    calc.context("test_push_back")
+    pending_work_queues = PendingWork(2)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001", "localhost:5002", "localhost:5003"], "localhost:5000")
+    # No ratio to enforce while a sender's queue is empty
+    for i in range(5):
+        pending_work_queues.enqueue(i, "localhost:5002")
+    pending_work_queues.enqueue(0, "localhost:5001")
+    # The own queue, and 5003 that never sends, stay empty without pinning the min at 0
+    calc.check(pending_work_queues.min_queue_len == 1)
+    # 5 queued is more than 2 times the shortest queue
+    try:
+        pending_work_queues.enqueue(5, "localhost:5002")
+        calc.check(False)
+    except DevicePushbackError:
+        calc.check(True)
+    pending_work_queues.enqueue(1, "localhost:5001")
+    pending_work_queues.enqueue(2, "localhost:5001")
+    pending_work_queues.enqueue(5, "localhost:5002")
+    calc.check(pending_work_queues.max_queue_len == 6)
+
+def test_concurrent_enqueue(calc):
+    calc.context("test_concurrent_enqueue")
+    hosts = ["localhost:51%02d" % i for i in range(8)]
+    pending_work_queues = PendingWork(float('inf'))
+    pending_work_queues.setup("localhost:5000", hosts, "localhost:5000")
+    drained = []
+    def enqueuer(host):
+        for i in range(2000):
+            pending_work_queues.enqueue(i, host)
+    def drainer():
+        while sum(drained) < 2000 * len(hosts):
+            for host in hosts:
+                try:
+                    pending_work_queues.dequeue(host)
+                    drained.append(1)
+                except EmptyQueueError:
+                    pass
+    threads = [Thread(target=enqueuer, args=(host,)) for host in hosts]
+    threads.append(Thread(target=drainer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    calc.check(sum(drained) == 2000 * len(hosts))
+    calc.check(pending_work_queues.get_total_no_of_updates() == 0)
+    calc.check(pending_work_queues.max_queue_len == 0)
+
+def test_new_host_queue(calc):
+    calc.context("test_new_host_queue")
+    pending_work_queues = PendingWork(float('inf'))
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+
+    # Queues for unknown hosts are made without waiting for other readers
+    pending_work_queues.read()
+    t = Thread(target=pending_work_queues.enqueue, args=("a", "localhost:5009"))
+    t.start()
+    t.join(5)
+    calc.check(not t.is_alive())
+    pending_work_queues.release()
+    calc.check(pending_work_queues.dequeue("localhost:5009") == "a")
+
+    # A thread that already reads can add queues for new hosts too
+    pending_work_queues.read()
+    pending_work_queues.enqueue("b", "localhost:5001")
+    pending_work_queues.enqueue("c", "localhost:5010")
+    calc.check(pending_work_queues.credits("localhost:5011") == None)
+    pending_work_queues.release()
+    t = Thread(target=pending_work_queues.dequeue_every_queue)
+    t.start()
+    t.join(5)
+    calc.check(not t.is_alive() and pending_work_queues.get_total_no_of_updates() == 0)
+    calc.check(len(pending_work_queues.queues) == 5)
+
+def test_failed_enqueue_unlocks(calc):
+    calc.context("test_failed_enqueue_unlocks")
+    pending_work_queues = PendingWork(float('inf'), running_aggregate=True)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    pending_work_queues.enqueue(ModelUpdate({'0': torch.ones(4)}, {"localhost:5001": 1}), "localhost:5001")
+    # A shape mismatch fails while folding, with the lock held
+    for enqueue in [pending_work_queues.enqueue, lambda update, host: pending_work_queues.enqueue_batch([update], host)]:
+        try:
+            enqueue(ModelUpdate({'0': torch.ones(5)}, {"localhost:5001": 1}), "localhost:5001")
+            calc.check(False)
+        except RuntimeError:
+            calc.check(True)
+    calc.check(pending_work_queues.get_total_no_of_updates() == 1)
+    calc.check(len(pending_work_queues.queues["localhost:5001"]) == 1)
+
+    # Writers still get the lock afterwards
+    t = Thread(target=pending_work_queues.dequeue_every_queue)
+    t.start()
+    t.join(5)
+    calc.check(not t.is_alive() and pending_work_queues.get_total_no_of_updates() == 0)
+
+def test_wait_for_updates(calc):
+    calc.context("test_wait_for_updates")
+    pending_work_queues = PendingWork(100)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001", "localhost:5002"], "localhost:5000")
+
+    # Times out when nothing arrives
+    start = time.time()
+    calc.check(pending_work_queues.wait_for_updates(1, timeout=0.05) == False)
+    calc.check(time.time() - start >= 0.05)
+
+    # Wakes up as soon as enough updates arrive
+    def send():
+        time.sleep(0.05)
+        pending_work_queues.enqueue("a", "localhost:5001")
+        time.sleep(0.05)
+        pending_work_queues.enqueue_batch(["b", "c"], "localhost:5002")
+    Thread(target=send).start()
+    calc.check(pending_work_queues.wait_for_updates(1, timeout=5) == True)
+    calc.check(pending_work_queues.get_total_no_of_updates() == 1)
+
+    # Counts only the given hosts
+    calc.check(pending_work_queues.wait_for_updates(2, ["localhost:5002"], timeout=5) == True)
+    calc.check(pending_work_queues.wait_for_updates(2, ["localhost:5001"], timeout=0.05) == False)
+    calc.check(pending_work_queues.wait_for_updates(3) == True)
+
+def test_memory_budget(calc):
+    calc.context("test_memory_budget")
+    spill_dir = tempfile.mkdtemp()
+    # Each update holds 400 bytes, so the budget fits two of them
+    pending_work_queues = PendingWork(float('inf'), memory_budget=800, spill_dir=spill_dir)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001", "localhost:5002"], "localhost:5000")
+    def update(i):
+        return ModelUpdate({'0': torch.full((10, 10), float(i))}, {"localhost:5001": i})
+
+    for i in range(5):
+        pending_work_queues.enqueue(update(i), "localhost:5001")
+    pending_work_queues.enqueue(update(5), "localhost:5002")
+    calc.check(pending_work_queues.queued_bytes <= 800)
+    calc.check(len(os.listdir(spill_dir)) == 4)
+
+    # The oldest updates were spilled; peeking leaves them on disk
+    calc.check(pending_work_queues.peek("localhost:5001").update_metadata == {"localhost:5001": 0})
+    calc.check(len(os.listdir(spill_dir)) == 4)
+
+    # Spilled updates are paged back in, in order, and their files deleted
+    calc.check(torch.equal(pending_work_queues.dequeue("localhost:5001").updates['0'], torch.full((10, 10), 0.)))
+    weights, metadata, _ = pending_work_queues.empty_model_and_metadata_from("localhost:5001")
+    calc.check([m["localhost:5001"] for m in metadata] == [1, 2, 3, 4])
+    calc.check(all(torch.equal(w['0'], torch.full((10, 10), float(i + 1))) for i, w in enumerate(weights)))
+    calc.check(os.listdir(spill_dir) == [])
+    calc.check(pending_work_queues.queued_bytes == 400)
+
+    # Clearing deletes the files of spilled updates
+    pending_work_queues.enqueue_batch([update(i) for i in range(3)], "localhost:5001")
+    calc.check(len(os.listdir(spill_dir)) == 2)
+    pending_work_queues.dequeue_every_queue()
+    calc.check(os.listdir(spill_dir) == [])
+    calc.check(pending_work_queues.queued_bytes == 0)
+    os.rmdir(spill_dir)
+
+def test_credits(calc):
+    calc.context("test_credits")
+    pending_work_queues = PendingWork(2, queue_capacity=4)
+    pending_work_queues.setup("localhost:5001", ["localhost:5002"], "localhost:5001")
+
+    # Credits are the free slots before the queue is pushed back
+    calc.check(pending_work_queues.credits("localhost:5002") == 4)
+    for i in range(3):
+        pending_work_queues.enqueue(i, "localhost:5002")
+    calc.check(pending_work_queues.credits("localhost:5002") == 1)
+    pending_work_queues.enqueue(3, "localhost:5002")
+    calc.check(pending_work_queues.credits("localhost:5002") == 0)
+    try:
+        pending_work_queues.enqueue(4, "localhost:5002")
+        calc.check(False)
+    except DevicePushbackError:
+        calc.check(True)
+
+    # The ratio to the shortest queue limits them too
+    pending_work_queues.enqueue(0, "localhost:5001")
+    pending_work_queues.dequeue("localhost:5002")
+    pending_work_queues.dequeue("localhost:5002")
+    calc.check(pending_work_queues.credits("localhost:5002") == 1)
+
+    # A batch is only taken whole if every update in it has a slot
+    try:
+        pending_work_queues.enqueue_batch([5, 6], "localhost:5002")
+        calc.check(False)
+    except DevicePushbackError:
+        calc.check(pending_work_queues.queues["localhost:5002"].len == 2)
+    pending_work_queues.enqueue_batch([5], "localhost:5002")
+    calc.check(pending_work_queues.credits("localhost:5002") == 0)
+
+    # Without a capacity, credits are unlimited while a queue is empty
+    calc.check(PendingWork(2).credits("localhost:5002") == None)
+
 def add_tests(calc):
-    calc.add_test(test_pending_work)
\ No newline at end of file
+    calc.add_test(test_pending_work)
+    calc.add_test(test_enqueue_batch)
+    calc.add_test(test_min_and_max_queue_len)
+    calc.add_test(test_push_back)
+    calc.add_test(test_concurrent_enqueue)
+    calc.add_test(test_new_host_queue)
+    calc.add_test(test_failed_enqueue_unlocks)
+    calc.add_test(test_wait_for_updates)
+    calc.add_test(test_memory_budget)
+    calc.add_test(test_credits)
\ No newline at end of file
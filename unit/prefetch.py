@@ -0,0 +1,56 @@
+import time
+from unit.unit import TestCalculator
+from src.prefetch import PrefetchedMinibatches
+
+class CountingLoader(object):
+    # Yields the numbers 0 to n - 1, counting how many were drawn
+    def __init__(self, n, fail_at=None):
+        self.n = n
+        self.fail_at = fail_at
+        self.drawn = 0
+
+    def __iter__(self):
+        for i in range(self.n):
+            if i == self.fail_at:
+                raise ValueError("bad minibatch")
+            self.drawn += 1
+            yield i
+
+    def __len__(self):
+        return self.n
+
+def test_prefetch(calc):
+    calc.context("test_prefetch")
+    loader = CountingLoader(20)
+    minibatches = PrefetchedMinibatches(loader, capacity=3)
+    calc.check(len(minibatches) == 20 and minibatches[0] == 0)
+    # No more than capacity minibatches are loaded ahead, plus one waiting
+    deadline = time.time() + 5
+    while loader.drawn < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    calc.check(loader.drawn == 4)
+
+    # Read forwards like minibatch_backprop_and_update_weights does
+    calc.check([minibatches[j] for j in range(1, 6)] == [1, 2, 3, 4, 5])
+    calc.check(minibatches[6:11] == [6, 7, 8, 9, 10])
+    calc.check(minibatches[18:25] == [18, 19])
+    for index in [17, 20]:
+        try:
+            minibatches[index]
+            calc.check(False)
+        except IndexError:
+            calc.check(True)
+    minibatches.close()
+
+    # The loader's errors reach the reader
+    minibatches = PrefetchedMinibatches(CountingLoader(10, fail_at=4), capacity=8)
+    calc.check(minibatches[3] == 3)
+    try:
+        minibatches[4]
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+    minibatches.close()
+
+def add_tests(calc):
+    calc.add_test(test_prefetch)
@@ -0,0 +1,97 @@
+import torch
+from concurrent.futures import Future
+from unit.unit import TestCalculator
+from src.pendingwork import PendingWork
+from src.running_aggregate import RunningAggregate
+from src.ml_thread import Solver
+from src.decoder import PendingDecode
+from src.sender import Sender
+from src.update_metadata.model_update import ModelUpdate
+from src.util import EmptyQueueError
+
+def test_running_aggregate(calc):
+    calc.context("test_running_aggregate")
+    aggregate = RunningAggregate()
+    aggregate.enqueue(ModelUpdate({'0': torch.ones(4)}, {"a": 3, "b": 4}))
+    aggregate.enqueue(ModelUpdate({'0': torch.full((4,), 3.)}, {"a": 1, "c": 0}))
+    aggregate.enqueue(ModelUpdate({'0': torch.full((4,), 9.)}, {"a": 0}))
+    # Weights are 1/5 and 1/1; all-zero metadata gets none
+    calc.check(len(aggregate) == 3)
+    calc.check(abs(aggregate.total_weight - 1.2) < 1e-9)
+    calc.check(torch.allclose(aggregate.weighted_sum['0'], torch.full((4,), 3.2)))
+    calc.check(aggregate.host_ids == {"a", "b", "c"})
+    calc.check(aggregate.nbytes == 16)
+
+    taken = aggregate.take()
+    calc.check(len(taken) == 3 and len(aggregate) == 0 and aggregate.nbytes == 0)
+
+def test_running_aggregate_pending(calc):
+    calc.context("test_running_aggregate_pending")
+    # Updates still being decoded are held, not waited for
+    aggregate = RunningAggregate(lambda v: 1.0)
+    future = Future()
+    aggregate.enqueue(PendingDecode(future, 100))
+    calc.check(len(aggregate) == 1 and aggregate.total_weight == 0 and aggregate.nbytes == 100)
+    # Once decoded, the next enqueue folds it in
+    future.set_result(ModelUpdate({'0': torch.ones(4)}, {"a": 3, "b": 4}))
+    aggregate.enqueue(ModelUpdate({'0': torch.full((4,), 3.)}, {"a": 1}))
+    calc.check(len(aggregate) == 2 and aggregate.total_weight == 2.0 and aggregate.nbytes == 16)
+    calc.check(torch.allclose(aggregate.weighted_sum['0'], torch.full((4,), 4.)))
+
+    # The rest are folded in on the draining side
+    future = Future()
+    aggregate.enqueue(PendingDecode(future, 100))
+    taken = aggregate.take()
+    calc.check(len(taken) == 3 and taken.nbytes == 116 and len(aggregate.pending) == 0)
+    future.set_result(ModelUpdate({'0': torch.ones(4)}, {"c": 1}))
+    taken.fold_pending()
+    calc.check(taken.total_weight == 3.0 and taken.nbytes == 16 and taken.host_ids == {"a", "b", "c"})
+
+    # Aggregates weight updates like the solver's fairness state
+    pending_work_queues = PendingWork(100, running_aggregate=True)
+    pending_work_queues.setup("localhost:5000", ["localhost:5001"], "localhost:5000")
+    solver = Solver(None, None, pending_work_queues, Sender(20))
+    solver.sender_queues.close()
+    calc.check(pending_work_queues.queues["localhost:5001"].weight_fn == solver.fairness_state.get_weight)
+
+def test_running_aggregation_matches(calc):
+    calc.context("test_running_aggregation_matches")
+    hosts = ["localhost:5001", "localhost:5002"]
+    solvers = []
+    for running in [False, True]:
+        pending_work_queues = PendingWork(100, running_aggregate=running)
+        pending_work_queues.setup("localhost:5000", hosts, "localhost:5000")
+        solver = Solver(None, None, pending_work_queues, Sender(20))
+        solver.fairness_state.update_internal_state_after_backprop("localhost:5000", 5)
+        torch.manual_seed(0)
+        for i in range(6):
+            updates = { idx: torch.randn_like(params) for idx, params in solver.parameter_pointers.items() }
+            metadata = {"localhost:5000": 5, hosts[i % 2]: i + 1, "localhost:5009": i % 3}
+            pending_work_queues.enqueue(ModelUpdate(updates, metadata), hosts[i % 2])
+        solvers.append(solver)
+
+    # Memory per host does not grow with the no. of updates
+    queues = solvers[1].pending_work_queues.queues
+    calc.check(queues[hosts[0]].len == 3)
+    calc.check(queues[hosts[0]].nbytes == sum(p.numel() * 4 for p in solvers[1].parameter_pointers.values()))
+
+    # Aggregating the running sums gives the same model and state
+    for solver in solvers:
+        solver.aggregate_received_updates()
+        solver.sender_queues.close()
+    calc.check(all(torch.allclose(a, b, atol=1e-6) for a, b in zip(
+        solvers[0].parameter_pointers.values(), solvers[1].parameter_pointers.values())))
+    state = [solver.fairness_state.device_ip_addr_to_epoch_dict for solver in solvers]
+    calc.check(state[0].keys() == state[1].keys())
+    calc.check(all(abs(state[0][host] - state[1][host]) < 1e-9 for host in state[0]))
+    calc.check(solvers[1].pending_work_queues.get_total_no_of_updates() == 0)
+    try:
+        solvers[1].pending_work_queues.take_aggregate(hosts[0])
+        calc.check(False)
+    except EmptyQueueError:
+        calc.check(True)
+
+def add_tests(calc):
+    calc.add_test(test_running_aggregate)
+    calc.add_test(test_running_aggregate_pending)
+    calc.add_test(test_running_aggregation_matches)
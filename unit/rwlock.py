@@ -0,0 +1,59 @@
+import time
+from threading import Thread
+from unit.unit import TestCalculator
+from src.rwlock import RWLock
+
+def test_rwlock(calc):
+    calc.context("test_rwlock")
+    lock = RWLock()
+    events = []
+
+    # Readers share the lock
+    lock.read()
+    reader = Thread(target=lambda: (lock.read(), events.append("read"), lock.release()))
+    reader.start()
+    reader.join(1)
+    calc.check(events == ["read"])
+
+    # A writer waits for readers, and new readers queue behind the writer
+    writer = Thread(target=lambda: (lock.write(), events.append("write"), lock.release()))
+    writer.start()
+    time.sleep(0.05)
+    late_reader = Thread(target=lambda: (lock.read(), events.append("late read"), lock.release()))
+    late_reader.start()
+    time.sleep(0.05)
+    calc.check(events == ["read"])
+    lock.release()
+    writer.join(1)
+    late_reader.join(1)
+    calc.check(events == ["read", "write", "late read"])
+
+    # The lock is reentrant, and release gives back the most recent acquire
+    lock.write()
+    lock.read()
+    lock.write()
+    lock.release()
+    lock.release()
+    lock.release()
+    lock.read()
+    lock.read()
+    lock.release()
+    lock.release()
+    calc.check(lock.writer is None and lock.num_readers == 0)
+
+    # Read locks cannot be upgraded, and unheld locks cannot be released
+    lock.read()
+    try:
+        lock.write()
+        calc.check(False)
+    except RuntimeError:
+        calc.check(True)
+    lock.release()
+    try:
+        lock.release()
+        calc.check(False)
+    except RuntimeError:
+        calc.check(True)
+
+def add_tests(calc):
+    calc.add_test(test_rwlock)
@@ -1,12 +1,16 @@
 
+import time
+import requests
+from threading import Lock
 from unit.unit import TestCalculator
-from src.sender import Sender
+from src.sender import Sender, CREDITS_HEADER
 
 sender = Sender(20)
 
 class HTTPResponse(object):
-    def __init__(self, code):
+    def __init__(self, code, headers={}):
         self.status_code = code
+        self.headers = headers
 
 def test_sender(calc):
     calc.context("sender")
@@ -36,6 +40,181 @@ def test_sender(calc):
     # sender.run()
     # print(sender)
 
-    
+
+def test_sender_engine(calc):
+    calc.context("sender engine")
+    engine = Sender(20)
+    engine.setup("localhost:5000", ["localhost:5001", "localhost:5002"], [])
+    sent = []
+    sent_lock = Lock()
+    def fake_post_update(host, update):
+        with sent_lock:
+            sent.append((host, update, time.time()))
+        return HTTPResponse(400 if update == "rejected" else 200)
+    engine._post_update = fake_post_update
+    engine.run()
+
+    # Every update reaches every host, in order
+    for i in range(3):
+        engine.enqueue(i)
+    deadline = time.time() + 5
+    while (len(sent) < 6 or engine.total_no_of_updates > 0) and time.time() < deadline:
+        time.sleep(0.01)
+    for host in ["localhost:5001", "localhost:5002"]:
+        calc.check([update for h, update, _ in sent if h == host] == [0, 1, 2])
+    calc.check(engine.total_no_of_updates == 0)
+
+    # Sends to the same host respect its wait time
+    times = [t for h, _, t in sent if h == "localhost:5001"]
+    calc.check(all(b - a >= 0.09 for a, b in zip(times, times[1:])))
+
+    # A 4xx doubles the host's wait time
+    engine.enqueue("rejected")
+    deadline = time.time() + 5
+    while engine.wait_times["localhost:5001"] != 0.2 and time.time() < deadline:
+        time.sleep(0.01)
+    calc.check(engine.wait_times["localhost:5001"] == 0.2)
+    engine.close()
+
+def test_sender_batching(calc):
+    calc.context("sender batching")
+    engine = Sender(20, max_batch_bytes=10)
+    engine.setup("localhost:5000", ["localhost:5001"], [])
+    sent = []
+    engine._post_update = lambda host, update: sent.append([update]) or HTTPResponse(200)
+    engine._post_batch = lambda host, updates: sent.append(updates) or HTTPResponse(200)
+
+    # Queued model updates go out together, up to max_batch_bytes
+    for update in [b"aaaa", b"bbbb", b"cccc", {"CLOSE": True}, b"dddd"]:
+        engine.enqueue(update)
+    for _ in range(4):
+        engine.last_sent_times["localhost:5001"] = 0
+        engine._update_host("localhost:5001")
+    calc.check(sent == [[b"aaaa", b"bbbb"], [b"cccc"], [{"CLOSE": True}], [b"dddd"]])
+    calc.check(engine.total_no_of_updates == 0)
+
+    # A rejected batch is split up, so only its bad update is lost
+    sent.clear()
+    engine._post_update = lambda host, update: sent.append([update]) or HTTPResponse(400 if update == b"bad" else 200)
+    engine._post_batch = lambda host, updates: sent.append(updates) or HTTPResponse(400)
+    for update in [b"aaaa", b"bad", b"bbbb", b"cccc"]:
+        engine.enqueue(update)
+    for _ in range(5):
+        engine.last_sent_times["localhost:5001"] = 0
+        engine._update_host("localhost:5001")
+    calc.check(sent == [[b"aaaa", b"bad"], [b"aaaa"], [b"bad"], [b"bbbb", b"cccc"], [b"bbbb"]])
+    calc.check(list(engine.queues["localhost:5001"].queue) == [b"cccc"])
+    calc.check(engine.total_no_of_updates == 1)
+
+def test_sender_coalescing(calc):
+    calc.context("sender coalescing")
+    engine = Sender(20)
+    engine.setup("localhost:5000", ["localhost:5001", "localhost:5002"], [], ["localhost:5001"])
+
+    # Newer model updates replace unsent ones for coalescing hosts only
+    for update in [b"1", b"2", {"CLEAR": True, "epoch": 1}, b"3", b"4", {"CLOSE": True}, b"5"]:
+        engine.enqueue(update)
+    calc.check(list(engine.queues["localhost:5001"].queue) == [b"2", {"CLEAR": True, "epoch": 1}, b"4", {"CLOSE": True}, b"5"])
+    calc.check(len(engine.queues["localhost:5002"]) == 7)
+    calc.check(engine.total_no_of_updates == 12)
+
+    # However slow the peer, the queue holds a single model update
+    for i in range(100):
+        engine.enqueue(str(i).encode())
+    calc.check(len(engine.queues["localhost:5001"]) == 5)
+    calc.check(engine.queues["localhost:5001"].peek_last() == b"99")
+
+def test_sender_credits(calc):
+    calc.context("sender credits")
+    engine = Sender(20)
+    engine.setup("localhost:5000", ["localhost:5001"], [])
+    host = "localhost:5001"
+    sent = []
+    polls = []
+    replies = []
+    def fake_post(host, updates):
+        sent.append(updates)
+        return replies.pop(0)
+    engine._post_update = lambda host, update: fake_post(host, [update])
+    engine._post_batch = fake_post
+    def fake_poll(host):
+        polls.append(host)
+        engine.credits[host] = 2
+        engine.last_sent_times[host] = time.time()
+    engine._poll_credits = fake_poll
+    def send():
+        engine.last_sent_times[host] = 0
+        engine._update_host(host)
+
+    # Batches are cut to the credits the peer advertised
+    engine.credits[host] = 2
+    for update in [b"1", b"2", b"3", b"4", b"5"]:
+        engine.enqueue(update)
+    replies.append(HTTPResponse(200, {CREDITS_HEADER: "2"}))
+    send()
+    replies.append(HTTPResponse(200, {CREDITS_HEADER: "0"}))
+    send()
+    calc.check(sent == [[b"1", b"2"], [b"3", b"4"]])
+    calc.check(engine.credits[host] == 0)
+
+    # Out of credits, the sender polls instead of sending
+    send()
+    calc.check(polls == [host] and len(sent) == 2)
+
+    # A 429 puts the updates back in order and zeroes the credits
+    for update in [b"6", b"7"]:
+        engine.enqueue(update)
+    replies.append(HTTPResponse(429))
+    send()
+    calc.check(sent[-1] == [b"5", b"6"] and engine.credits[host] == 0)
+    calc.check(list(engine.queues[host].queue) == [b"5", b"6", b"7"])
+    calc.check(engine.total_no_of_updates == 3)
+
+    # A 5xx puts the updates back and backs off
+    engine.credits[host] = None
+    replies.append(HTTPResponse(500))
+    send()
+    calc.check(list(engine.queues[host].queue) == [b"5", b"6", b"7"])
+    calc.check(engine.wait_times[host] == 0.2)
+
+    # So does a connection error, for control messages too
+    def unreachable(host, updates):
+        sent.append(updates)
+        raise requests.ConnectionError("connection refused")
+    engine._post_update = lambda host, update: unreachable(host, [update])
+    engine._post_batch = unreachable
+    engine.dequeue_every_queue()
+    engine.enqueue({"CLOSE": True})
+    send()
+    calc.check(sent[-1] == [{"CLOSE": True}])
+    calc.check(list(engine.queues[host].queue) == [{"CLOSE": True}] and engine.total_no_of_updates == 1)
+    calc.check(engine.wait_times[host] == 0.4)
+
+    # However long the peer is down, the wait is capped, and one success resets it
+    for _ in range(20):
+        send()
+    calc.check(engine.wait_times[host] == engine.max_wait_time)
+    calc.check(list(engine.queues[host].queue) == [{"CLOSE": True}])
+    engine._post_update = lambda host, update: fake_post(host, [update])
+    engine._post_batch = fake_post
+    replies.append(HTTPResponse(200))
+    send()
+    calc.check(len(engine.queues[host]) == 0 and engine.wait_times[host] == 0.1)
+
+    # An update that always fails with a 5xx is given up on, so the rest get through
+    engine.enqueue(b"bad")
+    engine.enqueue({"CLOSE": True})
+    replies.extend([HTTPResponse(500)] * (engine.max_server_errors + 1) + [HTTPResponse(200)])
+    for _ in range(engine.max_server_errors + 1):
+        send()
+    calc.check(sent[-1] == [b"bad"] and list(engine.queues[host].queue) == [{"CLOSE": True}])
+    send()
+    calc.check(sent[-1] == [{"CLOSE": True}] and engine.total_no_of_updates == 0)
+    calc.check(engine.server_errors[host] == 0)
+
 def add_tests(calc):
-    calc.add_test(test_sender)
\ No newline at end of file
+    calc.add_test(test_sender)
+    calc.add_test(test_sender_engine)
+    calc.add_test(test_sender_batching)
+    calc.add_test(test_sender_coalescing)
+    calc.add_test(test_sender_credits)
\ No newline at end of file
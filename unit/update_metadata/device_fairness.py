@@ -1,3 +1,4 @@
+import numpy as np
 from unit.unit import TestCalculator
 from src.update_metadata.device_fairness import DeviceFairnessReceiverState
 
@@ -115,9 +116,40 @@ def test_update_internal_state_after_aggregation(calc):
     state_1.update_internal_state_after_aggregation([1,2,3], [[1, 3, 4, 0], [0, 0, 3, 1], [3, 0, 0, 0]], ['127.0.0.1:5000', '127.0.0.1:5001', '127.0.0.1:5002', '127.0.0.1:5004'])
     calc.check(state_1.device_ip_addr_to_epoch_dict == {'127.0.0.1:5000': 10, '127.0.0.1:5001': 3, '127.0.0.1:5002': 10, '127.0.0.1:5004': 2})
 
+def test_metadata_matrix(calc):
+    calc.context('Test metadata matrix')
+    state_1 = DeviceFairnessReceiverState(2, {'127.0.0.1:5000': 0, '127.0.0.1:5001': 0})
+    m = state_1.metadata_matrix([
+        {'127.0.0.1:5000': 1, '127.0.0.1:5001': 3, '127.0.0.1:5009': 7},
+        {'127.0.0.1:5001': 2.5},
+    ], ['127.0.0.1:5001', '127.0.0.1:5000'])
+    calc.check(m.shape == (2, 2))
+    calc.check(m.tolist() == [[3, 1], [2.5, 0]])
+    # Weighted sum over hosts: (1, 3) and (0, 1) give (1, 4), 3 apart
+    dicts = [{'a': 1, 'b': 3}, {'b': 1}]
+    calc.check(state_1.fairness_fn([1, 1], dicts, 4) == True)
+    calc.check(state_1.fairness_fn([1, 1], dicts, 3) == False)
+
+    # Small inputs take the loops, large ones the matrix, with the same results
+    hosts = ['127.0.0.1:%d' % i for i in range(30)]
+    dicts = [{host: (i * j) % 7 for j, host in enumerate(hosts) if (i + j) % 3} for i in range(30)]
+    small = state_1.metadata_vectors(dicts[:2], hosts[:2])
+    calc.check(isinstance(small, list) and small == state_1.metadata_matrix(dicts[:2], hosts[:2]).tolist())
+    large = state_1.metadata_vectors(dicts, hosts)
+    calc.check(not isinstance(large, list) and state_1.flatten_metadata(dicts, hosts) == large.tolist())
+    alphas = [1.0 / len(dicts)] * len(dicts)
+    matrix_temp = (np.asarray(alphas) @ large).tolist()
+    for thresh in [1, 3, 10]:
+        fair = DeviceFairnessReceiverState.fairness_for_one_vec(matrix_temp, thresh)
+        calc.check(state_1.fairness_fn(alphas, dicts, thresh) == fair)
+        calc.check(state_1.fairness_fn(alphas[:2], dicts[:2], thresh)
+            == DeviceFairnessReceiverState.fairness_for_one_vec(
+                [sum(a * d.get(h, 0) for a, d in zip(alphas, dicts[:2])) for h in set(dicts[0]) | set(dicts[1])], thresh))
+
 def add_tests(calc):
     calc.add_test(test_flatten_metadata)
     calc.add_test(test_update_internal_state_after_aggregation)
+    calc.add_test(test_metadata_matrix)
     # calc.add_test(test_determine_fairness_given_internal_state)
     # calc.add_test(test_update_internal_state_after_backprop)
     # calc.add_test(test_update_internal_state_after_aggregation)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import json
+import torch
+from unit.unit import TestCalculator
+from src.neural_net import Net
+from src.update_metadata.model_update import ModelUpdate
+
+def test_model_update_bytes(calc):
+    calc.context("test_model_update_bytes")
+    net = Net()
+    updates = { str(idx): params.clone() for idx, params in enumerate(net.parameters()) }
+    metadata = {'localhost:5000': 5, 'localhost:5001': 2.5}
+    buf = ModelUpdate(updates, metadata).to_bytes()
+
+    # Data region holds exactly one float32 per parameter
+    numel = sum(params.numel() for params in updates.values())
+    calc.check(len(buf) - numel * 4 < 1024)
+
+    # Round trip keeps keys, shapes, values and metadata
+    decoded = ModelUpdate.from_bytes(buf)
+    calc.check(decoded.update_metadata == metadata)
+    calc.check(list(decoded.updates.keys()) == list(updates.keys()))
+    for idx, params in updates.items():
+        calc.check(decoded.updates[idx].shape == params.shape)
+        calc.check(torch.equal(decoded.updates[idx], params.data))
+
+    # Decoding a writable buffer gives views into it rather than copies
+    writable = bytearray(buf)
+    decoded = ModelUpdate.from_bytes(writable)
+    decoded.updates['0'][0][0] = 42.0
+    calc.check(ModelUpdate.from_bytes(writable).updates['0'][0][0].item() == 42.0)
+
+    # Every tensor is a view into one flat tensor
+    calc.check(decoded.flat.numel() == numel)
+    calc.check(decoded.flat[0].item() == 42.0)
+
+    # Same values as the json path
+    from_json = ModelUpdate.from_dict(ModelUpdate(**json.loads(ModelUpdate(updates, metadata).to_json())))
+    decoded = ModelUpdate.from_bytes(buf)
+    for idx in updates:
+        calc.check(torch.equal(from_json.updates[idx], decoded.updates[idx]))
+
+    # Garbage is rejected
+    try:
+        ModelUpdate.from_bytes(b'{"updates": {}}')
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+
+def test_model_update_batch(calc):
+    calc.context("test_model_update_batch")
+    payloads = [
+        ModelUpdate({'0': torch.arange(6.0).view(2, 3)}, {'localhost:5000': 1}).to_bytes(),
+        ModelUpdate({'0': torch.ones(5)}, {'localhost:5000': 2}).to_bytes(),
+        b'odd length',
+    ]
+    unpacked = ModelUpdate.unpack_batch(ModelUpdate.pack_batch(payloads))
+    calc.check([bytes(p) for p in unpacked] == payloads)
+    first = ModelUpdate.from_bytes(unpacked[0])
+    calc.check(torch.equal(first.updates['0'], torch.arange(6.0).view(2, 3)))
+    calc.check(ModelUpdate.from_bytes(unpacked[1]).update_metadata == {'localhost:5000': 2})
+    calc.check(ModelUpdate.unpack_batch(ModelUpdate.pack_batch([])) == [])
+    try:
+        ModelUpdate.unpack_batch(payloads[0])
+        calc.check(False)
+    except ValueError:
+        calc.check(True)
+
+def add_tests(calc):
+    calc.add_test(test_model_update_bytes)
+    calc.add_test(test_model_update_batch)
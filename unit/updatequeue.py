@@ -1,7 +1,10 @@
+import time
+import torch
 from unit.unit import TestCalculator
 from src.util import EmptyQueueError
 from src.pendingwork import PendingWork
 from src.updatequeue import UpdateQueue
+from src.update_metadata.model_update import ModelUpdate
 
 def test_update_queue(calc):
     calc.context("test_update_queue")
@@ -40,5 +43,51 @@ def test_update_queue(calc):
     print("queue", queue.queue)
     print("length", queue.len)
 
+def test_update_queue_last(calc):
+    calc.context("test_update_queue_last")
+    queue = UpdateQueue()
+    try:
+        queue.replace_last("giraffe")
+        calc.check(False)
+    except EmptyQueueError:
+        calc.check(True)
+    queue.enqueue("giraffe")
+    queue.enqueue("elephant")
+    calc.check(queue.peek_last() == "elephant")
+    queue.replace_last("zebra")
+    calc.check(len(queue) == 2)
+    calc.check(queue.dequeue() == "giraffe")
+    calc.check(queue.dequeue() == "zebra")
+
+def test_update_queue_nbytes(calc):
+    calc.context("test_update_queue_nbytes")
+    queue = UpdateQueue()
+    queue.enqueue(b"1234")
+    queue.enqueue({"CLOSE": True})
+    queue.enqueue(ModelUpdate({'0': torch.zeros(10)}, {}))
+    calc.check(queue.nbytes == 44)
+    queue.replace_last(b"12")
+    calc.check(queue.nbytes == 6)
+    queue.replace(0, b"123456")
+    calc.check(queue.nbytes == 8)
+    queue.replace(0, b"1234")
+    queue.push_front(b"123")
+    calc.check(queue.nbytes == 9 and queue.peek() == b"123")
+    queue.dequeue()
+    queue.dequeue()
+    calc.check(queue.nbytes == 2)
+    queue.clear()
+    calc.check(queue.nbytes == 0)
+
+    # Draining a long queue is linear
+    for i in range(100000):
+        queue.enqueue(i)
+    start = time.time()
+    while len(queue) > 0:
+        queue.dequeue()
+    calc.check(time.time() - start < 1)
+
 def add_tests(calc):
-    calc.add_test(test_update_queue)
\ No newline at end of file
+    calc.add_test(test_update_queue)
+    calc.add_test(test_update_queue_last)
+    calc.add_test(test_update_queue_nbytes)
\ No newline at end of file